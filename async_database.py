@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DB_READER_POOL_SIZE
+from participant_cache import MISSING
+from metrics import add_request_time
+
+# Database methods that modify data. They are queued on a single writer
+# thread, so writes are applied in exactly the order handlers issued them.
+WRITE_METHODS = frozenset({
+    'add_participant',
+    'set_admin_by_user_id',
+    'add_training',
+    'link_poll_to_training',
+    'update_registration',
+    'apply_registrations',
+    'add_payment',
+    'import_payments',
+    'set_initial_balance_by_user_id',
+    'debit_funds_for_training',
+    'debit_trainings_until',
+    'debit_trainings_with_notices',
+    'acknowledge_debit_notices',
+    'rebuild_balances',
+    'rebuild_stats',
+    'compact_ledger',
+    'set_fsm_state',
+    'set_fsm_data',
+    'delete_expired_fsm_records',
+    'register_group',
+    'add_group_member',
+    'set_current_group',
+    'link_poll_to_group',
+})
+
+
+class AsyncDatabase:
+    """Awaitable counterpart of Database for use inside aiogram handlers.
+
+    Every Database method is available under the same name as a coroutine.
+    Queries run on executor threads, so a slow report or debit no longer
+    blocks the event loop: reads go to a pool sized like the reader
+    connections, writes to one dedicated thread.
+    """
+
+    def __init__(self, database, readers=DB_READER_POOL_SIZE):
+        self.database = database
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._read_executor = ThreadPoolExecutor(max_workers=max(readers, 1), thread_name_prefix='db-reader')
+
+    async def _run(self, executor, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+        finally:
+            add_request_time('db', time.perf_counter() - started)
+
+    async def execute(self, sql, parameters=(), fetchone=False, fetchall=False, commit=False):
+        executor = self._write_executor if commit else self._read_executor
+        return await self._run(executor, self.database.execute, sql, parameters,
+                               fetchone=fetchone, fetchall=fetchall, commit=commit)
+
+    # Identity and admin checks are answered from the participant cache on the
+    # event loop; only a cache miss, or the check for other processes' writes
+    # once per EXTERNAL_WRITES_CHECK_INTERVAL, costs a trip to the executor.
+    async def get_participant(self, telegram_id):
+        await self.check_external_writes()
+        participant = self.database.participants.get(telegram_id)
+        if participant is MISSING:
+            participant = await self._run(self._read_executor, self.database.load_participant, telegram_id)
+        return participant
+
+    async def get_participant_id(self, telegram_id):
+        participant = await self.get_participant(telegram_id)
+        return participant[0] if participant else None
+
+    async def get_admin_telegram_ids(self):
+        await self.check_external_writes()
+        admins = self.database.participants.get_admins()
+        if admins is None:
+            admins = await self._run(self._read_executor, self.database.load_admin_telegram_ids)
+        return admins
+
+    async def check_external_writes(self):
+        """Database.external_version, checked on a reader thread at most once per interval."""
+        if self.database.external_check_due():
+            await self._run(self._read_executor, self.database.check_external_writes)
+        return self.database.external_version
+
+    async def is_admin(self, telegram_id):
+        return telegram_id in await self.get_admin_telegram_ids()
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+        if not callable(method):
+            return method
+        executor = self._write_executor if name in WRITE_METHODS else self._read_executor
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await self._run(executor, method, *args, **kwargs)
+
+        # Cache the wrapper so the lookup only happens once per method
+        setattr(self, name, call)
+        return call
+
+    def close(self):
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.database.close()
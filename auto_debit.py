@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+
+from config import AUTO_DEBIT_INTERVAL, AUTO_DEBIT_DELAY, AUTO_DEBIT_BATCH_SIZE, AUTO_DEBIT_WINDOWS
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+AUTO_DEBIT_TRAININGS = REGISTRY.counter(
+    'bot_auto_debit_trainings_total', "Trainings debited by the background scheduler"
+)
+AUTO_DEBIT_NOTICES = REGISTRY.counter(
+    'bot_auto_debit_notices_total', "Coalesced debit notifications by delivery outcome", ('outcome',)
+)
+
+# Notices sent at a time; each batch is cleared from debit_notices only once it was delivered
+NOTICES_PER_BATCH = 20
+
+# Start time in the free-text time of a training, e.g. "18:00", "9.30" or "18:00-20:00"
+TRAINING_TIME = re.compile(r'(\d{1,2})[:.](\d{2})')
+
+
+def parse_windows(text):
+    """Parse "02:00-06:00,23:00-01:00" into [(start, end), ...] of datetime.time."""
+    windows = []
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        start, end = (datetime.strptime(value.strip(), '%H:%M').time() for value in part.split('-'))
+        windows.append((start, end))
+    return windows
+
+
+def in_windows(windows, moment):
+    """Whether `moment` falls into one of the windows; no windows means always."""
+    if not windows:
+        return True
+    now = moment.time()
+    for start, end in windows:
+        # A window like 23:00-01:00 wraps around midnight
+        if start <= now < end if start <= end else (now >= start or now < end):
+            return True
+    return False
+
+
+def training_start(date, time):
+    """When a training starts; trainings without a readable time count as starting at the end of the day."""
+    day = datetime.strptime(date, '%Y-%m-%d')
+    match = TRAINING_TIME.search(time or '')
+    if match and int(match.group(1)) < 24 and int(match.group(2)) < 60:
+        return day.replace(hour=int(match.group(1)), minute=int(match.group(2)))
+    return day + timedelta(days=1)
+
+
+def format_notice(notice):
+    text = f"С вашего счета списано: {notice.amount:.2f} руб."
+    if notice.trainings > 1:
+        text += f" Тренировок: {notice.trainings}."
+    text += f" Ваш новый баланс: {notice.balance:.2f} руб."
+    if notice.balance < 0:
+        text += " Пожалуйста, пополните счёт."
+    return text
+
+
+class AutoDebitScheduler:
+    """Background task that debits past trainings during quiet hours.
+
+    Every `interval` seconds inside one of the quiet `windows`, each group's
+    trainings that started more than `delay` seconds ago are debited,
+    `batch_size` trainings per transaction, so admins don't have to and the
+    writes stay out of busy hours. Each debit transaction also adds to a
+    per-participant row of debit_notices; after the group is done, those
+    are sent as one message per participant however many trainings were
+    debited. A notice is only removed once the broadcaster has delivered
+    it (or given up on it), so progress survives a restart: debited
+    trainings are never debited again and unsent notices go out in the
+    next run. Only a crash between delivering a batch and removing it can
+    send those few messages twice.
+    """
+
+    def __init__(self, shards, broadcaster, interval=AUTO_DEBIT_INTERVAL, delay=AUTO_DEBIT_DELAY,
+                 batch_size=AUTO_DEBIT_BATCH_SIZE, windows=AUTO_DEBIT_WINDOWS):
+        self.shards = shards
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self.delay = timedelta(seconds=delay)
+        self.batch_size = batch_size
+        self.windows = parse_windows(windows)
+        self.last_run = None
+        self.debited = 0
+        self._task = None
+        self._stopping = asyncio.Event()
+
+    def start(self):
+        if self.interval > 0:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        """Let the current batch finish for up to `timeout` seconds, then stop.
+
+        Call it before stopping the broadcaster, which delivers the batch.
+        """
+        if self._task:
+            self._stopping.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Stopping automatic debits in the middle of a batch")
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Automatic debit failed")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self, now=None):
+        """Debit every group's due trainings if `now` is in a quiet window; returns the number debited."""
+        now = now or datetime.now()
+        if not in_windows(self.windows, now):
+            return 0
+        debited = 0
+        for chat_id in self.shards.chat_ids():
+            if self._stopping.is_set():
+                break
+            async with self.shards.use(chat_id) as db:
+                if db is not None:
+                    debited += await self._debit_group(db, now)
+        self.last_run = now
+        self.debited += debited
+        return debited
+
+    async def _debit_group(self, db, now):
+        due = [training_id for training_id, date, time, *_ in await db.get_undebited_trainings()
+               if training_start(date, time) + self.delay <= now]
+        debited = 0
+        for start in range(0, len(due), self.batch_size):
+            # A long backlog stops when the window closes and resumes in the next one
+            if self._stopping.is_set() or not in_windows(self.windows, datetime.now()):
+                break
+            debited += len(await db.debit_trainings_with_notices(due[start:start + self.batch_size]))
+        AUTO_DEBIT_TRAININGS.inc(amount=debited)
+        await self._send_notices(db)
+        return debited
+
+    async def _send_notices(self, db):
+        while not self._stopping.is_set():
+            notices = await db.get_debit_notices(NOTICES_PER_BATCH)
+            if not notices:
+                return
+            results = await asyncio.gather(*(
+                self.broadcaster.send(notice.telegram_id, format_notice(notice)) for notice in notices
+            ))
+            # Failed ones were retried by the broadcaster already, or can't be delivered at all
+            await db.acknowledge_debit_notices(notices)
+            for result in results:
+                AUTO_DEBIT_NOTICES.inc('sent' if result.ok else 'failed')
+
+    def stats(self):
+        return {'debited': self.debited, 'last_run': self.last_run}
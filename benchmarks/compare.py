@@ -0,0 +1,35 @@
+"""Compare two benchmarks.run result files by median time per operation.
+
+    python -m benchmarks.compare base.json new.json
+"""
+import argparse
+import json
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    args = parser.parse_args()
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+
+    print(f"base {base.get('commit') or '?'} -> new {new.get('commit') or '?'}")
+    for scale, results in new['scales'].items():
+        base_ops = base['scales'].get(scale, {}).get('operations', {})
+        print(f"\n[{scale}]")
+        print(f"{'operation':<28}{'base ms':>12}{'new ms':>12}{'change':>10}")
+        for operation, stats in results['operations'].items():
+            after = stats['median'] * 1000
+            before = base_ops.get(operation, {}).get('median')
+            if before is None:
+                print(f"{operation:<28}{'-':>12}{after:>12.3f}{'':>10}")
+            else:
+                before *= 1000
+                print(f"{operation:<28}{before:>12.3f}{after:>12.3f}{(after - before) / before:>+10.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Per-call cost of Database.execute: connection-per-call vs the pooled connections.
+
+Both variants run the original query methods (OriginalQueries), so only the connection
+handling differs.
+
+Run from the repository root:
+
+    python -m benchmarks.connection_overhead --calls 2000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from database import Database
+
+
+class OriginalQueries:
+    """The measured methods as they were before pooling, pinned so both variants run the same
+    statements: later versions answer them from the participant cache, participant_balances
+    or an explicit transaction and would no longer go through execute() at all."""
+
+    def logger(self, statement):
+        pass
+
+    def get_participant(self, telegram_id):
+        sql = "SELECT * FROM participants WHERE telegram_id = ?"
+        return self.execute(sql, (telegram_id,), fetchone=True)
+
+    def get_participant_id(self, telegram_id):
+        sql = "SELECT id FROM participants WHERE telegram_id = ?"
+        result = self.execute(sql, (telegram_id,), fetchone=True)
+        return result[0] if result else None
+
+    def calculate_balance(self, telegram_id):
+        participant_id = self.get_participant_id(telegram_id)
+        last_initial_balance = self.execute(
+            "SELECT balance, date FROM initial_balances WHERE participant_id = ? ORDER BY date DESC LIMIT 1",
+            (participant_id,), fetchone=True
+        )
+        if last_initial_balance:
+            initial_balance, initial_date = last_initial_balance
+            payments = self.execute(
+                "SELECT SUM(amount) FROM payments WHERE participant_id = ? AND date >= ?",
+                (participant_id, initial_date), fetchone=True
+            )[0] or 0
+            return initial_balance + payments
+        return self.execute(
+            "SELECT SUM(amount) FROM payments WHERE participant_id = ?",
+            (participant_id,), fetchone=True
+        )[0] or 0
+
+    def update_registration(self, telegram_id, training_id, status):
+        participant_id = self.get_participant_id(telegram_id)
+        registration = self.execute(
+            "SELECT * FROM training_registrations WHERE training_id = ? AND participant_id = ?",
+            (training_id, participant_id), fetchone=True
+        )
+        if registration:
+            self.execute(
+                "UPDATE training_registrations SET status = ? WHERE id = ?",
+                (status, registration[0]), commit=True
+            )
+        else:
+            self.execute(
+                "INSERT INTO training_registrations (training_id, participant_id, status) VALUES (?, ?, ?)",
+                (training_id, participant_id, status), commit=True
+            )
+
+
+class ConnectPerCallDatabase(OriginalQueries, Database):
+    """Reproduces the original behaviour: open, trace, run one statement, close."""
+
+    def execute(self, sql, parameters=(), fetchone=False, fetchall=False, commit=False):
+        connection = sqlite3.connect(self.path_to_db)
+        connection.set_trace_callback(self.logger)
+        cursor = connection.cursor()
+        cursor.execute(sql, parameters)
+        if commit:
+            connection.commit()
+        data = self._fetch(cursor, fetchone, fetchall)
+        connection.close()
+        return data
+
+
+class PooledDatabase(OriginalQueries, Database):
+    """The same statements through the pooled Database.execute()."""
+
+
+def create_schema(path):
+    connection = sqlite3.connect(path)
+    with open('database_setup.sql', 'r', encoding='utf-8') as f:
+        connection.executescript(f.read())
+    connection.executemany(
+        "INSERT INTO participants (telegram_id, name) VALUES (?, ?)",
+        [(1000 + i, f"Participant {i}") for i in range(50)]
+    )
+    connection.execute("INSERT INTO trainings (date, time, location, fee) VALUES ('2024-11-18', '18:00', 'Gym', 500)")
+    connection.commit()
+    connection.close()
+
+
+def time_calls(db, calls):
+    results = {}
+
+    started = time.perf_counter()
+    for i in range(calls):
+        db.get_participant(1000 + i % 50)
+    results['get_participant'] = (time.perf_counter() - started) / calls
+
+    started = time.perf_counter()
+    for i in range(calls):
+        db.calculate_balance(1000 + i % 50)
+    results['calculate_balance'] = (time.perf_counter() - started) / calls
+
+    started = time.perf_counter()
+    for i in range(calls):
+        db.update_registration(1000 + i % 50, 1, 'смогу' if i % 2 else 'не смогу')
+    results['update_registration'] = (time.perf_counter() - started) / calls
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = []
+        variants = (
+            # No pool and no pragmas: the original rollback-journal setup
+            ('connect-per-call', lambda path: ConnectPerCallDatabase(path, pool_size=0, pragmas={})),
+            ('pooled', PooledDatabase),
+        )
+        for label, factory in variants:
+            path = os.path.join(tmp, f"{label}.db")
+            create_schema(path)
+            db = factory(path)
+            rows.append((label, time_calls(db, args.calls)))
+            db.close()
+
+    print(f"{'operation':<22}" + "".join(f"{label:>20}" for label, _ in rows) + f"{'speedup':>10}")
+    for operation in rows[0][1]:
+        before = rows[0][1][operation]
+        after = rows[1][1][operation]
+        print(f"{operation:<22}{before * 1e6:>17.1f} us{after * 1e6:>17.1f} us{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Synthetic group-accounting databases for benchmarks."""
+import random
+import sqlite3
+from collections import namedtuple
+from datetime import date, timedelta
+
+from database import STATUS_ATTENDING, STATUS_WITH_FRIEND
+from migrate import apply_migrations
+
+Scale = namedtuple('Scale', 'participants trainings payments resets attendees')
+
+SCALES = {
+    'small': Scale(participants=100, trainings=50, payments=5_000, resets=50, attendees=15),
+    'medium': Scale(participants=1_000, trainings=500, payments=100_000, resets=1_000, attendees=25),
+    'large': Scale(participants=10_000, trainings=5_000, payments=1_000_000, resets=20_000, attendees=40),
+}
+
+# The last trainings are left undebited so debit benchmarks have work to do
+UNDEBITED_TRAININGS = 20
+
+STATUSES = (STATUS_ATTENDING, STATUS_WITH_FRIEND, 'не смогу', 'не определился')
+STATUS_WEIGHTS = (70, 10, 15, 5)
+
+
+def _day(start, offset):
+    return (start + timedelta(days=offset)).isoformat()
+
+
+def generate(path, scale, seed=0, batch=50_000):
+    """Create a database at `path` filled according to `scale` (a Scale or a SCALES key).
+
+    Training fees for attended trainings are booked as negative payments,
+    like a real debit would. Returns the Scale used.
+    """
+    if isinstance(scale, str):
+        scale = SCALES[scale]
+    rng = random.Random(seed)
+    start = date(2020, 1, 1)
+    days = max(scale.trainings, 365)
+
+    connection = sqlite3.connect(path)
+    with open('database_setup.sql', 'r', encoding='utf-8') as f:
+        connection.executescript(f.read())
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = OFF")
+
+    connection.executemany(
+        "INSERT INTO participants (id, telegram_id, name, is_admin) VALUES (?, ?, ?, ?)",
+        ((i, 100_000 + i, f"Участник {i}", int(i <= 3)) for i in range(1, scale.participants + 1))
+    )
+
+    trainings = []
+    for i in range(1, scale.trainings + 1):
+        offset = int(i * days / scale.trainings)
+        trainings.append((i, _day(start, offset), '19:00', 'Зал', 500.0, int(i <= scale.trainings - UNDEBITED_TRAININGS)))
+    connection.executemany(
+        "INSERT INTO trainings (id, date, time, location, fee, is_funds_debited) VALUES (?, ?, ?, ?, ?, ?)",
+        trainings
+    )
+    connection.executemany(
+        "INSERT INTO training_polls (training_id, poll_id) VALUES (?, ?)",
+        ((i, f"poll-{i}") for i in range(1, scale.trainings + 1))
+    )
+
+    registrations = []
+    debits = []
+    for training_id, training_date, _, _, fee, debited in trainings:
+        attendees = rng.sample(range(1, scale.participants + 1), min(scale.attendees, scale.participants))
+        for participant_id in attendees:
+            status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+            registrations.append((training_id, participant_id, status))
+            if debited and status in (STATUS_ATTENDING, STATUS_WITH_FRIEND):
+                debits.append((participant_id, -fee * (2 if status == STATUS_WITH_FRIEND else 1), training_date))
+    connection.executemany(
+        "INSERT INTO training_registrations (training_id, participant_id, status) VALUES (?, ?, ?)",
+        registrations
+    )
+
+    # Debits count towards the payment budget; the rest are top-ups
+    debits = debits[:scale.payments]
+    connection.executemany("INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)", debits)
+    remaining = scale.payments - len(debits)
+    while remaining > 0:
+        chunk = min(batch, remaining)
+        connection.executemany(
+            "INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)",
+            ((rng.randint(1, scale.participants), float(rng.choice((500, 1000, 2000, 5000))),
+              _day(start, rng.randrange(days))) for _ in range(chunk))
+        )
+        remaining -= chunk
+
+    connection.executemany(
+        "INSERT INTO initial_balances (participant_id, balance, date) VALUES (?, ?, ?)",
+        ((rng.randint(1, scale.participants), float(rng.randrange(-5000, 5000, 100)), _day(start, rng.randrange(days)))
+         for _ in range(scale.resets))
+    )
+    connection.commit()
+    connection.close()
+
+    apply_migrations(path)
+    # Materialized balances are derived data; build them the way the bot would
+    from database import Database
+    db = Database(path)
+    db.rebuild_balances()
+    db.close()
+    return scale
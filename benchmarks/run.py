@@ -0,0 +1,115 @@
+"""Time the Database hot paths on synthetic datasets and emit JSON results.
+
+    python -m benchmarks.run --scales small medium --output results.json
+    python -m benchmarks.compare base.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from database import Database
+from benchmarks.datasets import SCALES, UNDEBITED_TRAININGS, generate
+
+
+def measure(operation, runs):
+    """Call operation(i) `runs` times and return timing stats in seconds."""
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        operation(i)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'runs': runs,
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'mean': statistics.fmean(timings),
+    }
+
+
+def benchmark_database(path, scale, runs, seed=0):
+    rng = random.Random(seed)
+    telegram_ids = [100_000 + rng.randint(1, scale.participants) for _ in range(runs)]
+    db = Database(path)
+    try:
+        middle_id = scale.trainings // 2
+        middle = (db.get_training_date(middle_id), middle_id)
+        results = {
+            'calculate_balance': measure(lambda i: db.calculate_balance(telegram_ids[i]), runs),
+            'get_all_balances': measure(lambda i: db.get_all_balances(), max(runs // 10, 3)),
+            'update_registration': measure(
+                lambda i: db.update_registration(telegram_ids[i], scale.trainings, 'смогу' if i % 2 else 'не смогу'), runs
+            ),
+            'get_trainings_page.first': measure(lambda i: db.get_trainings_page(), runs),
+            'get_trainings_page.middle': measure(lambda i: db.get_trainings_page(middle), runs),
+            'get_undebited_trainings': measure(lambda i: db.get_undebited_trainings(), runs),
+            # Each run consumes one undebited training
+            'debit_funds_for_training': measure(
+                lambda i: db.debit_funds_for_training(scale.trainings - UNDEBITED_TRAININGS + 1 + i),
+                min(runs, UNDEBITED_TRAININGS)
+            ),
+            'verify_balances': measure(lambda i: db.verify_balances(), 3),
+        }
+    finally:
+        db.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Database hot paths on synthetic data")
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=['small', 'medium'])
+    parser.add_argument('--runs', type=int, default=200, help="calls per operation")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    parser.add_argument('--keep', metavar='DIR', help="keep the generated databases in DIR")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scales': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.keep or tmp
+        for name in args.scales:
+            path = os.path.join(directory, f"bench_{name}.db")
+            if os.path.exists(path):
+                os.remove(path)
+            started = time.perf_counter()
+            scale = generate(path, name)
+            generated = time.perf_counter() - started
+            print(f"{name}: generated in {generated:.1f}s", file=sys.stderr)
+            report['scales'][name] = {
+                'dataset': scale._asdict(),
+                'generate_seconds': generated,
+                'operations': benchmark_database(path, scale, args.runs),
+            }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,61 @@
 import asyncio
+import logging
+import os
+import tempfile
+from datetime import datetime
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, PollAnswer
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, PollAnswer, FSInputFile
 from aiogram.dispatcher.router import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import API_TOKEN, GROUP_CHAT_ID
+from config import (
+    API_TOKEN, GROUP_CHAT_ID, DB_PATH, TELEGRAM_API_URL,
+    BOT_MODE, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET,
+    METRICS_HOST, METRICS_PORT, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL, DB_TRACE_SQL,
+)
 from database import Database
+from async_database import AsyncDatabase
+from notifications import Broadcaster
+from poll_answers import PollAnswerBatcher
+from auto_debit import AutoDebitScheduler
+from migrate import apply_migrations
+from reports import TELEGRAM_MESSAGE_LIMIT, chunk_lines, format_attendance_lines, format_spending_lines
+from metrics import start_metrics_server, dump_metrics_periodically
+from middlewares import setup_metrics_middlewares, format_stats
+from webhook import WebhookServer
+from fsm_storage import SQLiteStorage
+from shards import ShardManager, ShardMiddleware
+from scheduler import KeyedScheduler
+from export import write_ledger_export
+from payment_import import ParticipantIndex, read_statement
+from report_cache import ReportCache
 
 # Initialize Bot, Dispatcher, and FSM Storage
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-db = Database()
+if TELEGRAM_API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
+# The main database holds the default group's data and the directory of groups
+main_db = AsyncDatabase(Database())
+shards = ShardManager(main_db, int(GROUP_CHAT_ID) if GROUP_CHAT_ID else None)
+dp = Dispatcher(storage=SQLiteStorage(main_db))
+broadcaster = Broadcaster(bot)
+poll_answers = PollAnswerBatcher(shards)
+report_cache = ReportCache()
+auto_debit = AutoDebitScheduler(shards, broadcaster)
 
 # Create a router for handling callback queries
 router = Router()
 dp.include_router(router)
+# The scheduler goes first: later middlewares await, which would lose arrival order. Update
+# metrics therefore start once an update got its turn; the wait is in bot_scheduler_wait_seconds.
+scheduler = KeyedScheduler()
+dp.update.outer_middleware(scheduler)
+setup_metrics_middlewares(dp, bot)
+dp.update.outer_middleware(ShardMiddleware(shards))
 
 # Define states for poll creation
 class PollCreation(StatesGroup):
@@ -42,11 +81,61 @@ async def cmd_get_group_id(message: Message):
     chat_id = message.chat.id
     await message.answer(f"ID этой группы: {chat_id}")
 
+@dp.message(Command('add_group'), lambda message: message.chat.type != 'private')
+async def cmd_add_group(message: Message):
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    if member.status not in ('creator', 'administrator'):
+        await message.reply("Подключить группу может только администратор чата.")
+        return
+    if not await shards.add_group(message.chat.id, message.chat.title):
+        await message.reply("Эта группа уже подключена.")
+        return
+    async with shards.use(message.chat.id) as db:
+        await db.add_participant(message.from_user.id, message.from_user.full_name, is_admin=True)
+    await shards.add_member(message.from_user.id, message.chat.id)
+    await message.reply("Группа подключена, вы назначены её администратором. "
+                        "Участники регистрируются командой /join в этом чате.")
+
+@dp.message(Command('join'), lambda message: message.chat.type != 'private')
+async def cmd_join(message: Message, db: AsyncDatabase):
+    if db is None:
+        await message.reply("Группа не подключена. Администратор чата может подключить её командой /add_group.")
+        return
+    if not await db.get_participant(message.from_user.id):
+        await db.add_participant(message.from_user.id, message.from_user.full_name)
+    await shards.add_member(message.from_user.id, message.chat.id)
+    await message.reply(f"{message.from_user.full_name}, вы зарегистрированы в группе. "
+                        "Команды бота доступны в личном чате: /start")
+
+@dp.message(Command('groups'), lambda message: message.chat.type == 'private')
+async def cmd_groups(message: Message):
+    groups = await shards.member_groups(message.from_user.id)
+    if not groups:
+        await message.answer("Вы не состоите ни в одной группе. Отправьте /join в чате группы.")
+        return
+    lines = [f"{'• ' if is_current else ''}{title or chat_id} [{chat_id}]" for chat_id, title, is_current in groups]
+    await message.answer("Ваши группы (• — текущая):\n" + "\n".join(lines) +
+                         "\n\nСменить текущую группу: /group ID")
+
+@dp.message(Command('group'), lambda message: message.chat.type == 'private')
+async def cmd_group(message: Message):
+    args = message.text.split(maxsplit=1)
+    try:
+        chat_id = int(args[1])
+    except (IndexError, ValueError):
+        await message.answer("Формат: /group ID (список групп: /groups)")
+        return
+    if await shards.set_current_group(message.from_user.id, chat_id):
+        await message.answer(f"Текущая группа: {shards.title(chat_id) or chat_id}")
+    else:
+        await message.answer("Вы не состоите в этой группе.")
+
 @dp.message(Command('start'), lambda message: message.chat.type == 'private')
-async def cmd_start(message: Message):
-    participant = db.get_participant(message.from_user.id)
+async def cmd_start(message: Message, db: AsyncDatabase, group_chat_id: int):
+    participant = await db.get_participant(message.from_user.id)
     if not participant:
-        db.add_participant(message.from_user.id, message.from_user.full_name)
+        await db.add_participant(message.from_user.id, message.from_user.full_name)
+        await shards.add_member(message.from_user.id, group_chat_id)
         await message.answer("Вы успешно зарегистрированы.")
     else:
         await message.answer("Вы уже зарегистрированы.")
@@ -58,7 +147,7 @@ async def cmd_start(message: Message):
     ]
     
     # Add admin-specific buttons
-    if db.is_admin(message.from_user.id):
+    if await db.is_admin(message.from_user.id):
         buttons.extend([
             ("Создать опрос", "create_poll"),
             ("Баланс всех участников", "all_balances"),
@@ -73,21 +162,21 @@ async def cmd_start(message: Message):
     await message.answer("Выберите действие:", reply_markup=keyboard)
 
 @router.callback_query(lambda c: c.data == 'check_balance')
-async def process_check_balance_callback(callback_query: CallbackQuery):
-    balance = db.calculate_balance(callback_query.from_user.id)
+async def process_check_balance_callback(callback_query: CallbackQuery, db: AsyncDatabase):
+    balance = await db.calculate_balance(callback_query.from_user.id)
     await bot.answer_callback_query(callback_query.id)
     await bot.send_message(callback_query.from_user.id, f"Ваш текущий баланс: {balance:.2f} руб.")
 
 @router.callback_query(lambda c: c.data == 'create_poll')
-async def start_poll_creation(callback_query: CallbackQuery, state: FSMContext):
+async def start_poll_creation(callback_query: CallbackQuery, state: FSMContext, db: AsyncDatabase):
     await bot.answer_callback_query(callback_query.id)
-    participant = db.get_participant(callback_query.from_user.id)
+    participant = await db.get_participant(callback_query.from_user.id)
     if not participant:
         await callback_query.message.answer("Вы не зарегистрированы. Пожалуйста, нажмите /start для регистрации.")
         return
 
-    await callback_query.message.answer("Введите дату для тренировки (например, 2024-11-18) или /cancel для выхода:")
     await state.set_state(PollCreation.waiting_for_date)
+    await callback_query.message.answer("Введите дату для тренировки (например, 2024-11-18) или /cancel для выхода:")
 
 @dp.message(PollCreation.waiting_for_date, lambda message: message.chat.type == 'private')
 async def poll_date_received(message: Message, state: FSMContext):
@@ -96,8 +185,8 @@ async def poll_date_received(message: Message, state: FSMContext):
         await message.answer("Создание опроса отменено.")
         return
     await state.update_data(date=message.text)
-    await message.answer("Введите время для тренировки (например, 18:00) или /cancel для выхода:")
     await state.set_state(PollCreation.waiting_for_time)
+    await message.answer("Введите время для тренировки (например, 18:00) или /cancel для выхода:")
 
 @dp.message(PollCreation.waiting_for_time, lambda message: message.chat.type == 'private')
 async def poll_time_received(message: Message, state: FSMContext):
@@ -106,8 +195,8 @@ async def poll_time_received(message: Message, state: FSMContext):
         await message.answer("Создание опроса отменено.")
         return
     await state.update_data(time=message.text)
-    await message.answer("Введите место для тренировки (например, спортивный зал) или /cancel для выхода:")
     await state.set_state(PollCreation.waiting_for_location)
+    await message.answer("Введите место для тренировки (например, спортивный зал) или /cancel для выхода:")
 
 @dp.message(PollCreation.waiting_for_location, lambda message: message.chat.type == 'private')
 async def poll_location_received(message: Message, state: FSMContext):
@@ -116,8 +205,8 @@ async def poll_location_received(message: Message, state: FSMContext):
         await message.answer("Создание опроса отменено.")
         return
     await state.update_data(location=message.text)
-    await message.answer("Введите стоимость тренировки (например, 500) или /cancel для выхода:")
     await state.set_state(PollCreation.waiting_for_fee)
+    await message.answer("Введите стоимость тренировки (например, 500) или /cancel для выхода:")
 
 @dp.message(PollCreation.waiting_for_fee, lambda message: message.chat.type == 'private')
 async def poll_fee_received(message: Message, state: FSMContext):
@@ -132,11 +221,11 @@ async def poll_fee_received(message: Message, state: FSMContext):
         return
 
     await state.update_data(fee=fee)
-    await message.answer("Введите комментарий к тренировке или '-' для отсутствия комментария:")
     await state.set_state(PollCreation.waiting_for_comment)
+    await message.answer("Введите комментарий к тренировке или '-' для отсутствия комментария:")
 
 @dp.message(PollCreation.waiting_for_comment, lambda message: message.chat.type == 'private')
-async def poll_comment_received(message: Message, state: FSMContext):
+async def poll_comment_received(message: Message, state: FSMContext, db: AsyncDatabase, group_chat_id: int):
     comment_input = message.text.strip()
     comment = None if comment_input == '-' else comment_input
     
@@ -169,7 +258,7 @@ async def poll_comment_received(message: Message, state: FSMContext):
 
     # Send poll to the group
     poll_message = await bot.send_poll(
-        GROUP_CHAT_ID,
+        group_chat_id,
             question=poll_question,
             options=poll_options,
             is_anonymous=False,
@@ -177,8 +266,9 @@ async def poll_comment_received(message: Message, state: FSMContext):
     )
 
     # Save poll to the database
-    training_id = db.add_training(date, time, location, fee, comment)
-    db.link_poll_to_training(training_id, poll_message.poll.id)
+    training_id = await db.add_training(date, time, location, fee, comment)
+    await db.link_poll_to_training(training_id, poll_message.poll.id)
+    await shards.link_poll(poll_message.poll.id, group_chat_id)
 
     await message.answer("Опрос создан и отправлен всем участникам!")
     await state.clear()
@@ -186,29 +276,28 @@ async def poll_comment_received(message: Message, state: FSMContext):
 @router.callback_query(lambda c: c.data == 'pay')
 async def start_payment_process(callback_query: CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id)
-    await callback_query.message.answer("Введите сумму для оплаты или /cancel для выхода:")
     await state.set_state(PaymentProcess.waiting_for_amount)
+    await callback_query.message.answer("Введите сумму для оплаты или /cancel для выхода:")
 
 @dp.message(PaymentProcess.waiting_for_amount, lambda message: message.chat.type == 'private')
-async def payment_amount_received(message: Message, state: FSMContext):
+async def payment_amount_received(message: Message, state: FSMContext, db: AsyncDatabase):
     if message.text.lower() == '/cancel':
         await state.clear()
         await message.answer("Процесс оплаты отменен.")
         return
     try:
         amount = float(message.text)
-        if db.add_payment(message.from_user.id, amount):
-            new_balance = db.calculate_balance(message.from_user.id)
+        if await db.add_payment(message.from_user.id, amount):
+            new_balance = await db.calculate_balance(message.from_user.id)
             await message.answer(f"Ваш баланс пополнен на {amount:.2f} руб. Текущий баланс: {new_balance:.2f} руб.")
             
-            participant_id = db.get_participant_id(message.from_user.id)
+            participant_id = await db.get_participant_id(message.from_user.id)
             admin_message = (
                 f"Пользователь {message.from_user.full_name} [{participant_id}] пополнил баланс на {amount:.2f} руб. "
                 f"Текущий баланс пользователя: {new_balance:.2f} руб."
             )
-            for name, user_id, telegram_id in db.get_all_participants():
-                if db.is_admin(telegram_id):
-                    await bot.send_message(telegram_id, admin_message)
+            for telegram_id in await db.get_admin_telegram_ids():
+                broadcaster.enqueue(telegram_id, admin_message)
         else:
             await message.answer("Вы не зарегистрированы.")
     except ValueError:
@@ -216,24 +305,25 @@ async def payment_amount_received(message: Message, state: FSMContext):
     await state.clear()
 
 @router.callback_query(lambda c: c.data == 'all_balances')
-async def process_all_balances_callback(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
-        report = db.get_all_balances()
+async def process_all_balances_callback(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
+        report = await report_cache.get(db, 'all_balances', db.get_all_balances)
         await bot.answer_callback_query(callback_query.id)
-        await bot.send_message(callback_query.from_user.id, report)
+        for chunk in report or ["Нет участников."]:
+            await bot.send_message(callback_query.from_user.id, chunk)
     else:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
 @dp.message(Command('set_admin'), lambda message: message.chat.type == 'private')
-async def cmd_set_admin(message: Message):
-    if db.is_admin(message.from_user.id):
+async def cmd_set_admin(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
         args = message.text.split(maxsplit=1)
         if len(args) < 2:
             await message.answer("Формат: /set_admin UserID")
             return
         try:
             new_admin_user_id = int(args[1])
-            db.set_admin_by_user_id(new_admin_user_id)
+            await db.set_admin_by_user_id(new_admin_user_id)
             await message.answer("Администратор успешно добавлен.")
             await bot.send_message(new_admin_user_id, "Вы были назначены администратором.")
         except ValueError:
@@ -242,19 +332,20 @@ async def cmd_set_admin(message: Message):
         await message.answer("Только администратор может выполнять эту команду.")
 
 @router.callback_query(lambda c: c.data == 'set_admin')
-async def handle_set_admin_callback(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
+async def handle_set_admin_callback(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(callback_query.from_user.id, "Чтобы добавить администратора, используйте команду:\n/set_admin UserID")
     else:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
 @router.callback_query(lambda c: c.data == 'list_participants')
-async def list_participants(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
-        participants = db.get_all_participants()
+async def list_participants(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
+        participants = await db.get_all_participants()
+        admins = await db.get_admin_telegram_ids()
         participant_list = "\n".join([
-            f"{name} - [{user_id}]" + (" (Администратор)" if db.is_admin(telegram_id) else "")
+            f"{name} - [{user_id}]" + (" (Администратор)" if telegram_id in admins else "")
             for name, user_id, telegram_id in participants
         ])
         await bot.answer_callback_query(callback_query.id)
@@ -263,52 +354,69 @@ async def list_participants(callback_query: CallbackQuery):
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
 @router.callback_query(lambda c: c.data == 'set_initial_balance')
-async def set_initial_balance_prompt(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
+async def set_initial_balance_prompt(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(callback_query.from_user.id, "Введите UserID и начальный баланс в формате: /set_initial_balance UserID сумма")
     else:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
+def format_trainings_page(page):
+    lines = []
+    for training in page.rows:
+        comment_text = f" ({training.comment})" if training.comment else ""
+        lines.append(
+            f"[{training.id}] {training.date}, {training.time}, {training.location}{comment_text}, {training.fee} руб. | "
+            f"Участники: {training.attendees or ''} | С друзьями: {training.plus_ones} | "
+            f"Итоговая стоимость: {training.total_cost} руб. | Средства списаны: {'Да' if training.is_funds_debited else 'Нет'}"
+        )
+    text = "Список тренировок:\n" + ("\n".join(lines) if lines else "Тренировок нет.")
+    return text[:TELEGRAM_MESSAGE_LIMIT]
+
+def create_trainings_page_keyboard(page):
+    # Callback data carries the (date, id) key of the row next to the page boundary
+    buttons = []
+    if page.has_newer:
+        first = page.rows[0]
+        buttons.append(InlineKeyboardButton(text="◀ Новее", callback_data=f"trainings|newer|{first.date}|{first.id}"))
+    if page.has_older:
+        last = page.rows[-1]
+        buttons.append(InlineKeyboardButton(text="Старше ▶", callback_data=f"trainings|older|{last.date}|{last.id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
+
 @router.callback_query(lambda c: c.data == 'list_trainings')
-async def list_trainings(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
-        trainings = db.get_all_trainings()
-        training_list = []
-        for training_id, date, time, location, fee, is_funds_debited, comment in trainings:
-            if comment:
-                comment_text = f" ({comment})"
-            else:
-                comment_text = ""
-            participants = db.execute(
-                "SELECT p.name, r.status FROM training_registrations r JOIN participants p ON r.participant_id = p.id WHERE r.training_id = ?",
-                (training_id,), fetchall=True
-            )
-            participant_list = ", ".join([
-                f"{name}{' (с другом)' if status == 'приду с другом' else ''}"
-                for name, status in participants if status in ['смогу', 'приду с другом']
-            ])
-            total_cost = sum(fee * (2 if status == 'приду с другом' else 1) for _, status in participants if status in ['смогу', 'приду с другом'])
-            training_list.append(
-                f"[{training_id}] {date}, {time}, {location}{comment_text}, {fee} руб. | Участники: {participant_list} | Итоговая стоимость: {total_cost} руб. | Средства списаны: {'Да' if is_funds_debited else 'Нет'}"
-            )
-        training_list = "\n".join(training_list)
+async def list_trainings(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
+        page = await report_cache.get(db, 'trainings_page', db.get_trainings_page)
+        await bot.answer_callback_query(callback_query.id)
+        await bot.send_message(callback_query.from_user.id, format_trainings_page(page),
+                               reply_markup=create_trainings_page_keyboard(page))
+    else:
+        await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
+
+@router.callback_query(lambda c: c.data.startswith('trainings|'))
+async def navigate_trainings(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
+        _, direction, date, training_id = callback_query.data.split('|')
+        page = await report_cache.get(db, 'trainings_page', db.get_trainings_page,
+                                 (date, int(training_id)), newer=direction == 'newer')
         await bot.answer_callback_query(callback_query.id)
-        await bot.send_message(callback_query.from_user.id, f"Список тренировок:\n{training_list}")
+        await callback_query.message.edit_text(format_trainings_page(page),
+                                               reply_markup=create_trainings_page_keyboard(page))
     else:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
 def create_training_keyboard(trainings):
      buttons = [
          [InlineKeyboardButton(text=f"{date} {time} - {location}{' (' + comment + ')' if comment else ''}", callback_data=f"debit_{training_id}")]
-         for training_id, date, time, location, fee, is_funds_debited, comment in trainings if not is_funds_debited
+         for training_id, date, time, location, fee, is_funds_debited, comment in trainings
      ]
      return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 @router.callback_query(lambda c: c.data == 'debit_funds')
-async def handle_debit_funds_callback(callback_query: CallbackQuery):
-    if db.is_admin(callback_query.from_user.id):
-        trainings = db.get_all_trainings()
+async def handle_debit_funds_callback(callback_query: CallbackQuery, db: AsyncDatabase):
+    if await db.is_admin(callback_query.from_user.id):
+        trainings = await db.get_undebited_trainings()
         keyboard = create_training_keyboard(trainings)
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(callback_query.from_user.id, "Выберите тренировку для списания средств:",
@@ -317,61 +425,68 @@ async def handle_debit_funds_callback(callback_query: CallbackQuery):
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этой команды.")
 
 @router.callback_query(lambda c: c.data.startswith('debit_'))
-async def process_debit_training(callback_query: CallbackQuery):
+async def process_debit_training(callback_query: CallbackQuery, db: AsyncDatabase):
     training_id = int(callback_query.data.split('_')[1])
-    if db.debit_funds_for_training(training_id):
-        participants = db.execute(
-            "SELECT p.id, p.telegram_id, r.status FROM training_registrations r JOIN participants p ON r.participant_id = p.id WHERE r.training_id = ?",
-            (training_id,), fetchall=True
-        )
-        fee = db.get_training_fee(training_id)
-        for participant_id, telegram_id, status in participants:
-            if status in ['смогу', 'приду с другом']:
-                amount_debited = fee
-                if status == 'приду с другом':
-                    amount_debited *= 2
-                new_balance = db.calculate_balance_by_id(participant_id)
-                await bot.send_message(
-                    telegram_id,
-                    f"С вашего счета списано: {amount_debited:.2f} руб. Ваш новый баланс: {new_balance:.2f} руб."
-                )
+    debited = await db.debit_funds_for_training(training_id)
+    if debited is not None:
+        for entry in debited:
+            broadcaster.enqueue(
+                entry.telegram_id,
+                f"С вашего счета списано: {entry.amount:.2f} руб. Ваш новый баланс: {entry.balance:.2f} руб."
+            )
         await bot.answer_callback_query(callback_query.id, "Средства успешно списаны за тренировку.")
     else:
         await bot.answer_callback_query(callback_query.id, "Не удалось списать средства. Возможно, они уже списаны.")
 
+# Poll option index -> registration status, in the order of poll_options
+POLL_STATUSES = {0: 'смогу', 1: 'приду с другом', 2: 'не смогу', 3: 'не определился'}
+
 @dp.poll_answer()
 async def handle_poll_answer(poll_answer: PollAnswer):
-    print(f"Received poll answer from user {poll_answer.user.id}")
-    participant = db.get_participant(poll_answer.user.id)
-    if not participant:
-        return
-
-    user_id = poll_answer.user.id
-    poll_id = poll_answer.poll_id
-    status_index = poll_answer.option_ids[0]
-    status_mapping = {0: 'смогу', 1: 'приду с другом', 2: 'не смогу', 3: 'не определился'}
-    status_text = status_mapping.get(status_index, 'не определился')
-
-    training_id = db.get_training_id_by_poll(poll_id)
-    if training_id:
-        db.update_registration(user_id, training_id, status_text)
+    # An empty option_ids means the user retracted their vote
+    if poll_answer.option_ids:
+        status_text = POLL_STATUSES.get(poll_answer.option_ids[0], 'не определился')
+    else:
+        status_text = None
+    poll_answers.submit(poll_answer.user.id, poll_answer.poll_id, status_text)
 
 @dp.message(Command('balance'), lambda message: message.chat.type == 'private')
-async def cmd_balance(message: Message):
-    balance = db.calculate_balance(message.from_user.id)
+async def cmd_balance(message: Message, db: AsyncDatabase):
+    balance = await db.calculate_balance(message.from_user.id)
     await message.answer(f"Ваш текущий баланс: {balance:.2f} руб.")
 
+def parse_balance_report_args(text):
+    """Parse `/all_balances [debtors | below N] [by_balance]` into get_all_balances kwargs."""
+    args = text.split()[1:]
+    options = {}
+    if 'by_balance' in args:
+        options['order_by'] = 'balance'
+        args.remove('by_balance')
+    if args and args[0] == 'debtors':
+        options['below'] = 0
+    elif len(args) == 2 and args[0] == 'below':
+        options['below'] = float(args[1])
+    elif args:
+        raise ValueError(text)
+    return options
+
 @dp.message(Command('all_balances'), lambda message: message.chat.type == 'private')
-async def cmd_all_balances(message: Message):
-    if db.is_admin(message.from_user.id):
-        report = db.get_all_balances()
-        await message.answer(report)
+async def cmd_all_balances(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        try:
+            options = parse_balance_report_args(message.text)
+        except ValueError:
+            await message.answer("Формат: /all_balances [debtors | below сумма] [by_balance]")
+            return
+        report = await report_cache.get(db, 'all_balances', db.get_all_balances, **options)
+        for chunk in report or ["Нет участников, подходящих под условия."]:
+            await message.answer(chunk)
     else:
         await message.answer("Только администратор может выполнять эту команду.")
 
 @dp.message(Command('set_initial_balance'), lambda message: message.chat.type == 'private')
-async def cmd_set_initial_balance(message: Message):
-    if db.is_admin(message.from_user.id):
+async def cmd_set_initial_balance(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
         args = message.text.split(maxsplit=2)
         if len(args) < 3:
             await message.answer("Формат: /set_initial_balance UserID сумма")
@@ -379,28 +494,239 @@ async def cmd_set_initial_balance(message: Message):
         try:
             user_id = int(args[1])
             balance = float(args[2])
-            db.set_initial_balance_by_user_id(user_id, balance)
+            await db.set_initial_balance_by_user_id(user_id, balance)
             await message.answer("Начальный баланс установлен.")
         except ValueError:
             await message.answer("Укажите корректные данные.")
     else:
         await message.answer("Только администратор может выполнять эту команду.")
 
+@dp.message(Command('verify_balances'), lambda message: message.chat.type == 'private')
+async def cmd_verify_balances(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        drift = await db.verify_balances()
+        if not drift:
+            await message.answer("Расхождений не найдено.")
+            return
+        report = "\n".join(
+            f"{name} [{participant_id}]: сохранено {stored:.2f}, по журналу {expected:.2f}"
+            for participant_id, name, stored, expected in drift
+        )
+        await message.answer(f"Найдены расхождения:\n{report}\n\nДля пересчета используйте /rebuild_balances")
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
+@dp.message(Command('rebuild_balances'), lambda message: message.chat.type == 'private')
+async def cmd_rebuild_balances(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        rebuilt = await db.rebuild_balances()
+        await message.answer(f"Балансы пересчитаны для {rebuilt} участников.")
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
+@dp.message(Command('debit_until'), lambda message: message.chat.type == 'private')
+async def cmd_debit_until(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        args = message.text.split(maxsplit=1)
+        try:
+            until = datetime.strptime(args[1].strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+        except (IndexError, ValueError):
+            await message.answer("Формат: /debit_until ГГГГ-ММ-ДД")
+            return
+        debited = await db.debit_trainings_until(until)
+        if not debited:
+            await message.answer("Нет тренировок для списания.")
+            return
+
+        # One message per participant, however many trainings were debited
+        per_participant = {}
+        for entries in debited.values():
+            for entry in entries:
+                total, _ = per_participant.get(entry.telegram_id, (0, 0))
+                per_participant[entry.telegram_id] = (total + entry.amount, entry.balance)
+        for telegram_id, (total, balance) in per_participant.items():
+            broadcaster.enqueue(
+                telegram_id,
+                f"С вашего счета списано: {total:.2f} руб. Ваш новый баланс: {balance:.2f} руб."
+            )
+        await message.answer(
+            f"Средства списаны за {len(debited)} тренировок, участников: {len(per_participant)}."
+        )
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
+def parse_date_range(text):
+    """Parse `/command [from to]` into two YYYY-MM-DD dates; no arguments means all history."""
+    args = text.split()[1:]
+    if not args:
+        return '0000-01-01', datetime.now().strftime("%Y-%m-%d")
+    if len(args) != 2:
+        raise ValueError(text)
+    date_from, date_to = (datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d") for arg in args)
+    if date_from > date_to:
+        raise ValueError(text)
+    return date_from, date_to
+
+@dp.message(Command('export'), lambda message: message.chat.type == 'private')
+async def cmd_export(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        try:
+            date_from, date_to = parse_date_range(message.text)
+        except ValueError:
+            await message.answer("Формат: /export [ГГГГ-ММ-ДД ГГГГ-ММ-ДД]")
+            return
+        filename = f"ledger_{date_to}.zip" if date_from == '0000-01-01' else f"ledger_{date_from}_{date_to}.zip"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, filename)
+            counts = await asyncio.get_running_loop().run_in_executor(
+                None, write_ledger_export, db.database, path, date_from, date_to
+            )
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"Платежей: {counts['payments']}, начальных балансов: {counts['initial_balances']}, "
+                        f"отметок на тренировках: {counts['training_registrations']}, участников: {counts['balances']}"
+            )
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
+IMPORT_REJECT_REASONS = {'invalid': "не разобрана", 'not_income': "не поступление", 'unknown': "участник не найден"}
+
+@dp.message(Command('import_payments'), lambda message: message.chat.type == 'private')
+async def cmd_import_payments(message: Message, db: AsyncDatabase):
+    if not await db.is_admin(message.from_user.id):
+        await message.answer("Только администратор может выполнять эту команду.")
+        return
+    if not message.document:
+        await message.answer(
+            "Отправьте CSV-файл выписки с подписью /import_payments. Нужны столбцы «сумма» и «имя» "
+            "(или «id»), необязательно «дата»."
+        )
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'statement.csv')
+        await bot.download(message.document, destination=path)
+        index = ParticipantIndex(await db.get_all_participants())
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, read_statement, path, index)
+        except ValueError:
+            await message.answer("Не удалось прочитать выписку: нужны столбцы «сумма» и «имя» (или «id»).")
+            return
+    imported, duplicates, archived = await db.import_payments(result.payments)
+    lines = [f"Импортировано платежей: {imported}, уже были в базе: {duplicates}, пропущено строк: {len(result.rejected)}."]
+    if archived:
+        lines.append(f"Не импортировано {archived} платежей старше даты сжатия журнала: они уже в архиве.")
+    for row in result.rejected[:10]:
+        lines.append(f"Строка {row.line}: {IMPORT_REJECT_REASONS[row.reason]} ({row.value})")
+    if len(result.rejected) > 10:
+        lines.append(f"… и ещё {len(result.rejected) - 10}")
+    await message.answer("\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT])
+
+def parse_month(text):
+    """Parse `/command [YYYY-MM]` into a month, or None for all time."""
+    args = text.split()[1:]
+    if not args:
+        return None
+    if len(args) != 1:
+        raise ValueError(text)
+    return datetime.strptime(args[0], "%Y-%m").strftime("%Y-%m")
+
+async def send_stats_report(message, db, format_lines):
+    if not await db.is_admin(message.from_user.id):
+        await message.answer("Только администратор может выполнять эту команду.")
+        return
+    try:
+        month = parse_month(message.text)
+    except ValueError:
+        await message.answer(f"Формат: {message.text.split()[0]} [ГГГГ-ММ]")
+        return
+    report = await report_cache.get(db, 'stats_report', db.get_stats_report, month)
+    for chunk in chunk_lines(format_lines(report, f"за {month}" if month else "за всё время")):
+        await message.answer(chunk)
+
+@dp.message(Command('attendance'), lambda message: message.chat.type == 'private')
+async def cmd_attendance(message: Message, db: AsyncDatabase):
+    await send_stats_report(message, db, format_attendance_lines)
+
+@dp.message(Command('spending'), lambda message: message.chat.type == 'private')
+async def cmd_spending(message: Message, db: AsyncDatabase):
+    await send_stats_report(message, db, format_spending_lines)
+
+@dp.message(Command('rebuild_stats'), lambda message: message.chat.type == 'private')
+async def cmd_rebuild_stats(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        rows = await db.rebuild_stats()
+        await message.answer(f"Статистика пересчитана, записей по участникам и месяцам: {rows}.")
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
+@dp.message(Command('stats'), lambda message: message.chat.type == 'private')
+async def cmd_stats(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        cache = db.database.participants.stats()
+        shard_stats = shards.stats()
+        debit_stats = auto_debit.stats()
+        last_run = debit_stats['last_run'].strftime('%Y-%m-%d %H:%M') if debit_stats['last_run'] else 'ещё не было'
+        await message.answer(
+            f"{format_stats()}\n\n"
+            f"Кэш участников: {cache['size']} записей, попаданий {cache['hits']}, промахов {cache['misses']}\n"
+            f"Уведомления: {dict(broadcaster.stats)}, в очереди {broadcaster.queue.qsize()}\n"
+            f"Группы: {shard_stats['groups']}, открытых баз: {shard_stats['open']}, "
+            f"отчётов в кэше: {report_cache.stats()['size']}\n"
+            f"Очереди по ключам: {', '.join(f'{kind} {key}: {depth}' for (kind, key), depth in scheduler.deepest()) or 'пусто'}\n"
+            f"Автосписание: списано тренировок {debit_stats['debited']}, последний запуск {last_run}"
+        )
+    else:
+        await message.answer("Только администратор может выполнять эту команду.")
+
 @dp.message(Command('list_trainings'), lambda message: message.chat.type == 'private')
-async def cmd_list_trainings(message: Message):
-    if db.is_admin(message.from_user.id):
-        trainings = db.get_all_trainings()
-        training_list = "\n".join([
-            f"ID: {training_id}, Дата: {date}, Время: {time}, Место: {location}, Стоимость: {fee} руб."
-            for training_id, date, time, location, fee, is_funds_debited, comment in trainings
-        ])
-        await message.answer(f"Список тренировок:\n{training_list}")
+async def cmd_list_trainings(message: Message, db: AsyncDatabase):
+    if await db.is_admin(message.from_user.id):
+        page = await report_cache.get(db, 'trainings_page', db.get_trainings_page)
+        await message.answer(format_trainings_page(page), reply_markup=create_trainings_page_keyboard(page))
     else:
         await message.answer("Только администратор может выполнять эту команду.")
 
+async def run_webhook():
+    server = WebhookServer(dp, bot, secret=WEBHOOK_SECRET)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await bot.session.close()
+
 async def main():
-    # Start polling
-    await dp.start_polling(bot)
+    apply_migrations(DB_PATH, verbose=True)
+    await shards.start()
+    metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    metrics_dump = (asyncio.create_task(dump_metrics_periodically(METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL))
+                    if METRICS_DUMP_PATH else None)
+    broadcaster.start()
+    poll_answers.start()
+    auto_debit.start()
+    dp.storage.start()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await dp.storage.close()
+        await poll_answers.stop()
+        await auto_debit.stop()
+        await broadcaster.stop()
+        if metrics_dump:
+            metrics_dump.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+        shards.close()
+        main_db.close()
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if DB_TRACE_SQL:
+        logging.getLogger('database').setLevel(logging.DEBUG)
     asyncio.run(main())
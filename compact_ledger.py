@@ -0,0 +1,52 @@
+import argparse
+import os
+from datetime import datetime
+
+from database import Database, LedgerMismatch
+
+
+def archive_path_for(path_to_db):
+    root, ext = os.path.splitext(path_to_db)
+    return f"{root}.archive{ext or '.db'}"
+
+
+def iso_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def compact_ledger(path_to_db, cutoff, archive_path=None):
+    archive_path = archive_path or archive_path_for(path_to_db)
+    db = Database(path_to_db)
+    try:
+        drift = db.verify_balances()
+        if drift:
+            print(f"{path_to_db}: {len(drift)} stored balances differ from the ledger, run rebuild_balances.py first")
+            return False
+        compaction = db.compact_ledger(cutoff, archive_path)
+    except LedgerMismatch as e:
+        print(f"{path_to_db}: compaction rolled back: {e}")
+        return False
+    finally:
+        db.close()
+    print(f"{path_to_db}: moved {compaction.payments} payments and {compaction.initial_balances} initial balances "
+          f"before {cutoff} to {archive_path}; {compaction.checkpoints} checkpoints written, balances unchanged")
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move ledger rows older than a cutoff date to an archive database, keeping balances intact"
+    )
+    parser.add_argument('--cutoff', required=True, type=iso_date, help="first date (YYYY-MM-DD) kept in the hot tables")
+    parser.add_argument('--db', default=None, help="database to compact (default: DB_PATH)")
+    parser.add_argument('--archive', default=None, help="archive database (default: <db>.archive.db)")
+    parser.add_argument('--all-groups', action='store_true', help="also compact the database of every group")
+    args = parser.parse_args()
+
+    db = Database(args.db) if args.db else Database()
+    paths = [db.path_to_db]
+    if args.all_groups:
+        paths += [path for _, path, _ in db.get_group_shards() if path != db.path_to_db]
+    db.close()
+    for path in paths:
+        compact_ledger(path, args.cutoff, args.archive if path == paths[0] else None)
@@ -8,3 +8,109 @@ API_TOKEN = os.getenv("API_TOKEN")
 # Group chat ID for sending polls
 GROUP_CHAT_ID = os.getenv("GROUP_CHAT_ID")
 
+# Alternative Bot API server, e.g. a local Bot API server or the load-test stand-in
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# SQLite database file
+DB_PATH = os.getenv("DB_PATH", "group_accounting.db")
+
+# Number of read-only connections kept open next to the single writer connection
+DB_READER_POOL_SIZE = int(os.getenv("DB_READER_POOL_SIZE", "4"))
+
+# Size of the prepared statement cache kept by every connection
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "128"))
+
+# PRAGMAs applied to every connection when it is opened
+DB_PRAGMAS = {
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    # Negative cache_size is interpreted by SQLite as KiB
+    "cache_size": -int(os.getenv("DB_CACHE_SIZE_KB", "16000")),
+    "temp_store": "MEMORY",
+}
+
+# Log every SQL statement as it runs, at DEBUG level of the "database" logger (debugging only)
+DB_TRACE_SQL = os.getenv("DB_TRACE_SQL", "0") == "1"
+
+# Fraction of SQL statements timed into the db_statement_* metrics; 0 turns instrumentation off
+SQL_METRICS_SAMPLE_RATE = float(os.getenv("SQL_METRICS_SAMPLE_RATE", "0"))
+# Sampled statements slower than this are logged as slow queries
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "100"))
+
+# Metrics in Prometheus text format: served on METRICS_PORT (0 = off) and/or
+# written to METRICS_DUMP_PATH every METRICS_DUMP_INTERVAL seconds
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "60"))
+
+# Trainings shown per page of the training list
+TRAININGS_PAGE_SIZE = int(os.getenv("TRAININGS_PAGE_SIZE", "10"))
+
+# Number of participants kept in the in-memory identity cache
+PARTICIPANT_CACHE_SIZE = int(os.getenv("PARTICIPANT_CACHE_SIZE", "10000"))
+
+# Poll answers are written in batches of up to POLL_BATCH_SIZE, waiting at most POLL_BATCH_LINGER seconds
+POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", "200"))
+POLL_BATCH_LINGER = float(os.getenv("POLL_BATCH_LINGER", "0.5"))
+
+# Background notification fan-out (see notifications.py)
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "10000"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+# Messages per second: whole bot, one private chat, one group chat (Telegram allows ~30, 1 and 20/min)
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_GROUP_RATE = float(os.getenv("NOTIFY_GROUP_RATE", str(20 / 60)))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+
+# How updates are received: "polling" (getUpdates) or "webhook" (see webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Local address the webhook server listens on; a reverse proxy terminates HTTPS in front of it
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Public HTTPS URL registered with setWebhook on startup; leave empty to register it by hand
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Value Telegram must send in X-Telegram-Bot-Api-Secret-Token; required in webhook mode
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Updates processed at once, and updates allowed to wait before requests are answered with 503
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))
+
+# FSM conversations (poll creation, payments) untouched for FSM_TTL seconds are dropped;
+# the sweeper deletes them every FSM_SWEEP_INTERVAL seconds
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+# In-process read cache of FSM records: entries kept, and seconds a read is trusted.
+# Several bot processes sharing one database see each other's changes after at most FSM_CACHE_TTL.
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1"))
+
+# Every group gets its own database file in SHARD_DIR (see shards.py); the group in
+# GROUP_CHAT_ID keeps using DB_PATH, which also holds the directory of groups.
+# At most SHARD_MAX_OPEN group databases stay open, each with SHARD_READER_POOL_SIZE readers.
+SHARD_DIR = os.getenv("SHARD_DIR", "shards")
+SHARD_MAX_OPEN = int(os.getenv("SHARD_MAX_OPEN", "32"))
+SHARD_READER_POOL_SIZE = int(os.getenv("SHARD_READER_POOL_SIZE", "2"))
+
+# Updates handled at once; updates of the same user are always handled one at a time (scheduler.py)
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "32"))
+
+# Cached admin reports (report_cache.py): entries kept, seconds after a write before the most
+# recently used REPORT_CACHE_REFRESH_LIMIT stale reports are recomputed (0 = only on next view)
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))
+REPORT_CACHE_REFRESH_DELAY = float(os.getenv("REPORT_CACHE_REFRESH_DELAY", "2"))
+REPORT_CACHE_REFRESH_LIMIT = int(os.getenv("REPORT_CACHE_REFRESH_LIMIT", "8"))
+
+# Seconds between checks for commits by other processes (CLI tools, another bot) to a database
+EXTERNAL_WRITES_CHECK_INTERVAL = float(os.getenv("EXTERNAL_WRITES_CHECK_INTERVAL", "1"))
+
+# Background debits (auto_debit.py), off by default: every AUTO_DEBIT_INTERVAL seconds (0 = off)
+# trainings that started more than AUTO_DEBIT_DELAY seconds ago are debited, AUTO_DEBIT_BATCH_SIZE per
+# transaction, but only inside the quiet windows AUTO_DEBIT_WINDOWS ("HH:MM-HH:MM,...", local time;
+# empty = at any time)
+AUTO_DEBIT_INTERVAL = float(os.getenv("AUTO_DEBIT_INTERVAL", "0"))
+AUTO_DEBIT_DELAY = float(os.getenv("AUTO_DEBIT_DELAY", str(3 * 3600)))
+AUTO_DEBIT_BATCH_SIZE = int(os.getenv("AUTO_DEBIT_BATCH_SIZE", "20"))
+AUTO_DEBIT_WINDOWS = os.getenv("AUTO_DEBIT_WINDOWS", "02:00-06:00")
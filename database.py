@@ -1,93 +1,396 @@
+import logging
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from collections import namedtuple
+from queue import Queue
+
+from config import (
+    DB_PATH, DB_READER_POOL_SIZE, DB_CACHED_STATEMENTS, DB_PRAGMAS, PARTICIPANT_CACHE_SIZE,
+    TRAININGS_PAGE_SIZE, DB_TRACE_SQL, SQL_METRICS_SAMPLE_RATE, EXTERNAL_WRITES_CHECK_INTERVAL,
+)
+from participant_cache import ParticipantCache, MISSING
+from reports import TELEGRAM_MESSAGE_LIMIT, balance_report_chunks
+from sql_metrics import InstrumentedConnection
+
+log = logging.getLogger(__name__)
+
+# Poll answers that make a participant pay for a training
+STATUS_ATTENDING = 'смогу'
+STATUS_WITH_FRIEND = 'приду с другом'
+ATTENDING_STATUSES = (STATUS_ATTENDING, STATUS_WITH_FRIEND)
+
+# One participant's share of a training debit and their balance right after it
+DebitEntry = namedtuple('DebitEntry', 'participant_id telegram_id name amount balance')
+
+# Debits of one participant by the background scheduler, summed up for a single message
+DebitNotice = namedtuple('DebitNotice', 'participant_id telegram_id amount balance trainings')
+
+# One page of the training list; rows are TrainingSummary, newest first
+TrainingsPage = namedtuple('TrainingsPage', 'rows has_newer has_older')
+TrainingSummary = namedtuple(
+    'TrainingSummary',
+    'id date time location fee is_funds_debited comment attendees plus_ones total_cost'
+)
+
+# Attendance and spending of a group and of each participant, from the stats tables
+StatsTotals = namedtuple('StatsTotals', 'trainings attended plus_ones debited paid')
+ParticipantStats = namedtuple('ParticipantStats', 'participant_id name attended plus_ones debited paid')
+StatsReport = namedtuple('StatsReport', 'totals participants')
+
+# Rows moved to the archive by one compact_ledger() call, and checkpoints written
+Compaction = namedtuple('Compaction', 'payments initial_balances checkpoints')
+
+
+class LedgerMismatch(Exception):
+    """compact_ledger() would have changed a balance or lost a row; nothing was compacted."""
+
 
 class Database:
-    def __init__(self, path_to_db='group_accounting.db'):
+    # Pass every executed statement to logger(), which logs it at DEBUG; see DB_TRACE_SQL
+    trace_sql = DB_TRACE_SQL
+
+    def __init__(self, path_to_db=DB_PATH, pool_size=DB_READER_POOL_SIZE, pragmas=None):
         self.path_to_db = path_to_db
+        self.pragmas = DB_PRAGMAS if pragmas is None else pragmas
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        # Single long-lived writer; SQLite serializes writers anyway
+        self._writer = self._connect()
+        # Readers run concurrently with the writer thanks to WAL
+        self._readers = Queue()
+        for _ in range(pool_size):
+            self._readers.put(self._connect(query_only=True))
+        self._pool_size = pool_size
+        self.participants = ParticipantCache(PARTICIPANT_CACHE_SIZE)
+        # poll_id -> training_id; a poll never moves to another training
+        self._poll_trainings = {}
+        # Bumped by every committed data write; see transaction()
+        self.data_version = 0
+        self._write_listeners = []
+        # SQLite's data_version as of the last check_external_writes()
+        self.external_version = None
+        self._external_checked = float('-inf')
 
-    @property
-    def connection(self):
-        return sqlite3.connect(self.path_to_db)
+    def _connect(self, query_only=False):
+        connection = sqlite3.connect(
+            self.path_to_db,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS,
+            factory=InstrumentedConnection if SQL_METRICS_SAMPLE_RATE > 0 else sqlite3.Connection,
+        )
+        for name, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        if query_only:
+            connection.execute("PRAGMA query_only = 1")
+        if self.trace_sql:
+            connection.set_trace_callback(self.logger)
+        return connection
 
-    def execute(self, sql, parameters=(), fetchone=False, fetchall=False, commit=False):
-        connection = self.connection
-        connection.set_trace_callback(self.logger)
-        cursor = connection.cursor()
-        data = None
-        cursor.execute(sql, parameters)
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+    @contextmanager
+    def transaction(self, versioned=True):
+        """Run the enclosed statements in one write transaction on the writer connection.
+
+        Nested calls from the same thread join the outer transaction, so
+        helper methods can be composed without committing halfway. Committing
+        a versioned transaction bumps data_version and notifies the write
+        listeners; bookkeeping writes (FSM state, group directory) pass
+        versioned=False so cached reports stay valid.
+        """
+        with self._write_lock:
+            cursor = getattr(self._local, 'cursor', None)
+            if cursor is not None:
+                yield cursor
+                return
+            cursor = self._writer.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            self._local.cursor = cursor
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            else:
+                cursor.execute("COMMIT")
+                if versioned:
+                    self.data_version += 1
+                    for listener in self._write_listeners:
+                        listener(self)
+            finally:
+                self._local.cursor = None
+
+    def external_check_due(self):
+        return time.monotonic() - self._external_checked >= EXTERNAL_WRITES_CHECK_INTERVAL
 
+    def check_external_writes(self):
+        """Update external_version from SQLite's PRAGMA data_version of the writer connection.
+
+        Every write of this process goes through the writer, so the value
+        only changes when another process (a CLI tool, a second bot) commits.
+        While a write holds the writer the check is skipped instead of waiting
+        for it: no other process can commit during that write anyway. A
+        change clears the participant cache, since another process may have
+        registered someone this one has cached as unknown.
+        Returns external_version.
+        """
+        if self._write_lock.acquire(blocking=False):
+            try:
+                version = self._writer.execute("PRAGMA data_version").fetchone()[0]
+            finally:
+                self._write_lock.release()
+            self._external_checked = time.monotonic()
+            if version != self.external_version:
+                self.external_version = version
+                self.participants.invalidate()
+        return self.external_version
+
+    def add_write_listener(self, listener):
+        """Call listener(database) on the writer thread after every versioned commit."""
+        self._write_listeners.append(listener)
+
+    @contextmanager
+    def reader(self):
+        # Reads issued inside a transaction must see its uncommitted writes
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            yield cursor.connection
+            return
+        if not self._pool_size:
+            with self._write_lock:
+                yield self._writer
+            return
+        connection = self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put(connection)
+
+    def execute(self, sql, parameters=(), fetchone=False, fetchall=False, commit=False):
         if commit:
-            connection.commit()
+            with self.transaction() as cursor:
+                cursor.execute(sql, parameters)
+                return self._fetch(cursor, fetchone, fetchall)
+        with self.reader() as connection:
+            cursor = connection.execute(sql, parameters)
+            return self._fetch(cursor, fetchone, fetchall)
+
+    @staticmethod
+    def _fetch(cursor, fetchone, fetchall):
+        data = None
         if fetchone:
             data = cursor.fetchone()
         if fetchall:
             data = cursor.fetchall()
-
-        connection.close()
         return data
 
     def logger(self, statement):
-        print(f'Executing: {statement}')
+        log.debug("Executing: %s", statement)
 
     def get_participant(self, telegram_id):
+        if self.external_check_due():
+            self.check_external_writes()
+        participant = self.participants.get(telegram_id)
+        if participant is MISSING:
+            participant = self.load_participant(telegram_id)
+        return participant
+
+    def load_participant(self, telegram_id):
+        generation = self.participants.generation
         sql = "SELECT * FROM participants WHERE telegram_id = ?"
-        return self.execute(sql, (telegram_id,), fetchone=True)
+        participant = self.execute(sql, (telegram_id,), fetchone=True)
+        self.participants.put(telegram_id, participant, generation)
+        return participant
 
-    def add_participant(self, telegram_id, name):
-        sql = "INSERT INTO participants (telegram_id, name) VALUES (?, ?)"
-        self.execute(sql, (telegram_id, name), commit=True)
+    def add_participant(self, telegram_id, name, is_admin=False):
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO participants (telegram_id, name, is_admin) VALUES (?, ?, ?)",
+                (telegram_id, name, int(is_admin))
+            )
+            cursor.execute("INSERT INTO participant_balances (participant_id, balance) VALUES (?, 0)", (cursor.lastrowid,))
+        self.participants.invalidate(telegram_id)
+
+    def get_admin_telegram_ids(self):
+        if self.external_check_due():
+            self.check_external_writes()
+        admins = self.participants.get_admins()
+        if admins is None:
+            admins = self.load_admin_telegram_ids()
+        return admins
+
+    def load_admin_telegram_ids(self):
+        generation = self.participants.generation
+        rows = self.execute("SELECT telegram_id FROM participants WHERE is_admin = 1", fetchall=True)
+        admins = frozenset(telegram_id for telegram_id, in rows)
+        self.participants.put_admins(admins, generation)
+        return admins
 
     def is_admin(self, telegram_id):
-        sql = "SELECT is_admin FROM participants WHERE telegram_id = ?"
-        result = self.execute(sql, (telegram_id,), fetchone=True)
-        return result and result[0] == 1
+        return telegram_id in self.get_admin_telegram_ids()
 
     def set_admin_by_user_id(self, user_id):
         self.execute("UPDATE participants SET is_admin = 1 WHERE id = ?", (user_id,), commit=True)
+        self.participants.invalidate()
 
     def add_training(self, date, time, location, fee, comment=None):
-        connection = self.connection
-        cursor = connection.cursor()
-        if comment:
-            cursor.execute("INSERT INTO trainings (date, time, location, fee, comment) VALUES (?, ?, ?, ?, ?)", (date, time, location, fee, comment))
-        else:
-            cursor.execute("INSERT INTO trainings (date, time, location, fee) VALUES (?, ?, ?, ?)", (date, time, location, fee))
-        connection.commit()
-        training_id = cursor.lastrowid
-        self.logger(f"New training_id: {training_id}")
-        connection.close()
+        with self.transaction() as cursor:
+            if comment:
+                cursor.execute("INSERT INTO trainings (date, time, location, fee, comment) VALUES (?, ?, ?, ?, ?)", (date, time, location, fee, comment))
+            else:
+                cursor.execute("INSERT INTO trainings (date, time, location, fee) VALUES (?, ?, ?, ?)", (date, time, location, fee))
+            training_id = cursor.lastrowid
+            cursor.execute(
+                """
+                INSERT INTO monthly_stats (month, trainings) VALUES (substr(?, 1, 7), 1)
+                ON CONFLICT(month) DO UPDATE SET trainings = trainings + 1
+                """,
+                (date,)
+            )
+        log.info("New training_id: %s", training_id)
         return training_id
 
     def link_poll_to_training(self, training_id, poll_id):
         sql = "INSERT INTO training_polls (training_id, poll_id) VALUES (?, ?)"
         self.execute(sql, (training_id, poll_id), commit=True)
+        self._poll_trainings[poll_id] = training_id
 
     def get_training_id_by_poll(self, poll_id):
-        sql = "SELECT training_id FROM training_polls WHERE poll_id = ?"
-        result = self.execute(sql, (poll_id,), fetchone=True)
-        return result[0] if result else None
+        training_id = self._poll_trainings.get(poll_id)
+        if training_id is None:
+            sql = "SELECT training_id FROM training_polls WHERE poll_id = ?"
+            result = self.execute(sql, (poll_id,), fetchone=True)
+            training_id = result[0] if result else None
+            if training_id is not None:
+                self._poll_trainings[poll_id] = training_id
+        return training_id
+
+    UPSERT_REGISTRATION_SQL = """
+        INSERT INTO training_registrations (training_id, participant_id, status) VALUES (?, ?, ?)
+        ON CONFLICT(training_id, participant_id) DO UPDATE SET status = excluded.status
+    """
 
     def update_registration(self, telegram_id, training_id, status):
+        """Write one registration; returns False if the training was already debited."""
         participant_id = self.get_participant_id(telegram_id)
-        registration = self.execute(
-            "SELECT * FROM training_registrations WHERE training_id = ? AND participant_id = ?",
-            (training_id, participant_id), fetchone=True
-        )
-        if registration:
-            self.execute(
-                "UPDATE training_registrations SET status = ? WHERE id = ?",
-                (status, registration[0]), commit=True
-            )
-        else:
-            self.execute(
-                "INSERT INTO training_registrations (training_id, participant_id, status) VALUES (?, ?, ?)",
-                (training_id, participant_id, status), commit=True
+        with self.transaction() as cursor:
+            if not self._undebited_trainings(cursor, [training_id]):
+                return False
+            self._add_to_stats(cursor, self._registration_stats(cursor, [(training_id, participant_id, status)]))
+            cursor.execute(self.UPSERT_REGISTRATION_SQL, (training_id, participant_id, status))
+        return True
+
+    def apply_registrations(self, answers):
+        """Apply a batch of (telegram_id, poll_id, status) poll answers in one transaction.
+
+        A status of None means the vote was retracted and removes the
+        registration. Answers from unknown users, for unknown polls or for
+        trainings already debited are skipped; for repeated answers by the
+        same user the last one wins. Returns the number of registrations written.
+        """
+        latest = {}
+        for telegram_id, poll_id, status in answers:
+            participant_id = self.get_participant_id(telegram_id)
+            training_id = self.get_training_id_by_poll(poll_id)
+            if participant_id and training_id:
+                latest[(training_id, participant_id)] = status
+        with self.transaction() as cursor:
+            # Polls stay open after the debit; late votes would no longer match what was charged
+            undebited = self._undebited_trainings(cursor, [training_id for training_id, _ in latest])
+            changes = [(training_id, participant_id, status)
+                       for (training_id, participant_id), status in latest.items() if training_id in undebited]
+            self._add_to_stats(cursor, self._registration_stats(cursor, changes))
+            cursor.executemany(self.UPSERT_REGISTRATION_SQL, [change for change in changes if change[2] is not None])
+            cursor.executemany(
+                "DELETE FROM training_registrations WHERE training_id = ? AND participant_id = ?",
+                [(training_id, participant_id) for training_id, participant_id, status in changes if status is None]
             )
+        return len(changes)
+
+    def _undebited_trainings(self, cursor, training_ids):
+        """The ids among training_ids of trainings that exist and haven't been debited yet."""
+        training_ids = list(set(training_ids))
+        if not training_ids:
+            return set()
+        rows = cursor.execute(
+            f"SELECT id FROM trainings WHERE is_funds_debited = 0 AND id IN ({', '.join('?' * len(training_ids))})",
+            training_ids
+        )
+        return {training_id for training_id, in rows}
+
+    def _registration_stats(self, cursor, changes):
+        """Stats deltas of (training_id, participant_id, status) registration changes, read before writing them."""
+        deltas = []
+        for training_id, participant_id, status in changes:
+            row = cursor.execute(
+                """
+                SELECT substr(t.date, 1, 7), r.status FROM trainings t
+                LEFT JOIN training_registrations r ON r.training_id = t.id AND r.participant_id = ?
+                WHERE t.id = ?
+                """,
+                (participant_id, training_id)
+            ).fetchone()
+            if row is None:
+                continue
+            month, old_status = row
+            attended = (status in ATTENDING_STATUSES) - (old_status in ATTENDING_STATUSES)
+            plus_ones = (status == STATUS_WITH_FRIEND) - (old_status == STATUS_WITH_FRIEND)
+            if attended or plus_ones:
+                deltas.append((participant_id, month, attended, plus_ones, 0, 0))
+        return deltas
+
+    # Add (participant_id, month, attended, plus_ones, debited, paid) deltas to every stats table
+    STATS_UPSERT_SQL = (
+        """
+        INSERT INTO participant_monthly_stats (participant_id, month, attended, plus_ones, debited, paid)
+        VALUES (?1, ?2, ?3, ?4, ?5, ?6)
+        ON CONFLICT(participant_id, month) DO UPDATE SET
+            attended = attended + excluded.attended, plus_ones = plus_ones + excluded.plus_ones,
+            debited = debited + excluded.debited, paid = paid + excluded.paid
+        """,
+        """
+        INSERT INTO participant_stats (participant_id, attended, plus_ones, debited, paid)
+        VALUES (?1, ?3, ?4, ?5, ?6)
+        ON CONFLICT(participant_id) DO UPDATE SET
+            attended = attended + excluded.attended, plus_ones = plus_ones + excluded.plus_ones,
+            debited = debited + excluded.debited, paid = paid + excluded.paid
+        """,
+        """
+        INSERT INTO monthly_stats (month, attended, plus_ones, debited, paid)
+        VALUES (?2, ?3, ?4, ?5, ?6)
+        ON CONFLICT(month) DO UPDATE SET
+            attended = attended + excluded.attended, plus_ones = plus_ones + excluded.plus_ones,
+            debited = debited + excluded.debited, paid = paid + excluded.paid
+        """,
+    )
+
+    def _add_to_stats(self, cursor, deltas):
+        for sql in self.STATS_UPSERT_SQL:
+            cursor.executemany(sql, deltas)
+
+    def _payment_stats(self, payments):
+        # Only money received counts as paid; debits are counted per training
+        return [(participant_id, date[:7], 0, 0, 0, amount) for participant_id, amount, date in payments if amount > 0]
 
     def get_participant_id(self, telegram_id):
-        sql = "SELECT id FROM participants WHERE telegram_id = ?"
-        result = self.execute(sql, (telegram_id,), fetchone=True)
-        return result[0] if result else None
+        participant = self.get_participant(telegram_id)
+        return participant[0] if participant else None
+
+    def get_training_registrations(self, training_id):
+        sql = """
+            SELECT p.id, p.telegram_id, p.name, r.status
+            FROM training_registrations r JOIN participants p ON r.participant_id = p.id
+            WHERE r.training_id = ?
+        """
+        return self.execute(sql, (training_id,), fetchall=True)
 
     def get_training_fee(self, training_id):
         sql = "SELECT fee FROM trainings WHERE id = ?"
@@ -103,63 +406,411 @@ class Database:
         participant_id = self.get_participant_id(telegram_id)
         if participant_id:
             date = date or datetime.now().strftime('%Y-%m-%d')
-            sql = "INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)"
-            self.execute(sql, (participant_id, amount, date), commit=True)
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)",
+                    (participant_id, amount, date)
+                )
+                self._apply_to_balances(cursor, [(participant_id, amount, date)])
+                self._add_to_stats(cursor, self._payment_stats([(participant_id, amount, date)]))
             return True
         return False
 
+    def import_payments(self, payments):
+        """Insert a batch of (participant_id, amount, date) payments in one transaction.
+
+        Payments already in the ledger are skipped: for every participant,
+        date and amount (to the kopeck) only as many rows are inserted as
+        the batch has more than the ledger, so importing the same statement
+        twice adds nothing. Payments dated before the last compact_ledger()
+        cutoff are skipped too, as the rows they would duplicate are in the
+        archive. Returns (inserted, duplicates, archived).
+        """
+        with self.transaction() as cursor:
+            cutoff = cursor.execute("SELECT MAX(cutoff) FROM ledger_compactions").fetchone()[0]
+            batch = {}
+            for participant_id, amount, date in payments:
+                if cutoff is None or date >= cutoff:
+                    batch.setdefault((participant_id, round(amount, 2), date), []).append(
+                        (participant_id, amount, date)
+                    )
+            archived = len(payments) - sum(len(rows) for rows in batch.values())
+            if not batch:
+                return 0, 0, archived
+            dates = [date for _, _, date in batch]
+            existing = cursor.execute(
+                """
+                SELECT participant_id, ROUND(amount, 2), date, COUNT(*) FROM payments
+                WHERE date BETWEEN ? AND ? GROUP BY participant_id, ROUND(amount, 2), date
+                """,
+                (min(dates), max(dates))
+            )
+            counts = {(participant_id, amount, date): count for participant_id, amount, date, count in existing}
+            new = [payment for key, rows in batch.items() for payment in rows[counts.get(key, 0):]]
+            cursor.executemany("INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)", new)
+            self._apply_to_balances(cursor, new)
+            self._add_to_stats(cursor, self._payment_stats(new))
+        return len(new), len(payments) - len(new) - archived, archived
+
+    def _apply_to_balances(self, cursor, payments):
+        """Add (participant_id, amount, date) payments to participant_balances.
+
+        A payment only counts if it is not older than the latest initial balance.
+        """
+        cursor.executemany(
+            """
+            INSERT INTO participant_balances (participant_id, balance) VALUES (?, ?)
+            ON CONFLICT(participant_id) DO UPDATE SET balance = balance + excluded.balance
+            WHERE participant_balances.since IS NULL OR ? >= participant_balances.since
+            """,
+            payments
+        )
+
     def calculate_balance(self, telegram_id):
-        participant_id = self.get_participant_id(telegram_id)
-        last_initial_balance = self.execute(
-            "SELECT balance, date FROM initial_balances WHERE participant_id = ? ORDER BY date DESC LIMIT 1",
-            (participant_id,), fetchone=True
+        result = self.execute(
+            "SELECT b.balance FROM participants p JOIN participant_balances b ON b.participant_id = p.id WHERE p.telegram_id = ?",
+            (telegram_id,), fetchone=True
         )
-        if last_initial_balance:
-            initial_balance, initial_date = last_initial_balance
-            payments = self.execute(
-                "SELECT SUM(amount) FROM payments WHERE participant_id = ? AND date >= ?",
-                (participant_id, initial_date), fetchone=True
-            )[0] or 0
-            balance = initial_balance + payments
-        else:
-            payments = self.execute(
-                "SELECT SUM(amount) FROM payments WHERE participant_id = ?",
-                (participant_id,), fetchone=True
-            )[0] or 0
-            balance = payments
-        return balance
-
-    def get_all_balances(self):
-        participants = self.execute("SELECT id, name FROM participants", fetchall=True)
-        report = ""
-        for participant_id, name in participants:
-            balance = self.calculate_balance_by_id(participant_id)
-            report += f"{name}: {balance:.2f} руб.\n"
-        return report
+        return result[0] if result else 0
+
+    BALANCE_ORDERS = {
+        'name': "p.name COLLATE NOCASE, p.id",
+        'balance': "balance, p.id",
+    }
+
+    def iter_balances(self, order_by='name', below=None):
+        """Stream (participant_id, name, balance) for all participants in one query.
+
+        `below` keeps only balances strictly lower than the given amount,
+        e.g. below=0 lists debtors.
+        """
+        sql = f"""
+            SELECT p.id, p.name, COALESCE(b.balance, 0) AS balance
+            FROM participants p LEFT JOIN participant_balances b ON b.participant_id = p.id
+            WHERE ? IS NULL OR COALESCE(b.balance, 0) < ?
+            ORDER BY {self.BALANCE_ORDERS[order_by]}
+        """
+        with self.reader() as connection:
+            yield from connection.execute(sql, (below, below))
+
+    def get_all_balances(self, order_by='name', below=None, limit=TELEGRAM_MESSAGE_LIMIT):
+        """Balance report split into messages that fit into one Telegram message each."""
+        return list(balance_report_chunks(self.iter_balances(order_by, below), limit))
 
     def calculate_balance_by_id(self, participant_id):
-        last_initial_balance = self.execute(
-            "SELECT balance, date FROM initial_balances WHERE participant_id = ? ORDER BY date DESC LIMIT 1",
+        result = self.execute(
+            "SELECT balance FROM participant_balances WHERE participant_id = ?",
             (participant_id,), fetchone=True
         )
-        if last_initial_balance:
-            initial_balance, initial_date = last_initial_balance
-            payments = self.execute(
-                "SELECT SUM(amount) FROM payments WHERE participant_id = ? AND date >= ?",
-                (participant_id, initial_date), fetchone=True
-            )[0] or 0
-            balance = initial_balance + payments
-        else:
-            payments = self.execute(
-                "SELECT SUM(amount) FROM payments WHERE participant_id = ?",
-                (participant_id,), fetchone=True
-            )[0] or 0
-            balance = payments
-        return balance
+        return result[0] if result else 0
 
     def set_initial_balance_by_user_id(self, user_id, balance):
-        sql = "INSERT INTO initial_balances (participant_id, balance, date) VALUES (?, ?, date('now'))"
-        self.execute(sql, (user_id, balance), commit=True)
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO initial_balances (participant_id, balance, date) VALUES (?, ?, date('now'))",
+                (user_id, balance)
+            )
+            # Payments made on the same day still count on top of the new initial balance
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO participant_balances (participant_id, balance, since)
+                SELECT ?, ? + COALESCE(SUM(amount), 0), date('now')
+                FROM payments WHERE participant_id = ? AND date >= date('now')
+                """,
+                (user_id, balance, user_id)
+            )
+
+    # Balance of every participant recomputed from the raw ledger: the latest
+    # initial balance plus all payments dated on or after it.
+    LEDGER_BALANCES_SQL = """
+        WITH last_initial AS (
+            SELECT participant_id, balance, date FROM (
+                SELECT participant_id, balance, date,
+                       ROW_NUMBER() OVER (PARTITION BY participant_id ORDER BY date DESC, id DESC) AS rn
+                FROM initial_balances
+            ) WHERE rn = 1
+        )
+        SELECT p.id,
+               COALESCE(li.balance, 0) + COALESCE(SUM(pay.amount), 0) AS balance,
+               li.date AS since
+        FROM participants p
+        LEFT JOIN last_initial li ON li.participant_id = p.id
+        LEFT JOIN payments pay ON pay.participant_id = p.id AND (li.date IS NULL OR pay.date >= li.date)
+        GROUP BY p.id
+    """
+
+    def rebuild_balances(self):
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM participant_balances")
+            cursor.execute(
+                f"INSERT INTO participant_balances (participant_id, balance, since) {self.LEDGER_BALANCES_SQL}"
+            )
+            return cursor.rowcount
+
+    def verify_balances(self, tolerance=0.005):
+        """Return (participant_id, name, stored, expected) for every balance that drifted from the ledger."""
+        sql = f"""
+            SELECT p.id, p.name, COALESCE(b.balance, 0), ledger.balance
+            FROM ({self.LEDGER_BALANCES_SQL}) ledger
+            JOIN participants p ON p.id = ledger.id
+            LEFT JOIN participant_balances b ON b.participant_id = ledger.id
+            WHERE ABS(COALESCE(b.balance, 0) - ledger.balance) > ?
+        """
+        return self.execute(sql, (tolerance,), fetchall=True)
+
+    # Stats tables recomputed from registrations, training_debits and payments; migration 014
+    # runs them too (see migrate.BACKFILLS)
+    STATS_REBUILD_SQL = (
+        "DELETE FROM participant_monthly_stats",
+        "DELETE FROM participant_stats",
+        "DELETE FROM monthly_stats",
+        f"""
+        INSERT INTO participant_monthly_stats (participant_id, month, attended, plus_ones, debited, paid)
+        SELECT participant_id, month, SUM(attended), SUM(plus_ones), SUM(debited), SUM(paid) FROM (
+            SELECT r.participant_id, substr(t.date, 1, 7) AS month, 1 AS attended,
+                   r.status = '{STATUS_WITH_FRIEND}' AS plus_ones, 0 AS debited, 0 AS paid
+            FROM training_registrations r JOIN trainings t ON t.id = r.training_id
+            WHERE r.status IN ('{STATUS_ATTENDING}', '{STATUS_WITH_FRIEND}')
+            UNION ALL
+            SELECT d.participant_id, substr(t.date, 1, 7), 0, 0, d.amount, 0
+            FROM training_debits d JOIN trainings t ON t.id = d.training_id
+            UNION ALL
+            SELECT participant_id, substr(date, 1, 7), 0, 0, 0, amount FROM payments WHERE amount > 0
+        )
+        GROUP BY participant_id, month
+        """,
+        """
+        INSERT INTO participant_stats (participant_id, attended, plus_ones, debited, paid)
+        SELECT participant_id, SUM(attended), SUM(plus_ones), SUM(debited), SUM(paid)
+        FROM participant_monthly_stats GROUP BY participant_id
+        """,
+        """
+        INSERT INTO monthly_stats (month, trainings, attended, plus_ones, debited, paid)
+        SELECT month, SUM(trainings), SUM(attended), SUM(plus_ones), SUM(debited), SUM(paid) FROM (
+            SELECT month, 0 AS trainings, attended, plus_ones, debited, paid FROM participant_monthly_stats
+            UNION ALL
+            SELECT substr(date, 1, 7), 1, 0, 0, 0, 0 FROM trainings
+        )
+        GROUP BY month
+        """,
+    )
+
+    def rebuild_stats(self):
+        """Recompute the stats tables from registrations, training_debits and payments.
+
+        Rows moved to the archive by compact_ledger() are no longer counted,
+        so after a compaction this forgets the archived history.
+        Returns the number of participant-month rows.
+        """
+        with self.transaction() as cursor:
+            for sql in self.STATS_REBUILD_SQL:
+                cursor.execute(sql)
+            return cursor.execute("SELECT COUNT(*) FROM participant_monthly_stats").fetchone()[0]
+
+    def get_stats_report(self, month=None):
+        """Return a StatsReport for one YYYY-MM month, or for all time if month is None.
+
+        Reads only the stats tables: one row per participant, plus one per
+        month for the all-time totals.
+        """
+        if month is None:
+            totals = self.execute(
+                """
+                SELECT COALESCE(SUM(trainings), 0), COALESCE(SUM(attended), 0), COALESCE(SUM(plus_ones), 0),
+                       COALESCE(SUM(debited), 0), COALESCE(SUM(paid), 0)
+                FROM monthly_stats
+                """,
+                fetchone=True
+            )
+            rows = self.execute(
+                """
+                SELECT p.id, p.name, s.attended, s.plus_ones, s.debited, s.paid
+                FROM participant_stats s JOIN participants p ON p.id = s.participant_id
+                ORDER BY p.name COLLATE NOCASE, p.id
+                """,
+                fetchall=True
+            )
+        else:
+            totals = self.execute(
+                "SELECT trainings, attended, plus_ones, debited, paid FROM monthly_stats WHERE month = ?",
+                (month,), fetchone=True
+            ) or (0, 0, 0, 0, 0)
+            rows = self.execute(
+                """
+                SELECT p.id, p.name, s.attended, s.plus_ones, s.debited, s.paid
+                FROM participant_monthly_stats s JOIN participants p ON p.id = s.participant_id
+                WHERE s.month = ?
+                ORDER BY p.name COLLATE NOCASE, p.id
+                """,
+                (month,), fetchall=True
+            )
+        return StatsReport(StatsTotals(*totals), [ParticipantStats(*row) for row in rows])
+
+    # Tables of the archive database that compact_ledger() moves old rows into;
+    # rows keep their ids, so moving the same row twice is a no-op
+    ARCHIVE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archive.payments (
+            id INTEGER PRIMARY KEY, participant_id INTEGER NOT NULL, amount REAL NOT NULL, date TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS archive.initial_balances (
+            id INTEGER PRIMARY KEY, participant_id INTEGER NOT NULL, balance REAL NOT NULL, date TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archive.idx_archive_payments_participant_date ON payments (participant_id, date);
+    """
+
+    # Checkpoint as of the cutoff for participants with history before it and no
+    # initial balance on or after it: the last initial balance before the cutoff
+    # plus the payments between the two.
+    CHECKPOINT_SQL = """
+        INSERT INTO initial_balances (participant_id, balance, date)
+        WITH last_initial AS (
+            SELECT participant_id, balance, date FROM (
+                SELECT participant_id, balance, date,
+                       ROW_NUMBER() OVER (PARTITION BY participant_id ORDER BY date DESC, id DESC) AS rn
+                FROM initial_balances WHERE date < :cutoff
+            ) WHERE rn = 1
+        )
+        SELECT p.id, COALESCE(li.balance, 0) + COALESCE(SUM(pay.amount), 0), :cutoff
+        FROM participants p
+        LEFT JOIN last_initial li ON li.participant_id = p.id
+        LEFT JOIN payments pay ON pay.participant_id = p.id AND pay.date < :cutoff
+            AND (li.date IS NULL OR pay.date >= li.date)
+        WHERE NOT EXISTS (SELECT 1 FROM initial_balances ib WHERE ib.participant_id = p.id AND ib.date >= :cutoff)
+        GROUP BY p.id
+        HAVING li.date IS NOT NULL OR COUNT(pay.id) > 0
+    """
+
+    def compact_ledger(self, cutoff, archive_path, tolerance=0.005):
+        """Move ledger rows dated before `cutoff` into the archive database at archive_path.
+
+        Every participant with older history first gets a checkpoint initial
+        balance dated `cutoff`; then payments and initial balances dated
+        before it are copied to the archive and deleted. The ledger balance
+        of every participant is compared before and after, and any
+        difference larger than `tolerance` rolls the whole compaction back
+        with a LedgerMismatch. Returns a Compaction with the number of rows
+        moved.
+        """
+        # Payments dated today or later must keep counting on top of the checkpoint
+        if cutoff > datetime.now().strftime('%Y-%m-%d'):
+            raise ValueError("cutoff can't be in the future")
+        with self._write_lock:
+            # ATTACH isn't allowed inside a transaction
+            self._writer.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+            try:
+                self._writer.executescript(self.ARCHIVE_SCHEMA)
+                with self.transaction() as cursor:
+                    return self._compact(cursor, cutoff, archive_path, tolerance)
+            finally:
+                self._writer.execute("DETACH DATABASE archive")
+
+    def _compact(self, cursor, cutoff, archive_path, tolerance):
+        cursor.execute(f"CREATE TEMP TABLE ledger_before AS {self.LEDGER_BALANCES_SQL}")
+        try:
+            last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM initial_balances").fetchone()[0]
+            cursor.execute(self.CHECKPOINT_SQL, {'cutoff': cutoff})
+            checkpoints = cursor.rowcount
+            # Payments backdated before the checkpoint no longer count, like after any initial balance
+            cursor.execute(
+                """
+                UPDATE participant_balances SET since = :cutoff
+                WHERE participant_id IN (SELECT participant_id FROM initial_balances WHERE id > :last_id)
+                    AND (since IS NULL OR since < :cutoff)
+                """,
+                {'cutoff': cutoff, 'last_id': last_id}
+            )
+
+            moved = {}
+            # Registrations (and training_debits) stay although they grow with trainings x participants:
+            # the training list, the export and the stats rebuild read them
+            for table in ('payments', 'initial_balances'):
+                cursor.execute(f"INSERT OR IGNORE INTO archive.{table} SELECT * FROM main.{table} WHERE date < :cutoff",
+                               {'cutoff': cutoff})
+                missing = cursor.execute(
+                    f"""
+                    SELECT COUNT(*) FROM main.{table}
+                    WHERE date < :cutoff AND id NOT IN (SELECT id FROM archive.{table})
+                    """,
+                    {'cutoff': cutoff}
+                ).fetchone()[0]
+                if missing:
+                    raise LedgerMismatch(f"{missing} {table} rows were not archived")
+                cursor.execute(f"DELETE FROM main.{table} WHERE date < :cutoff", {'cutoff': cutoff})
+                moved[table] = cursor.rowcount
+
+            changed = cursor.execute(
+                f"""
+                SELECT old.id, old.balance, new.balance
+                FROM temp.ledger_before old JOIN ({self.LEDGER_BALANCES_SQL}) new ON new.id = old.id
+                WHERE ABS(old.balance - new.balance) > ?
+                """,
+                (tolerance,)
+            ).fetchall()
+            if changed:
+                raise LedgerMismatch(f"balances of {len(changed)} participants changed, e.g. {changed[:3]}")
+
+            cursor.execute(
+                """
+                INSERT INTO ledger_compactions
+                    (cutoff, archive_path, payments, initial_balances, checkpoints)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (cutoff, archive_path, moved['payments'], moved['initial_balances'], checkpoints)
+            )
+            return Compaction(moved['payments'], moved['initial_balances'], checkpoints)
+        finally:
+            cursor.execute("DROP TABLE temp.ledger_before")
+
+    def get_compactions(self):
+        sql = """
+            SELECT cutoff, archive_path, payments, initial_balances, checkpoints, compacted_at
+            FROM ledger_compactions ORDER BY id
+        """
+        return self.execute(sql, fetchall=True)
+
+    # Ledger sections of the CSV export (export.py); every query takes (date_from, date_to)
+    LEDGER_EXPORT_SQL = {
+        'payments': """
+            SELECT pay.id, pay.date, p.id, p.telegram_id, p.name, pay.amount
+            FROM payments pay JOIN participants p ON p.id = pay.participant_id
+            WHERE pay.date BETWEEN ? AND ? ORDER BY pay.date, pay.id
+        """,
+        'initial_balances': """
+            SELECT ib.id, ib.date, p.id, p.telegram_id, p.name, ib.balance
+            FROM initial_balances ib JOIN participants p ON p.id = ib.participant_id
+            WHERE ib.date BETWEEN ? AND ? ORDER BY ib.date, ib.id
+        """,
+        'training_registrations': """
+            SELECT t.id, t.date, t.time, t.location, t.fee, p.id, p.telegram_id, p.name, r.status
+            FROM trainings t
+            JOIN training_registrations r ON r.training_id = t.id
+            JOIN participants p ON p.id = r.participant_id
+            WHERE t.date BETWEEN ? AND ? ORDER BY t.date, t.id, p.name
+        """,
+        # Balance at the end of the range: the last initial balance up to date_to plus later payments
+        'balances': """
+            WITH last_initial AS (
+                SELECT participant_id, balance, date FROM (
+                    SELECT participant_id, balance, date,
+                           ROW_NUMBER() OVER (PARTITION BY participant_id ORDER BY date DESC, id DESC) AS rn
+                    FROM initial_balances WHERE date <= ?2
+                ) WHERE rn = 1
+            )
+            SELECT p.id, p.telegram_id, p.name,
+                   ROUND(COALESCE(li.balance, 0) + COALESCE(SUM(pay.amount), 0), 2)
+            FROM participants p
+            LEFT JOIN last_initial li ON li.participant_id = p.id
+            LEFT JOIN payments pay ON pay.participant_id = p.id AND pay.date <= ?2
+                AND (li.date IS NULL OR pay.date >= li.date)
+            GROUP BY p.id
+            ORDER BY p.id
+        """,
+    }
+
+    def iter_ledger(self, section, date_from, date_to):
+        """Stream the rows of one LEDGER_EXPORT_SQL section for dates in [date_from, date_to]."""
+        with self.reader() as connection:
+            yield from connection.execute(self.LEDGER_EXPORT_SQL[section], (date_from, date_to))
 
     def get_all_participants(self):
         sql = "SELECT name, id, telegram_id FROM participants"
@@ -169,24 +820,268 @@ class Database:
         sql = "SELECT id, date, time, location, fee, is_funds_debited, comment FROM trainings"
         return self.execute(sql, fetchall=True)
 
+    def get_undebited_trainings(self):
+        sql = """
+            SELECT id, date, time, location, fee, is_funds_debited, comment FROM trainings
+            WHERE is_funds_debited = 0 ORDER BY date, id
+        """
+        return self.execute(sql, fetchall=True)
+
+    def get_trainings_page(self, cursor=None, newer=False, limit=TRAININGS_PAGE_SIZE):
+        """Return a TrainingsPage of trainings with their attendees and total cost.
+
+        Pages are keyed on (date, id) of a neighbouring row: `cursor` is the
+        last row of the previous page when going to older trainings, or the
+        first row of the current page when going back to newer ones
+        (`newer=True`). Without a cursor the newest trainings are returned.
+        """
+        if cursor is None:
+            where, order = "", "date DESC, id DESC"
+            parameters = (limit + 1,)
+        elif newer:
+            where, order = "WHERE (date, id) > (?, ?)", "date, id"
+            parameters = (*cursor, limit + 1)
+        else:
+            where, order = "WHERE (date, id) < (?, ?)", "date DESC, id DESC"
+            parameters = (*cursor, limit + 1)
+        sql = f"""
+            SELECT t.id, t.date, t.time, t.location, t.fee, t.is_funds_debited, t.comment,
+                   GROUP_CONCAT(p.name || CASE r.status WHEN '{STATUS_WITH_FRIEND}' THEN ' (с другом)' ELSE '' END, ', '),
+                   COUNT(CASE r.status WHEN '{STATUS_WITH_FRIEND}' THEN 1 END),
+                   t.fee * (COUNT(r.id) + COUNT(CASE r.status WHEN '{STATUS_WITH_FRIEND}' THEN 1 END))
+            FROM (SELECT * FROM trainings {where} ORDER BY {order} LIMIT ?) t
+            LEFT JOIN training_registrations r
+                ON r.training_id = t.id AND r.status IN ('{STATUS_ATTENDING}', '{STATUS_WITH_FRIEND}')
+            LEFT JOIN participants p ON p.id = r.participant_id
+            GROUP BY t.id
+            ORDER BY t.date DESC, t.id DESC
+        """
+        rows = [TrainingSummary(*row) for row in self.execute(sql, parameters, fetchall=True)]
+        more = len(rows) > limit
+        if cursor is None:
+            return TrainingsPage(rows[:limit], False, more)
+        if newer:
+            return TrainingsPage(rows[-limit:], more, True)
+        return TrainingsPage(rows[:limit], True, more)
+
     def debit_funds_for_training(self, training_id):
-        training = self.execute("SELECT fee, is_funds_debited FROM trainings WHERE id = ?", (training_id,), fetchone=True)
-        if not training or training[1]:  # Если тренировка не найдена или средства уже списаны
-            return False
-
-        fee = training[0]
-        participants = self.execute(
-            "SELECT participant_id, status FROM training_registrations WHERE training_id = ?",
-            (training_id,), fetchall=True
+        """Debit the fee of one training from every attendee in a single transaction.
+
+        Returns a list of DebitEntry, or None if the training doesn't exist or
+        was already debited.
+        """
+        with self.transaction() as cursor:
+            debit_date = cursor.execute("SELECT date('now')").fetchone()[0]
+            return self._debit_training(cursor, training_id, debit_date)
+
+    def debit_trainings_until(self, date):
+        """Debit every not yet debited training dated on or before `date` in one pass.
+
+        Returns {training_id: [DebitEntry, ...]} for the trainings debited.
+        """
+        with self.transaction() as cursor:
+            debit_date = cursor.execute("SELECT date('now')").fetchone()[0]
+            training_ids = [row[0] for row in cursor.execute(
+                "SELECT id FROM trainings WHERE is_funds_debited = 0 AND date <= ? ORDER BY date, id", (date,)
+            ).fetchall()]
+            return {
+                training_id: self._debit_training(cursor, training_id, debit_date)
+                for training_id in training_ids
+            }
+
+    def debit_trainings_with_notices(self, training_ids):
+        """Debit the given trainings in one transaction and queue coalesced debit_notices.
+
+        Every attendee's notice accumulates the amounts of all trainings
+        debited for them until acknowledge_debit_notices() clears it, and
+        keeps the balance after the latest one. Returns the ids of the trainings that
+        were actually debited; already debited ones are skipped.
+        """
+        debited = []
+        with self.transaction() as cursor:
+            debit_date = cursor.execute("SELECT date('now')").fetchone()[0]
+            for training_id in training_ids:
+                entries = self._debit_training(cursor, training_id, debit_date)
+                if entries is None:
+                    continue
+                debited.append(training_id)
+                cursor.executemany(
+                    """
+                    INSERT INTO debit_notices (participant_id, amount, balance, trainings) VALUES (?, ?, ?, 1)
+                    ON CONFLICT(participant_id) DO UPDATE SET
+                        amount = amount + excluded.amount, balance = excluded.balance, trainings = trainings + 1
+                    """,
+                    [(entry.participant_id, entry.amount, entry.balance) for entry in entries]
+                )
+        return debited
+
+    def get_debit_notices(self, limit):
+        """Return up to `limit` DebitNotice rows of debit_notices, in participant order."""
+        sql = """
+            SELECT n.participant_id, p.telegram_id, n.amount, n.balance, n.trainings
+            FROM debit_notices n JOIN participants p ON p.id = n.participant_id
+            ORDER BY n.participant_id LIMIT ?
+        """
+        return [DebitNotice(*row) for row in self.execute(sql, (limit,), fetchall=True)]
+
+    def acknowledge_debit_notices(self, notices):
+        """Remove sent DebitNotice rows from debit_notices.
+
+        Only the amount and trainings that were sent are taken off, so debits
+        added to a notice while it was being sent stay for the next message.
+        """
+        with self.transaction(versioned=False) as cursor:
+            cursor.executemany(
+                "UPDATE debit_notices SET amount = amount - ?, trainings = trainings - ? WHERE participant_id = ?",
+                [(amount, trainings, participant_id) for participant_id, _, amount, _, trainings in notices]
+            )
+            cursor.executemany(
+                "DELETE FROM debit_notices WHERE participant_id = ? AND trainings <= 0",
+                [(participant_id,) for participant_id, *_ in notices]
+            )
+
+    def _debit_training(self, cursor, training_id, debit_date):
+        # Flipping the flag first guards against debiting the same training twice:
+        # only the transaction that actually changed it goes on to insert payments.
+        cursor.execute("UPDATE trainings SET is_funds_debited = 1 WHERE id = ? AND is_funds_debited = 0", (training_id,))
+        if cursor.rowcount == 0:
+            return None
+
+        attendees = cursor.execute(
+            f"""
+            SELECT p.id, p.telegram_id, p.name, t.fee * CASE r.status WHEN '{STATUS_WITH_FRIEND}' THEN 2 ELSE 1 END
+            FROM training_registrations r
+            JOIN trainings t ON t.id = r.training_id
+            JOIN participants p ON p.id = r.participant_id
+            WHERE r.training_id = ? AND r.status IN ('{STATUS_ATTENDING}', '{STATUS_WITH_FRIEND}')
+            """,
+            (training_id,)
+        ).fetchall()
+        payments = [(participant_id, -amount, debit_date) for participant_id, _, _, amount in attendees]
+        cursor.executemany("INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, ?)", payments)
+        cursor.executemany(
+            "INSERT INTO training_debits (training_id, participant_id, amount) VALUES (?, ?, ?)",
+            [(training_id, participant_id, amount) for participant_id, _, _, amount in attendees]
         )
+        self._apply_to_balances(cursor, payments)
+        month = cursor.execute("SELECT substr(date, 1, 7) FROM trainings WHERE id = ?", (training_id,)).fetchone()[0]
+        self._add_to_stats(cursor, [(participant_id, month, 0, 0, amount, 0) for participant_id, _, _, amount in attendees])
+
+        balances = dict(cursor.execute(
+            f"""
+            SELECT b.participant_id, b.balance FROM participant_balances b
+            JOIN training_registrations r ON r.participant_id = b.participant_id
+            WHERE r.training_id = ? AND r.status IN ('{STATUS_ATTENDING}', '{STATUS_WITH_FRIEND}')
+            """,
+            (training_id,)
+        ).fetchall())
+        return [
+            DebitEntry(participant_id, telegram_id, name, amount, balances.get(participant_id, 0))
+            for participant_id, telegram_id, name, amount in attendees
+        ]
+
+    def get_fsm_record(self, key, now):
+        """Return (state, data) stored for an FSM key, or None if absent or expired."""
+        sql = "SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?"
+        return self.execute(sql, (key, now), fetchone=True)
+
+    def set_fsm_state(self, key, state, expires_at):
+        self._set_fsm_field(key, 'state', state, expires_at)
+
+    def set_fsm_data(self, key, data, expires_at):
+        self._set_fsm_field(key, 'data', data, expires_at)
+
+    def _set_fsm_field(self, key, column, value, expires_at):
+        # Only the given column is written, so processes sharing the table
+        # don't overwrite each other's state with data or vice versa
+        with self.transaction(versioned=False) as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO fsm_states (key, {column}, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, expires_at = excluded.expires_at
+                """,
+                (key, value, expires_at)
+            )
+            cursor.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
 
-        for participant_id, status in participants:
-            if status in ['смогу', 'приду с другом']:
-                amount_to_deduct = fee * (2 if status == 'приду с другом' else 1)
-                self.execute(
-                    "INSERT INTO payments (participant_id, amount, date) VALUES (?, ?, date('now'))",
-                    (participant_id, -amount_to_deduct), commit=True
+    def delete_expired_fsm_records(self, now):
+        """Delete conversations nobody touched before their TTL ran out; returns how many."""
+        with self.transaction(versioned=False) as cursor:
+            cursor.execute("DELETE FROM fsm_states WHERE expires_at <= ?", (now,))
+            return cursor.rowcount
+
+    def register_group(self, chat_id, path, title=None, adopt_existing=False):
+        """Add a group to the shard directory; returns False if it was already there.
+
+        With adopt_existing the participants and polls already stored in this
+        database become members and polls of the group, which is how the
+        original single-group database turns into the default group's shard.
+        """
+        with self.transaction(versioned=False) as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO group_shards (chat_id, path, title) VALUES (?, ?, ?)", (chat_id, path, title)
+            )
+            if cursor.rowcount == 0:
+                return False
+            if adopt_existing:
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO group_members (telegram_id, chat_id, is_current)
+                    SELECT telegram_id, ?, NOT EXISTS (
+                        SELECT 1 FROM group_members m WHERE m.telegram_id = participants.telegram_id AND m.is_current = 1
+                    ) FROM participants
+                    """,
+                    (chat_id,)
                 )
+                cursor.execute(
+                    "INSERT OR IGNORE INTO group_polls (poll_id, chat_id) SELECT poll_id, ? FROM training_polls",
+                    (chat_id,)
+                )
+            return True
 
-        self.execute("UPDATE trainings SET is_funds_debited = 1 WHERE id = ?", (training_id,), commit=True)
-        return True
+    def get_group_shards(self):
+        return self.execute("SELECT chat_id, path, title FROM group_shards", fetchall=True)
+
+    def add_group_member(self, telegram_id, chat_id):
+        """Record that the user belongs to the group and make it their current one."""
+        with self.transaction(versioned=False) as cursor:
+            cursor.execute("UPDATE group_members SET is_current = 0 WHERE telegram_id = ? AND is_current = 1", (telegram_id,))
+            cursor.execute(
+                """
+                INSERT INTO group_members (telegram_id, chat_id, is_current) VALUES (?, ?, 1)
+                ON CONFLICT(telegram_id, chat_id) DO UPDATE SET is_current = 1
+                """,
+                (telegram_id, chat_id)
+            )
+
+    def set_current_group(self, telegram_id, chat_id):
+        """Switch the user's current group; returns False if they aren't a member of it."""
+        with self.transaction(versioned=False) as cursor:
+            member = cursor.execute(
+                "SELECT 1 FROM group_members WHERE telegram_id = ? AND chat_id = ?", (telegram_id, chat_id)
+            ).fetchone()
+            if not member:
+                return False
+            self.add_group_member(telegram_id, chat_id)
+            return True
+
+    def get_current_group(self, telegram_id):
+        sql = "SELECT chat_id FROM group_members WHERE telegram_id = ? AND is_current = 1"
+        result = self.execute(sql, (telegram_id,), fetchone=True)
+        return result[0] if result else None
+
+    def get_member_groups(self, telegram_id):
+        sql = """
+            SELECT m.chat_id, g.title, m.is_current FROM group_members m
+            JOIN group_shards g ON g.chat_id = m.chat_id
+            WHERE m.telegram_id = ? ORDER BY g.title
+        """
+        return self.execute(sql, (telegram_id,), fetchall=True)
+
+    def link_poll_to_group(self, poll_id, chat_id):
+        with self.transaction(versioned=False) as cursor:
+            cursor.execute("INSERT OR IGNORE INTO group_polls (poll_id, chat_id) VALUES (?, ?)", (poll_id, chat_id))
+
+    def get_group_by_poll(self, poll_id):
+        result = self.execute("SELECT chat_id FROM group_polls WHERE poll_id = ?", (poll_id,), fetchone=True)
+        return result[0] if result else None
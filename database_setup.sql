@@ -15,6 +15,10 @@ CREATE TABLE IF NOT EXISTS trainings (
     is_funds_debited BOOLEAN DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS idx_trainings_date ON trainings (date);
+
+CREATE INDEX IF NOT EXISTS idx_trainings_undebited ON trainings (date) WHERE is_funds_debited = 0;
+
 CREATE TABLE IF NOT EXISTS training_registrations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     training_id INTEGER NOT NULL,
@@ -24,6 +28,9 @@ CREATE TABLE IF NOT EXISTS training_registrations (
     FOREIGN KEY (participant_id) REFERENCES participants(id)
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS idx_training_registrations_training_participant
+    ON training_registrations (training_id, participant_id);
+
 CREATE TABLE IF NOT EXISTS payments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     participant_id INTEGER NOT NULL,
@@ -32,6 +39,9 @@ CREATE TABLE IF NOT EXISTS payments (
     FOREIGN KEY (participant_id) REFERENCES participants(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_payments_participant_date ON payments (participant_id, date);
+CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (date);
+
 CREATE TABLE IF NOT EXISTS initial_balances (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     participant_id INTEGER NOT NULL,
@@ -40,8 +50,115 @@ CREATE TABLE IF NOT EXISTS initial_balances (
     FOREIGN KEY (participant_id) REFERENCES participants(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_initial_balances_participant_date ON initial_balances (participant_id, date);
+CREATE INDEX IF NOT EXISTS idx_initial_balances_date ON initial_balances (date);
+
 CREATE TABLE IF NOT EXISTS training_polls (
     training_id INTEGER,
     poll_id TEXT UNIQUE,
     FOREIGN KEY (training_id) REFERENCES trainings(id)
 );
+
+-- Running balance per participant, maintained together with every ledger write
+CREATE TABLE IF NOT EXISTS participant_balances (
+    participant_id INTEGER PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    since TEXT,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
+
+-- Conversation state of the FSM storage (fsm_storage.py); rows past expires_at are swept
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at);
+
+-- Directory of groups served by the bot (shards.py); kept in the main database only
+CREATE TABLE IF NOT EXISTS group_shards (
+    chat_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    title TEXT
+);
+
+-- Groups each user belongs to; private-chat commands act on the user's current group
+CREATE TABLE IF NOT EXISTS group_members (
+    telegram_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    is_current INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (telegram_id, chat_id)
+) WITHOUT ROWID;
+
+-- Poll answers don't say which chat the poll was posted to
+CREATE TABLE IF NOT EXISTS group_polls (
+    poll_id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Every compaction of the ledger (Database.compact_ledger): rows dated before cutoff were moved to archive_path
+CREATE TABLE IF NOT EXISTS ledger_compactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cutoff TEXT NOT NULL,
+    archive_path TEXT NOT NULL,
+    payments INTEGER NOT NULL,
+    initial_balances INTEGER NOT NULL,
+    checkpoints INTEGER NOT NULL,
+    compacted_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+-- Debit notifications of the background scheduler (auto_debit.py) not yet handed to the
+-- broadcaster, one coalesced row per participant, written in the debit's transaction
+CREATE TABLE IF NOT EXISTS debit_notices (
+    participant_id INTEGER PRIMARY KEY,
+    amount REAL NOT NULL,
+    balance REAL NOT NULL,
+    trainings INTEGER NOT NULL,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
+
+-- Attendance and spending summaries, kept up to date by every registration, training,
+-- debit and payment (see Database._add_to_stats). Months are YYYY-MM: attendance and
+-- debits count in the month of the training, payments in the month they were made.
+CREATE TABLE IF NOT EXISTS participant_monthly_stats (
+    participant_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (participant_id, month)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_participant_monthly_stats_month ON participant_monthly_stats (month);
+
+CREATE TABLE IF NOT EXISTS participant_stats (
+    participant_id INTEGER PRIMARY KEY,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
+
+CREATE TABLE IF NOT EXISTS monthly_stats (
+    month TEXT PRIMARY KEY,
+    trainings INTEGER NOT NULL DEFAULT 0,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- What every debited training charged each attendee, written in the debit's transaction
+-- (see Database._debit_training); the stats count debits from here
+CREATE TABLE IF NOT EXISTS training_debits (
+    training_id INTEGER NOT NULL,
+    participant_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (training_id, participant_id),
+    FOREIGN KEY (training_id) REFERENCES trainings(id),
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+) WITHOUT ROWID;
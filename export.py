@@ -0,0 +1,49 @@
+import csv
+import io
+import zipfile
+
+# CSV header of every ledger section, in the column order of Database.LEDGER_EXPORT_SQL
+LEDGER_COLUMNS = {
+    'payments': ('payment_id', 'date', 'participant_id', 'telegram_id', 'name', 'amount'),
+    'initial_balances': ('initial_balance_id', 'date', 'participant_id', 'telegram_id', 'name', 'balance'),
+    'training_registrations': ('training_id', 'date', 'time', 'location', 'fee',
+                               'participant_id', 'telegram_id', 'name', 'status'),
+    'balances': ('participant_id', 'telegram_id', 'name', 'balance'),
+}
+
+# Rows handed to the csv writer at a time; the text buffer below flushes into the zip entry
+ROWS_PER_WRITE = 500
+BUFFER_SIZE = 64 * 1024
+
+
+def batched(rows, size=ROWS_PER_WRITE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_ledger_export(database, path, date_from, date_to):
+    """Write the ledger between two dates to a zip file with one CSV per section.
+
+    Rows stream from the database cursor through the csv writer straight
+    into the compressed zip entry, so memory use doesn't depend on the size
+    of the ledger. Returns {section: number of rows}.
+    """
+    counts = {}
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for section, columns in LEDGER_COLUMNS.items():
+            counts[section] = 0
+            entry = archive.open(f"{section}.csv", 'w', force_zip64=True)
+            # utf-8-sig so spreadsheet programs detect the encoding of Cyrillic names
+            with io.TextIOWrapper(io.BufferedWriter(entry, BUFFER_SIZE), encoding='utf-8-sig', newline='') as text:
+                writer = csv.writer(text)
+                writer.writerow(columns)
+                for batch in batched(database.iter_ledger(section, date_from, date_to)):
+                    writer.writerows(batch)
+                    counts[section] += len(batch)
+    return counts
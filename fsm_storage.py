@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from config import FSM_TTL, FSM_SWEEP_INTERVAL, FSM_CACHE_SIZE, FSM_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage kept in the fsm_states table of the bot's database.
+
+    State is stored as its name and data as compact JSON, one row per
+    chat/user key. Every write pushes the row's expiry FSM_TTL seconds
+    ahead; expired rows read as empty and are deleted by a background
+    sweeper started with start(). Reads are served from a small LRU cache
+    for up to `cache_ttl` seconds, and this process's own writes update it.
+    """
+
+    def __init__(self, db, ttl=FSM_TTL, sweep_interval=FSM_SWEEP_INTERVAL,
+                 cache_size=FSM_CACHE_SIZE, cache_ttl=FSM_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> (state, data JSON, time read)
+        self._cache = OrderedDict()
+        # Bumped by every write, so a read that raced with one isn't cached
+        self._generation = 0
+        self._sweeper = None
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                deleted = await self.db.delete_expired_fsm_records(time.time())
+                if deleted:
+                    logger.info("Expired %d abandoned FSM conversations", deleted)
+            except Exception:
+                logger.exception("Failed to sweep expired FSM conversations")
+
+    async def _load(self, key):
+        now = time.time()
+        cached = self._cache.get(key)
+        if cached is not None and now - cached[2] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            return cached
+        generation = self._generation
+        record = await self.db.get_fsm_record(key, now)
+        state, data = record if record else (None, None)
+        if generation != self._generation:
+            return state, data, now
+        return self._remember(key, state, data, now)
+
+    def _remember(self, key, state, data, now):
+        entry = (state, data, now)
+        if self.cache_size and self.cache_ttl > 0:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        self._generation += 1
+        await self.db.set_fsm_state(key, state, time.time() + self.ttl)
+        # Only a cached entry knows the other half of the row; otherwise it is read on next use
+        cached = self._cache.pop(key, None)
+        if cached:
+            self._remember(key, state, cached[1], cached[2])
+
+    async def get_state(self, key):
+        state, _, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        data = json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None
+        self._generation += 1
+        await self.db.set_fsm_data(key, data, time.time() + self.ttl)
+        cached = self._cache.pop(key, None)
+        if cached:
+            self._remember(key, cached[0], data, cached[2])
+
+    async def get_data(self, key):
+        _, data, _ = await self._load(self.key_builder.build(key))
+        return json.loads(data) if data else {}
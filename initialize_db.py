@@ -1,7 +1,10 @@
 import sqlite3
 
+from config import DB_PATH
+from migrate import apply_migrations
+
 def initialize_db():
-    conn = sqlite3.connect('group_accounting.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     with open('database_setup.sql', 'r', encoding='utf-8') as f:
@@ -11,6 +14,9 @@ def initialize_db():
     conn.commit()
     conn.close()
 
+    # database_setup.sql is the current schema; this only records the
+    # migrations as applied (and runs any that add data)
+    apply_migrations(DB_PATH)
+
 if __name__ == '__main__':
     initialize_db()
-
@@ -0,0 +1,159 @@
+"""Local stand-in for the Telegram Bot API.
+
+Serves /bot<token>/<method> for the calls the bot makes. Updates pushed
+with push_update() are handed out through getUpdates (long polling), and
+every outgoing call is recorded and reported to waiters, so a driver can
+measure the time from an update to the bot's reply.
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Load test bot', 'username': 'loadtest_bot'}
+
+
+class FakeTelegramAPI:
+    def __init__(self):
+        self.updates = []
+        self.calls = []
+        self.polls = []
+        # file_id -> bytes served to getFile / file downloads
+        self.files = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._poll_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        # chat_id -> [(future, methods)] waiting for the bot to reply in that chat
+        self._waiters = {}
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.app.router.add_get('/file/bot{token}/{path}', self.download)
+        self._runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start serving; returns the base URL to put into TELEGRAM_API_URL."""
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def push_update(self, update):
+        """Queue an update for getUpdates, assigning its update_id."""
+        update = dict(update, update_id=next(self._update_ids))
+        self.updates.append(update)
+        self._new_updates.set()
+        return update
+
+    def expect_reply(self, chat_id, methods=('sendMessage',)):
+        """Future resolved with the time of the next matching call the bot makes for chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((future, methods))
+        return future
+
+    def add_file(self, file_id, content):
+        """Make content downloadable by the bot as a document with this file_id."""
+        self.files[file_id] = content
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_name': f"{file_id}.csv",
+                'file_size': len(content)}
+
+    async def download(self, request):
+        content = self.files.get(request.match_info['path'])
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        # Confirmed updates are dropped, as Telegram does
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit') or 100)]
+
+    def _message(self, chat_id, **fields):
+        chat_id = int(chat_id)
+        chat = {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'}
+        if chat_id < 0:
+            chat['title'] = 'Load test group'
+        return {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': chat, 'from': BOT_USER, **fields}
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            return self._message(params.get('chat_id') or 0, text=params.get('text', ''))
+        if method == 'sendPoll':
+            options = json.loads(params['options'])
+            poll = {
+                'id': f"poll-{next(self._poll_ids)}",
+                'question': params['question'],
+                'options': [{'text': option if isinstance(option, str) else option['text'], 'voter_count': 0,
+                             'persistent_id': str(index)}
+                            for index, option in enumerate(options)],
+                'total_voter_count': 0,
+                'is_closed': False,
+                'is_anonymous': False,
+                'type': 'regular',
+                'allows_multiple_answers': False,
+                'allows_revoting': True,
+                'members_only': False,
+            }
+            self.polls.append(poll['id'])
+            return self._message(params['chat_id'], poll=poll)
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_path': file_id,
+                    'file_size': len(self.files.get(file_id, b''))}
+        if method == 'getChatMember':
+            # Everyone owns every chat, so any user can /add_group
+            user_id = int(params['user_id'])
+            return {'status': 'creator', 'is_anonymous': False,
+                    'user': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}}
+        if method == 'sendDocument':
+            return self._message(params['chat_id'], document={'file_id': 'file', 'file_unique_id': 'file'})
+        return True
+
+    def _notify(self, method, params):
+        chat_id = params.get('chat_id')
+        if method == 'answerCallbackQuery':
+            chat_id = params.get('_chat_id')
+        if chat_id is None:
+            return
+        waiters = self._waiters.get(int(chat_id))
+        if not waiters:
+            return
+        for index, (future, methods) in enumerate(waiters):
+            if method in methods and not future.done():
+                future.set_result(time.perf_counter())
+                del waiters[index]
+                return
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = {key: value if isinstance(value, str) else value.filename
+                      for key, value in (await request.post()).items()}
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+        if method == 'answerCallbackQuery':
+            # The reply goes to whoever pressed the button; recover them from the query id
+            params['_chat_id'] = params['callback_query_id'].split(':', 1)[0]
+        self.calls.append((time.perf_counter(), method, params))
+        self._notify(method, params)
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
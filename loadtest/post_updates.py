@@ -0,0 +1,89 @@
+"""POST recorded updates to a bot running in webhook mode.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=s3cret python bot.py
+    python -m loadtest.post_updates updates.jsonl --secret s3cret --rate 100
+
+The file holds one Update JSON object per line, as Telegram sends them
+(e.g. saved from getUpdates); missing update_id fields are filled in.
+Without a file, --synthetic N posts /start and /balance for N users.
+Reports acknowledgement latency, i.e. how fast the endpoint answers,
+not how long the bot takes to process the update.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import time
+
+import aiohttp
+
+from loadtest.run import message_update, summarize
+from webhook import SECRET_HEADER
+
+
+def read_updates(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_updates(users, first_user_id=1000):
+    return [message_update(first_user_id + i, text)
+            for text in ('/start', '/balance') for i in range(users)]
+
+
+async def post_all(url, updates, secret, rate):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses = collections.Counter()
+    latencies = []
+    update_ids = itertools.count(1)
+
+    async def post(session, update):
+        update.setdefault('update_id', next(update_ids))
+        started = time.perf_counter()
+        async with session.post(url, json=update, headers=headers) as response:
+            await response.read()
+        latencies.append(time.perf_counter() - started)
+        statuses[response.status] += 1
+
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        started = time.perf_counter()
+        for index, update in enumerate(updates):
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(session, update)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    report = summarize(latencies)
+    report['throughput'] = len(updates) / elapsed
+    report['statuses'] = dict(statuses)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay updates against the webhook endpoint")
+    parser.add_argument('file', nargs='?', help="JSON lines file with one update per line")
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N',
+                        help="post /start and /balance for N users instead of a file")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', help="value for the secret token header")
+    parser.add_argument('--rate', type=float, default=100, help="updates per second")
+    args = parser.parse_args()
+    if args.file:
+        updates = read_updates(args.file)
+    elif args.synthetic:
+        updates = synthetic_updates(args.synthetic)
+    else:
+        parser.error("give a file of updates or --synthetic N")
+    report = asyncio.run(post_all(args.url, updates, args.secret, args.rate))
+    print(json.dumps(report, indent=2))
+    if any(status != 200 for status in report['statuses']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""End-to-end load test of bot.py against the local fake Bot API, fully offline.
+
+    python -m loadtest.run --participants 300 --answer-rate 200 --balance-rate 50
+
+Phases: participants register with /start, an admin creates a training
+poll, everyone answers it while /balance requests arrive concurrently,
+some participants report payments, and the admin debits the training.
+Latency is measured from pushing an update to the bot's reply reaching
+the fake API.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from loadtest.fake_api import FakeTelegramAPI, BOT_USER
+
+ADMIN_ID = 10
+GROUP_CHAT_ID = -100
+FIRST_PARTICIPANT_ID = 1000
+REPLY_TIMEOUT = 60
+
+_message_ids = itertools.count(1)
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+
+
+def private_chat(user_id):
+    return {'id': user_id, 'type': 'private', 'first_name': f"User {user_id}"}
+
+
+def message_update(user_id, text):
+    return {'message': {
+        'message_id': next(_message_ids), 'date': int(time.time()),
+        'chat': private_chat(user_id), 'from': user(user_id), 'text': text,
+    }}
+
+
+def callback_update(user_id, data):
+    return {'callback_query': {
+        # The fake API maps answerCallbackQuery back to the user through this prefix
+        'id': f"{user_id}:{next(_message_ids)}", 'from': user(user_id), 'chat_instance': 'loadtest', 'data': data,
+        'message': {'message_id': next(_message_ids), 'date': int(time.time()),
+                    'chat': private_chat(user_id), 'from': BOT_USER, 'text': "menu"},
+    }}
+
+
+def poll_answer_update(user_id, poll_id, option):
+    return {'poll_answer': {'poll_id': poll_id, 'user': user(user_id), 'option_ids': [option],
+                            'option_persistent_ids': [str(option)]}}
+
+
+class Driver:
+    def __init__(self, api):
+        self.api = api
+        self.latencies = {}
+
+    async def request(self, phase, update, chat_id, methods=('sendMessage',)):
+        """Push an update and wait for the bot's reply in chat_id; records the latency under phase."""
+        reply = self.api.expect_reply(chat_id, methods)
+        started = time.perf_counter()
+        self.api.push_update(update)
+        finished = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        self.latencies.setdefault(phase, []).append(finished - started)
+
+    async def paced(self, factories, rate):
+        """Start the coroutine factories at `rate` per second and wait for all of them."""
+        tasks = []
+        started = time.perf_counter()
+        for index, factory in enumerate(factories):
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(factory()))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        'count': len(samples),
+        'p50_ms': pick(0.5) * 1000,
+        'p95_ms': pick(0.95) * 1000,
+        'p99_ms': pick(0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+        'mean_ms': statistics.fmean(samples) * 1000,
+    }
+
+
+def prepare_database(path):
+    connection = sqlite3.connect(path)
+    with open('database_setup.sql', 'r', encoding='utf-8') as f:
+        connection.executescript(f.read())
+    connection.execute("INSERT INTO participants (telegram_id, name, is_admin) VALUES (?, 'Admin', 1)", (ADMIN_ID,))
+    connection.execute("INSERT INTO participant_balances (participant_id, balance) VALUES (last_insert_rowid(), 0)")
+    connection.commit()
+    connection.close()
+
+
+async def wait_for_poll_link(path, poll_id, timeout=REPLY_TIMEOUT):
+    """The bot links the poll to its training only after sendPoll returns."""
+    connection = sqlite3.connect(path)
+    deadline = time.perf_counter() + timeout
+    try:
+        while time.perf_counter() < deadline:
+            row = connection.execute("SELECT training_id FROM training_polls WHERE poll_id = ?", (poll_id,)).fetchone()
+            if row:
+                return row[0]
+            await asyncio.sleep(0.01)
+        raise TimeoutError(f"poll {poll_id} was never linked to a training")
+    finally:
+        connection.close()
+
+
+async def wait_for_registrations(path, training_id, expected, timeout=REPLY_TIMEOUT):
+    connection = sqlite3.connect(path)
+    deadline = time.perf_counter() + timeout
+    try:
+        while time.perf_counter() < deadline:
+            count = connection.execute(
+                "SELECT COUNT(*) FROM training_registrations WHERE training_id = ?", (training_id,)
+            ).fetchone()[0]
+            if count >= expected:
+                return
+            await asyncio.sleep(0.01)
+        raise TimeoutError(f"only {count} of {expected} poll answers were stored")
+    finally:
+        connection.close()
+
+
+async def scenario(driver, db_path, args):
+    participants = [FIRST_PARTICIPANT_ID + i for i in range(args.participants)]
+    report = {}
+
+    elapsed = await driver.paced(
+        [lambda uid=uid: driver.request('start', message_update(uid, '/start'), uid) for uid in participants],
+        args.request_rate
+    )
+    report['start'] = {'throughput': len(participants) / elapsed}
+
+    # Admin walks through poll creation; the last step posts the poll to the group
+    steps = [callback_update(ADMIN_ID, 'create_poll')] + [
+        message_update(ADMIN_ID, text) for text in ('2030-01-15', '19:00', 'Зал', '500')
+    ]
+    for update in steps:
+        await driver.request('create_poll', update, ADMIN_ID)
+    await driver.request('create_poll', message_update(ADMIN_ID, '-'), GROUP_CHAT_ID, ('sendPoll',))
+    poll_id = driver.api.polls[-1]
+    training_id = await wait_for_poll_link(db_path, poll_id)
+
+    # Burst of poll answers with /balance requests running alongside
+    async def answers():
+        started = time.perf_counter()
+        for index, uid in enumerate(participants):
+            delay = started + index / args.answer_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            driver.api.push_update(poll_answer_update(uid, poll_id, index % 4))
+        await wait_for_registrations(db_path, training_id, len(participants))
+        return time.perf_counter() - started
+
+    balance_users = participants[:args.balance_requests]
+    answers_elapsed, _ = await asyncio.gather(
+        answers(),
+        driver.paced(
+            [lambda uid=uid: driver.request('balance', message_update(uid, '/balance'), uid) for uid in balance_users],
+            args.balance_rate
+        ),
+    )
+    report['poll_answers'] = {'count': len(participants), 'seconds': answers_elapsed,
+                              'throughput': len(participants) / answers_elapsed}
+
+    payers = participants[:args.payments]
+
+    async def pay(uid):
+        await driver.request('pay_prompt', callback_update(uid, 'pay'), uid)
+        await driver.request('payment', message_update(uid, '1000'), uid)
+
+    elapsed = await driver.paced([lambda uid=uid: pay(uid) for uid in payers], args.request_rate)
+    report['payment'] = {'throughput': len(payers) / elapsed}
+
+    await driver.request('debit', callback_update(ADMIN_ID, f'debit_{training_id}'), ADMIN_ID, ('answerCallbackQuery',))
+
+    for phase, samples in driver.latencies.items():
+        report.setdefault(phase, {}).update(summarize(samples))
+    return report
+
+
+async def main(args):
+    api = FakeTelegramAPI()
+    base_url = await api.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'loadtest.db')
+        prepare_database(db_path)
+        os.environ.update({
+            'API_TOKEN': '123456:LOADTEST',
+            'TELEGRAM_API_URL': base_url,
+            'GROUP_CHAT_ID': str(GROUP_CHAT_ID),
+            'DB_PATH': db_path,
+        })
+        import bot
+
+        bot_task = asyncio.create_task(bot.main())
+        try:
+            report = await scenario(Driver(api), db_path, args)
+        finally:
+            await bot.dp.stop_polling()
+            await bot_task
+        await api.stop()
+
+    print(json.dumps(report, indent=2))
+    print(f"\n{'phase':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'per sec':>10}",
+          file=sys.stderr)
+    for phase, stats in report.items():
+        print(f"{phase:<14}{stats.get('count', ''):>7}"
+              + "".join(f"{stats[key]:>10.1f}" if key in stats else f"{'':>10}"
+                        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'throughput')),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake Bot API")
+    parser.add_argument('--participants', type=int, default=200)
+    parser.add_argument('--request-rate', type=float, default=100, help="/start and payment flows per second")
+    parser.add_argument('--answer-rate', type=float, default=200, help="poll answers per second")
+    parser.add_argument('--balance-requests', type=int, default=100)
+    parser.add_argument('--balance-rate', type=float, default=50, help="/balance requests per second during the poll burst")
+    parser.add_argument('--payments', type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,187 @@
+"""In-process metrics with Prometheus text exposition.
+
+Metrics are registered once in the module-level REGISTRY and are safe to
+update from the event loop and from database executor threads alike.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from sub-millisecond SQLite lookups to slow Telegram calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, values, (), value) for values, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def series(self):
+        """Return {label values: (count, sum)}."""
+        with self._lock:
+            return {values: (sum(series[:-1]), series[-1]) for values, series in self._series.items()}
+
+    def quantile(self, q, *label_values):
+        """Estimate a quantile from the buckets, interpolating linearly inside the matching bucket."""
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                return None
+            counts = series[:-1]
+        total = sum(counts)
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return None
+
+    def samples(self):
+        with self._lock:
+            items = [(values, list(series)) for values, series in self._series.items()]
+        samples = []
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", values, (('le', bound),), cumulative))
+            samples.append((f"{self.name}_count", values, (), cumulative))
+            samples.append((f"{self.name}_sum", values, (), series[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, values, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labels, values, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Per-update time breakdown, set by the dispatcher middleware for the task
+# handling an update: {'handler': name, 'db': seconds, 'api': seconds}
+request_timings = ContextVar('request_timings', default=None)
+
+
+def add_request_time(kind, seconds):
+    """Attribute `seconds` of `kind` ('db' or 'api') to the update being handled, if any."""
+    timings = request_timings.get()
+    if timings is not None:
+        timings[kind] += seconds
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    """Serve GET /metrics on host:port. Returns the aiohttp runner; call runner.cleanup() to stop."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return runner
+
+
+async def dump_metrics_periodically(path, interval, registry=REGISTRY):
+    """Rewrite `path` with the current metrics every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(registry.render())
+        except OSError:
+            logger.exception("Failed to dump metrics to %s", path)
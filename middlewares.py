@@ -0,0 +1,106 @@
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from metrics import REGISTRY, request_timings, add_request_time
+
+UPDATE_SECONDS = REGISTRY.histogram(
+    'bot_update_seconds', "End-to-end time to process one update", ('handler',)
+)
+UPDATE_DB_SECONDS = REGISTRY.histogram(
+    'bot_update_db_seconds', "Time an update spent waiting for the database", ('handler',)
+)
+UPDATE_API_SECONDS = REGISTRY.histogram(
+    'bot_update_api_seconds', "Time an update spent in Telegram Bot API calls", ('handler',)
+)
+UPDATES_IN_FLIGHT = REGISTRY.gauge('bot_updates_in_flight', "Updates currently being processed")
+API_REQUEST_SECONDS = REGISTRY.histogram(
+    'bot_api_request_seconds', "Duration of Telegram Bot API requests", ('method',)
+)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware for dp.update: measures every update from arrival to completion.
+
+    The handler name is filled in by HandlerTagMiddleware once routing has
+    picked a handler; updates no handler accepted are recorded as 'unhandled'.
+    """
+
+    async def __call__(self, handler, event, data):
+        timings = {'handler': 'unhandled', 'db': 0.0, 'api': 0.0}
+        token = request_timings.set(timings)
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            UPDATES_IN_FLIGHT.dec()
+            request_timings.reset(token)
+            name = timings['handler']
+            UPDATE_SECONDS.observe(name, value=elapsed)
+            UPDATE_DB_SECONDS.observe(name, value=timings['db'])
+            UPDATE_API_SECONDS.observe(name, value=timings['api'])
+
+
+class HandlerTagMiddleware(BaseMiddleware):
+    """Inner middleware: records which handler the current update was routed to.
+
+    Inner middlewares registered on the dispatcher's observers also run for
+    the handlers of routers included into it.
+    """
+
+    async def __call__(self, handler, event, data):
+        timings = request_timings.get()
+        if timings is not None and 'handler' in data:
+            timings['handler'] = data['handler'].callback.__name__
+        return await handler(event, data)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing outgoing Bot API calls."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            API_REQUEST_SECONDS.observe(type(method).__name__, value=elapsed)
+            add_request_time('api', elapsed)
+
+
+def setup_metrics_middlewares(dp, bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    tag = HandlerTagMiddleware()
+    for observer in (dp.message, dp.callback_query, dp.poll_answer):
+        observer.middleware(tag)
+    bot.session.middleware(ApiTimingMiddleware())
+
+
+def handler_stats():
+    """Rows of (handler, count, p50, p95, p99, avg db seconds, avg api seconds), busiest first."""
+    db_time = UPDATE_DB_SECONDS.series()
+    api_time = UPDATE_API_SECONDS.series()
+    rows = []
+    for labels, (count, _) in UPDATE_SECONDS.series().items():
+        rows.append((
+            labels[0], count,
+            UPDATE_SECONDS.quantile(0.5, *labels),
+            UPDATE_SECONDS.quantile(0.95, *labels),
+            UPDATE_SECONDS.quantile(0.99, *labels),
+            db_time.get(labels, (1, 0))[1] / count,
+            api_time.get(labels, (1, 0))[1] / count,
+        ))
+    return sorted(rows, key=lambda row: row[1], reverse=True)
+
+
+def format_stats():
+    lines = [f"Обновлений в обработке: {UPDATES_IN_FLIGHT.value()}"]
+    for name, count, p50, p95, p99, db, api in handler_stats():
+        lines.append(
+            f"{name}: {count} шт., p50 {p50 * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс, p99 {p99 * 1000:.0f} мс, "
+            f"БД {db * 1000:.0f} мс, API {api * 1000:.0f} мс"
+        )
+    return "\n".join(lines)
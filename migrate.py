@@ -0,0 +1,270 @@
+"""Apply numbered SQL migrations from migrations/ and inspect query plans.
+
+    python migrate.py             apply pending migrations to DB_PATH
+    python migrate.py --status    list migrations and whether they are applied
+    python migrate.py --explain   print EXPLAIN QUERY PLAN for every Database query
+"""
+import argparse
+import inspect
+import os
+import re
+import sqlite3
+import tempfile
+
+from config import DB_PATH
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(.+)\.sql$')
+
+# Tables a migration fills from the existing history with the same SQL the bot uses
+# to rebuild them: version -> name of a Database attribute holding the statements.
+# They run in the migration's transaction, after its own statements.
+BACKFILLS = {
+    14: 'STATS_REBUILD_SQL',
+}
+
+
+def list_migrations(directory=MIGRATIONS_DIR):
+    """Return (version, name, path) for every migration file, ordered by version."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+
+def split_statements(script):
+    statements = []
+    current = ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+
+def applied_versions(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    return {row[0] for row in connection.execute("SELECT version FROM schema_migrations")}
+
+
+def apply_migrations(path_to_db=DB_PATH, directory=MIGRATIONS_DIR, verbose=False):
+    """Apply every migration that isn't recorded in schema_migrations yet.
+
+    Each migration runs in its own transaction together with its
+    schema_migrations row, so running this again is always safe. Databases
+    created from database_setup.sql already have the columns the early
+    ALTER TABLE migrations add; a duplicate column is treated as applied.
+    Migrations listed in BACKFILLS then fill their tables from the history.
+    Returns the list of versions applied.
+    """
+    connection = sqlite3.connect(path_to_db, isolation_level=None)
+    try:
+        done = applied_versions(connection)
+        applied = []
+        for version, name, path in list_migrations(directory):
+            if version in done:
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                statements = split_statements(f.read())
+            if version in BACKFILLS:
+                from database import Database
+                statements += getattr(Database, BACKFILLS[version])
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    try:
+                        connection.execute(statement)
+                    except sqlite3.OperationalError as e:
+                        if 'duplicate column name' not in str(e):
+                            raise
+                connection.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            applied.append(version)
+            if verbose:
+                print(f"Applied migration {version:03d} {name}")
+        return applied
+    finally:
+        connection.close()
+
+
+def print_status(path_to_db=DB_PATH):
+    connection = sqlite3.connect(path_to_db)
+    done = applied_versions(connection)
+    connection.close()
+    for version, name, _ in list_migrations():
+        print(f"{version:03d} {name}: {'applied' if version in done else 'pending'}")
+
+
+# Representative call for every Database method that talks to SQLite. The
+# statements they issue are captured with the trace callback and explained
+# against the real database. Methods missing here are reported by --explain.
+EXPLAIN_CALLS = [
+    ('load_participant', (1,)),
+    ('load_admin_telegram_ids', ()),
+    ('add_participant', (2, 'Explain')),
+    ('set_admin_by_user_id', (2,)),
+    ('add_training', ('2024-01-01', '18:00', 'Gym', 500.0)),
+    ('link_poll_to_training', (1, 'explain-poll-2')),
+    ('get_training_id_by_poll', ('explain-poll',)),
+    ('update_registration', (1, 1, 'смогу')),
+    ('apply_registrations', ([(1, 'explain-poll', 'смогу'), (2, 'explain-poll', None)],)),
+    ('get_training_registrations', (1,)),
+    ('get_training_fee', (1,)),
+    ('get_training_date', (1,)),
+    ('add_payment', (1, 100.0)),
+    ('import_payments', ([(1, 100.0, '2024-01-01'), (1, 50.0, '2024-01-02')],)),
+    ('calculate_balance', (1,)),
+    ('calculate_balance_by_id', (1,)),
+    ('get_all_balances', ()),
+    ('set_initial_balance_by_user_id', (1, 100.0)),
+    ('verify_balances', ()),
+    ('rebuild_balances', ()),
+    ('rebuild_stats', ()),
+    ('get_stats_report', ()),
+    ('get_stats_report', ('2024-01',)),
+    ('get_all_participants', ()),
+    ('get_all_trainings', ()),
+    ('get_undebited_trainings', ()),
+    ('get_trainings_page', ()),
+    ('get_trainings_page', (('2024-01-01', 1),)),
+    ('get_trainings_page', (('2024-01-01', 1), True)),
+    ('debit_funds_for_training', (1,)),
+    ('update_registration', (1, 2, 'смогу')),
+    ('debit_trainings_with_notices', ([2],)),
+    ('get_debit_notices', (100,)),
+    ('acknowledge_debit_notices', ([(1, 1, 500.0, 0.0, 1)],)),
+    ('debit_trainings_until', ('9999-12-31',)),
+    ('set_fsm_state', ('fsm:1:1', 'PaymentProcess:waiting_for_amount', 2e9)),
+    ('set_fsm_data', ('fsm:1:1', None, 2e9)),
+    ('get_fsm_record', ('fsm:1:1', 0)),
+    ('delete_expired_fsm_records', (0,)),
+    ('register_group', (-100, 'explain.db', 'Explain', True)),
+    ('get_group_shards', ()),
+    ('add_group_member', (1, -100)),
+    ('set_current_group', (1, -100)),
+    ('get_current_group', (1,)),
+    ('get_member_groups', (1,)),
+    ('link_poll_to_group', ('explain-poll', -100)),
+    ('get_group_by_poll', ('explain-poll',)),
+    ('get_compactions', ()),
+    ('iter_ledger', ('payments', '2024-01-01', '2024-12-31')),
+    ('iter_ledger', ('initial_balances', '2024-01-01', '2024-12-31')),
+    ('iter_ledger', ('training_registrations', '2024-01-01', '2024-12-31')),
+    ('iter_ledger', ('balances', '2024-01-01', '2024-12-31')),
+]
+
+# Database methods that don't issue queries of their own
+EXPLAIN_SKIP = {
+    'close', 'execute', 'transaction', 'reader', 'logger', 'iter_balances', 'add_write_listener',
+    'external_check_due', 'check_external_writes',
+    'get_participant', 'get_participant_id', 'get_admin_telegram_ids', 'is_admin',
+    # Queries an attached archive database and a temp table the explained database doesn't have
+    'compact_ledger',
+}
+
+
+def capture_statements(schema_db):
+    """Run EXPLAIN_CALLS against a scratch database and return {method: [sql, ...]}."""
+    from database import Database
+
+    class TracingDatabase(Database):
+        trace_sql = True
+        current = None
+        statements = {}
+
+        def logger(self, statement):
+            if self.current and statement.split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+                self.statements.setdefault(self.current, []).append(statement)
+
+    db = TracingDatabase(schema_db)
+    for method, args in EXPLAIN_CALLS:
+        db.current = method
+        result = getattr(db, method)(*args)
+        if inspect.isgenerator(result):
+            for _ in result:
+                pass
+    db.current = None
+    db.close()
+
+    public = {name for name in dir(Database) if not name.startswith('_') and callable(getattr(Database, name))}
+    uncovered = public - EXPLAIN_SKIP - {method for method, _ in EXPLAIN_CALLS}
+    return db.statements, sorted(uncovered)
+
+
+def explain(path_to_db=DB_PATH):
+    """Print the query plan of every statement Database issues, flagging full table scans."""
+    source = sqlite3.connect(path_to_db)
+    schema = [row[0] for row in source.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+    )]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Same schema as the real database plus one row per table, so every
+        # code path in the sample calls issues its queries
+        scratch = os.path.join(tmp, 'explain.db')
+        connection = sqlite3.connect(scratch)
+        for sql in schema:
+            connection.execute(sql)
+        connection.executescript("""
+            INSERT INTO participants (id, telegram_id, name, is_admin) VALUES (1, 1, 'Explain', 1);
+            INSERT INTO trainings (id, date, time, location, fee) VALUES (1, '2024-01-01', '18:00', 'Gym', 500);
+            INSERT INTO training_polls (training_id, poll_id) VALUES (1, 'explain-poll');
+            INSERT INTO payments (participant_id, amount, date) VALUES (1, 100, '2024-01-01');
+            INSERT INTO initial_balances (participant_id, balance, date) VALUES (1, 0, '2023-12-31');
+        """)
+        connection.commit()
+        connection.close()
+        statements, uncovered = capture_statements(scratch)
+
+    full_scans = 0
+    for method, sqls in statements.items():
+        print(f"== {method}")
+        seen = set()
+        for sql in sqls:
+            if sql in seen:
+                continue
+            seen.add(sql)
+            print("   " + " ".join(sql.split()))
+            # Scanning a subquery's own result rows is not a table scan
+            derived = {'CONSTANT ROW'}
+            for _, _, _, detail in source.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE ')):
+                    derived.add(detail.split(' ', 1)[1])
+                scan = (detail.startswith('SCAN ') and ' USING ' not in detail
+                        and detail[5:] not in derived and not detail.startswith('SCAN (subquery'))
+                full_scans += scan
+                print(f"      {'!! ' if scan else ''}{detail}")
+    source.close()
+    print(f"\nFull table scans: {full_scans}")
+    if uncovered:
+        print(f"Not covered by EXPLAIN_CALLS: {', '.join(uncovered)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply database migrations")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--status', action='store_true', help="show applied and pending migrations")
+    parser.add_argument('--explain', action='store_true', help="print query plans of all Database queries")
+    args = parser.parse_args()
+    if args.status:
+        print_status(args.db)
+    elif args.explain:
+        explain(args.db)
+    else:
+        applied = apply_migrations(args.db, verbose=True)
+        if not applied:
+            print("Database is up to date")
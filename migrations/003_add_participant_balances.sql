@@ -0,0 +1,22 @@
+CREATE TABLE IF NOT EXISTS participant_balances (
+    participant_id INTEGER PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    since TEXT,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
+
+INSERT OR REPLACE INTO participant_balances (participant_id, balance, since)
+WITH last_initial AS (
+    SELECT participant_id, balance, date FROM (
+        SELECT participant_id, balance, date,
+               ROW_NUMBER() OVER (PARTITION BY participant_id ORDER BY date DESC, id DESC) AS rn
+        FROM initial_balances
+    ) WHERE rn = 1
+)
+SELECT p.id,
+       COALESCE(li.balance, 0) + COALESCE(SUM(pay.amount), 0),
+       li.date
+FROM participants p
+LEFT JOIN last_initial li ON li.participant_id = p.id
+LEFT JOIN payments pay ON pay.participant_id = p.id AND (li.date IS NULL OR pay.date >= li.date)
+GROUP BY p.id;
@@ -0,0 +1,6 @@
+-- Keep only the latest answer per participant and training before enforcing uniqueness
+DELETE FROM training_registrations
+WHERE id NOT IN (SELECT MAX(id) FROM training_registrations GROUP BY training_id, participant_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_training_registrations_training_participant
+    ON training_registrations (training_id, participant_id);
@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS idx_payments_participant_date ON payments (participant_id, date);
+
+CREATE INDEX IF NOT EXISTS idx_initial_balances_participant_date ON initial_balances (participant_id, date);
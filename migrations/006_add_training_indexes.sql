@@ -0,0 +1,5 @@
+-- Keyset pagination of the training list, newest first
+CREATE INDEX IF NOT EXISTS idx_trainings_date ON trainings (date);
+
+-- Trainings still waiting for a debit; stays small however long the history gets
+CREATE INDEX IF NOT EXISTS idx_trainings_undebited ON trainings (date) WHERE is_funds_debited = 0;
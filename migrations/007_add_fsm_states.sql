@@ -0,0 +1,9 @@
+-- Conversation state of the FSM storage (fsm_storage.py); rows past expires_at are swept
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at);
@@ -0,0 +1,20 @@
+-- Directory of groups served by the bot (shards.py); kept in the main database only
+CREATE TABLE IF NOT EXISTS group_shards (
+    chat_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    title TEXT
+);
+
+-- Groups each user belongs to; private-chat commands act on the user's current group
+CREATE TABLE IF NOT EXISTS group_members (
+    telegram_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    is_current INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (telegram_id, chat_id)
+) WITHOUT ROWID;
+
+-- Poll answers don't say which chat the poll was posted to
+CREATE TABLE IF NOT EXISTS group_polls (
+    poll_id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL
+) WITHOUT ROWID;
@@ -0,0 +1,3 @@
+-- Date-range scans of the ledger export, returned in date order without sorting
+CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (date);
+CREATE INDEX IF NOT EXISTS idx_initial_balances_date ON initial_balances (date);
@@ -0,0 +1,10 @@
+-- Every compaction of the ledger (Database.compact_ledger): rows dated before cutoff were moved to archive_path
+CREATE TABLE IF NOT EXISTS ledger_compactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cutoff TEXT NOT NULL,
+    archive_path TEXT NOT NULL,
+    payments INTEGER NOT NULL,
+    initial_balances INTEGER NOT NULL,
+    checkpoints INTEGER NOT NULL,
+    compacted_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
@@ -0,0 +1,9 @@
+-- Debit notifications of the background scheduler (auto_debit.py) not yet handed to the
+-- broadcaster, one coalesced row per participant, written in the debit's transaction
+CREATE TABLE IF NOT EXISTS debit_notices (
+    participant_id INTEGER PRIMARY KEY,
+    amount REAL NOT NULL,
+    balance REAL NOT NULL,
+    trainings INTEGER NOT NULL,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
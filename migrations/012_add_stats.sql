@@ -0,0 +1,33 @@
+-- Attendance and spending summaries, kept up to date by every registration, training,
+-- debit and payment (see Database._add_to_stats). Months are YYYY-MM: attendance and
+-- debits count in the month of the training, payments in the month they were made.
+-- Migration 014 fills them from the existing history (Database.STATS_REBUILD_SQL).
+CREATE TABLE IF NOT EXISTS participant_monthly_stats (
+    participant_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (participant_id, month)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_participant_monthly_stats_month ON participant_monthly_stats (month);
+
+CREATE TABLE IF NOT EXISTS participant_stats (
+    participant_id INTEGER PRIMARY KEY,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0,
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+);
+
+CREATE TABLE IF NOT EXISTS monthly_stats (
+    month TEXT PRIMARY KEY,
+    trainings INTEGER NOT NULL DEFAULT 0,
+    attended INTEGER NOT NULL DEFAULT 0,
+    plus_ones INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    paid REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
@@ -0,0 +1,16 @@
+-- What every debited training charged each attendee, written in the debit's transaction
+-- (see Database._debit_training); the stats count debits from here. Trainings debited
+-- before this table existed get their current registrations times the fee.
+CREATE TABLE IF NOT EXISTS training_debits (
+    training_id INTEGER NOT NULL,
+    participant_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (training_id, participant_id),
+    FOREIGN KEY (training_id) REFERENCES trainings(id),
+    FOREIGN KEY (participant_id) REFERENCES participants(id)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO training_debits (training_id, participant_id, amount)
+SELECT t.id, r.participant_id, t.fee * CASE r.status WHEN 'приду с другом' THEN 2 ELSE 1 END
+FROM trainings t JOIN training_registrations r ON r.training_id = t.id
+WHERE t.is_funds_debited = 1 AND r.status IN ('смогу', 'приду с другом');
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from collections import namedtuple, deque, Counter
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramAPIError
+
+from config import (
+    NOTIFY_QUEUE_SIZE, NOTIFY_WORKERS, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE,
+    NOTIFY_GROUP_RATE, NOTIFY_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# `future`, if set, receives the DeliveryResult (see Broadcaster.send)
+Notification = namedtuple('Notification', 'chat_id text kwargs future')
+DeliveryResult = namedtuple('DeliveryResult', 'chat_id ok attempts error')
+
+
+class Broadcaster:
+    """Background fan-out of bot messages.
+
+    Callers enqueue messages and return immediately; a pool of workers sends
+    them while keeping under Telegram's global and per-chat rate limits,
+    waiting out 429 responses and retrying transient failures with backoff.
+    Only `bot.send_message` is used, so any object providing it can stand in
+    for the real Bot.
+    """
+
+    def __init__(self, bot, queue_size=NOTIFY_QUEUE_SIZE, workers=NOTIFY_WORKERS,
+                 global_rate=NOTIFY_GLOBAL_RATE, chat_rate=NOTIFY_CHAT_RATE, group_rate=NOTIFY_GROUP_RATE,
+                 max_retries=NOTIFY_MAX_RETRIES, on_result=None, history=1000):
+        self.bot = bot
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.group_interval = 1 / group_rate
+        self.max_retries = max_retries
+        self.on_result = on_result
+        self.results = deque(maxlen=history)
+        self.stats = Counter()
+        self._tasks = []
+        self._next_global = 0.0
+        self._next_chat = {}
+
+    def enqueue(self, chat_id, text, **kwargs):
+        """Queue a message for delivery. Returns False if the queue is full and the message was dropped."""
+        try:
+            self.queue.put_nowait(Notification(chat_id, text, kwargs, None))
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            logger.warning("Notification queue is full, dropping message to %s", chat_id)
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    async def send(self, chat_id, text, **kwargs):
+        """Queue a message, waiting for room if needed, and return its DeliveryResult once it is
+        delivered or given up on. Never returns if the broadcaster stops before sending it."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Notification(chat_id, text, kwargs, future))
+        self.stats['queued'] += 1
+        return await future
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout=10):
+        """Give queued messages up to `timeout` seconds to go out, then stop the workers."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d undelivered notifications", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _reserve_slot(self, chat_id):
+        """Reserve the earliest send time allowed by both limits and return the delay until it."""
+        now = asyncio.get_running_loop().time()
+        # Negative chat ids are groups, which have a much lower per-chat limit
+        interval = self.group_interval if chat_id < 0 else self.chat_interval
+        slot = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+        self._next_global = slot + self.global_interval
+        self._next_chat[chat_id] = slot + interval
+        if len(self._next_chat) > 10000:
+            self._next_chat = {chat: t for chat, t in self._next_chat.items() if t > now}
+        return slot - now
+
+    def _pause(self, seconds):
+        now = asyncio.get_running_loop().time()
+        self._next_global = max(self._next_global, now + seconds)
+
+    async def _worker(self):
+        while True:
+            notification = await self.queue.get()
+            try:
+                result = await self._deliver(notification)
+                if notification.future is not None and not notification.future.done():
+                    notification.future.set_result(result)
+                self.results.append(result)
+                self.stats['sent' if result.ok else 'failed'] += 1
+                if self.on_result:
+                    try:
+                        self.on_result(notification, result)
+                    except Exception:
+                        logger.exception("Notification callback failed")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, notification):
+        chat_id, text, kwargs, _ = notification
+        attempt = 0
+        while True:
+            attempt += 1
+            delay = self._reserve_slot(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return DeliveryResult(chat_id, True, attempt, None)
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot, so every worker waits
+                self.stats['retry_after'] += 1
+                self._pause(e.retry_after)
+                error = e
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error = e
+                if attempt <= self.max_retries:
+                    self.stats['retried'] += 1
+                    await asyncio.sleep(min(2 ** attempt, 60))
+            except TelegramAPIError as e:
+                # Blocked bot, deleted chat, bad request: retrying won't help
+                logger.info("Giving up on message to %s: %s", chat_id, e)
+                return DeliveryResult(chat_id, False, attempt, str(e))
+            except Exception as e:
+                # A response aiogram can't decode or a bug: report it instead of losing the message silently
+                logger.exception("Failed to send message to %s", chat_id)
+                return DeliveryResult(chat_id, False, attempt, str(e))
+            if attempt > self.max_retries:
+                logger.warning("Giving up on message to %s after %d attempts: %s", chat_id, attempt, error)
+                return DeliveryResult(chat_id, False, attempt, str(error))
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+# Returned by ParticipantCache.get when nothing is cached for the key
+MISSING = object()
+
+
+class ParticipantCache:
+    """Bounded LRU cache of participant rows by telegram_id plus the set of admin telegram ids.
+
+    Unregistered users are cached as None, so repeated lookups by strangers
+    don't hit SQLite either. Writers call invalidate() after committing, and
+    Database.check_external_writes() does when another process committed;
+    put() takes the generation read before the query, so a lookup that raced
+    with a write can't store its stale result.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._rows = OrderedDict()
+        self._admins = None
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        with self._lock:
+            row = self._rows.get(telegram_id, MISSING)
+            if row is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._rows.move_to_end(telegram_id)
+            return row
+
+    def put(self, telegram_id, row, generation):
+        with self._lock:
+            if generation != self.generation or not self.maxsize:
+                return
+            self._rows[telegram_id] = row
+            self._rows.move_to_end(telegram_id)
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+
+    def get_admins(self):
+        with self._lock:
+            if self._admins is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return self._admins
+
+    def put_admins(self, admins, generation):
+        with self._lock:
+            if generation == self.generation:
+                self._admins = frozenset(admins)
+
+    def invalidate(self, telegram_id=None):
+        """Forget one participant (and the admin set), or everything when telegram_id is None."""
+        with self._lock:
+            self.generation += 1
+            self._admins = None
+            if telegram_id is None:
+                self._rows.clear()
+            else:
+                self._rows.pop(telegram_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._rows), 'hits': self.hits, 'misses': self.misses}
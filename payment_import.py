@@ -0,0 +1,130 @@
+import csv
+import re
+from collections import namedtuple
+from datetime import datetime
+
+# Header names (lower case) recognised in uploaded statements, per field
+COLUMN_ALIASES = {
+    'date': ('date', 'дата', 'дата операции', 'дата платежа'),
+    'amount': ('amount', 'sum', 'сумма', 'сумма операции', 'приход'),
+    'name': ('name', 'payer', 'имя', 'участник', 'плательщик', 'фио'),
+    'id': ('id', 'participant_id', 'user_id', 'userid', 'telegram_id'),
+}
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d.%m.%y', '%d/%m/%Y')
+
+# A statement row that couldn't be imported, with its 1-based line number
+RejectedRow = namedtuple('RejectedRow', 'line reason value')
+ImportResult = namedtuple('ImportResult', 'payments rejected')
+
+
+def normalize_name(name):
+    return " ".join(name.replace('ё', 'е').replace('Ё', 'Е').split()).casefold()
+
+
+class ParticipantIndex:
+    """In-memory lookup of participants by participant id, telegram id or name.
+
+    Names shared by several participants are ambiguous and never matched.
+    """
+
+    def __init__(self, participants):
+        self.by_id = {}
+        self.by_telegram_id = {}
+        self.by_name = {}
+        ambiguous = set()
+        for name, participant_id, telegram_id in participants:
+            self.by_id[participant_id] = participant_id
+            self.by_telegram_id[telegram_id] = participant_id
+            key = normalize_name(name)
+            if key in self.by_name:
+                ambiguous.add(key)
+            self.by_name[key] = participant_id
+        for key in ambiguous:
+            del self.by_name[key]
+
+    def match(self, participant_id=None, name=None):
+        if participant_id and participant_id.isdigit():
+            number = int(participant_id)
+            found = self.by_id.get(number) or self.by_telegram_id.get(number)
+            if found:
+                return found
+        if name:
+            return self.by_name.get(normalize_name(name))
+        return None
+
+
+def parse_amount(text):
+    # Bank exports write "1 500,00" or "1500.00"
+    cleaned = re.sub(r'\s|₽|руб\.?', '', text).replace(',', '.')
+    return float(cleaned)
+
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip()[:10], date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    raise ValueError(text)
+
+
+def find_columns(header):
+    columns = {}
+    for index, title in enumerate(header):
+        title = title.strip().lstrip('\ufeff').lower()
+        for field, aliases in COLUMN_ALIASES.items():
+            if title in aliases and field not in columns:
+                columns[field] = index
+    if 'amount' not in columns or not ('name' in columns or 'id' in columns):
+        raise ValueError("statement needs an amount column and a name or id column")
+    return columns
+
+
+def parse_statement(lines, index, default_date=None):
+    """Parse an iterable of CSV text lines into (participant_id, amount, date) payments.
+
+    Lines are consumed one at a time; the delimiter is guessed from the
+    header line. Rows that can't be read or matched to a participant are
+    returned in ImportResult.rejected instead of stopping the import.
+    """
+    lines = iter(lines)
+    header_line = next(lines, '')
+    try:
+        dialect = csv.Sniffer().sniff(header_line, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    columns = find_columns(next(csv.reader([header_line], dialect)))
+    default_date = default_date or datetime.now().strftime('%Y-%m-%d')
+
+    payments = []
+    rejected = []
+    for line_number, row in enumerate(csv.reader(lines, dialect), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        cell = lambda field: row[columns[field]].strip() if field in columns and columns[field] < len(row) else ''
+        try:
+            amount = parse_amount(cell('amount'))
+            date = parse_date(cell('date')) if cell('date') else default_date
+        except ValueError:
+            rejected.append(RejectedRow(line_number, 'invalid', ';'.join(row)))
+            continue
+        if amount <= 0:
+            rejected.append(RejectedRow(line_number, 'not_income', ';'.join(row)))
+            continue
+        participant_id = index.match(cell('id'), cell('name'))
+        if participant_id is None:
+            rejected.append(RejectedRow(line_number, 'unknown', cell('name') or cell('id')))
+            continue
+        payments.append((participant_id, amount, date))
+    return ImportResult(payments, rejected)
+
+
+def read_statement(path, index):
+    """parse_statement() over a file, read as UTF-8 or, failing that, as Windows-1251."""
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            with open(path, 'r', encoding=encoding, newline='') as f:
+                return parse_statement(f, index)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("unsupported encoding")
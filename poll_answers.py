@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from config import POLL_BATCH_SIZE, POLL_BATCH_LINGER
+
+logger = logging.getLogger(__name__)
+
+
+class PollAnswerBatcher:
+    """Buffers poll answers and writes them to the database in batches.
+
+    Right after a poll is posted answers arrive in a burst; instead of one
+    transaction per answer they are collected for up to `linger` seconds
+    (or until `batch_size` answers are waiting) and applied with a single
+    Database.apply_registrations call.
+    """
+
+    def __init__(self, db, batch_size=POLL_BATCH_SIZE, linger=POLL_BATCH_LINGER):
+        self.db = db
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = asyncio.Queue()
+        self._task = None
+        # Answers taken off the queue but not yet handed to the database
+        self._batch = []
+
+    def submit(self, telegram_id, poll_id, status):
+        """Queue an answer; status None means the vote was retracted."""
+        self.queue.put_nowait((telegram_id, poll_id, status))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush whatever is still queued."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        batch, self._batch = self._batch, []
+        if batch:
+            await self._flush(batch)
+        while not self.queue.empty():
+            await self._flush(self._drain(self.batch_size))
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch.append(await self.queue.get())
+            deadline = loop.time() + self.linger
+            while len(self._batch) < self.batch_size:
+                self._batch.extend(self._drain(self.batch_size - len(self._batch)))
+                timeout = deadline - loop.time()
+                if len(self._batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            written = await self.db.apply_registrations(batch)
+            logger.debug("Applied %d poll answers (%d registrations)", len(batch), written)
+        except Exception:
+            logger.exception("Failed to apply %d poll answers", len(batch))
@@ -0,0 +1,20 @@
+import argparse
+
+from database import Database
+
+def rebuild_balances(verify_only=False):
+    db = Database()
+    drift = db.verify_balances()
+    for participant_id, name, stored, expected in drift:
+        print(f"{name} [{participant_id}]: stored {stored:.2f}, ledger {expected:.2f}")
+    print(f"Participants with drift: {len(drift)}")
+    if not verify_only:
+        rebuilt = db.rebuild_balances()
+        print(f"Rebuilt balances for {rebuilt} participants")
+    db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recompute participant_balances from payments and initial balances")
+    parser.add_argument('--verify-only', action='store_true', help="only report drift, don't rewrite the table")
+    args = parser.parse_args()
+    rebuild_balances(args.verify_only)
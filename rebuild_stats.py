@@ -0,0 +1,17 @@
+import argparse
+
+from database import Database
+
+def rebuild_stats(path_to_db=None):
+    db = Database(path_to_db) if path_to_db else Database()
+    rows = db.rebuild_stats()
+    totals = db.get_stats_report().totals
+    print(f"Rebuilt {rows} participant-month rows: {totals.trainings} trainings, {totals.attended} attendances, "
+          f"{totals.debited:.2f} debited, {totals.paid:.2f} paid")
+    db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recompute the attendance and spending stats tables from the ledger")
+    parser.add_argument('--db', default=None, help="database to rebuild (default: DB_PATH)")
+    args = parser.parse_args()
+    rebuild_stats(args.db)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+
+from config import REPORT_CACHE_SIZE, REPORT_CACHE_REFRESH_DELAY, REPORT_CACHE_REFRESH_LIMIT
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+REPORT_CACHE_REQUESTS = REGISTRY.counter(
+    'bot_report_cache_requests_total', "Admin report lookups by outcome", ('report', 'outcome')
+)
+REPORT_RENDER_SECONDS = REGISTRY.histogram(
+    'bot_report_render_seconds', "Time to compute a report on a cache miss or refresh", ('report',)
+)
+
+# One cached report: the data versions it was computed at and how to compute it again
+CacheEntry = namedtuple('CacheEntry', 'version external_version value db render args kwargs')
+
+
+class ReportCache:
+    """LRU cache of admin reports, valid until the next write to their database.
+
+    Entries are keyed on the database, report name and arguments, and store
+    the Database.data_version they were computed at; any versioned commit
+    makes them stale. They also store Database.external_version, so commits
+    by other processes (the CLI tools, another bot process) make them stale
+    too, within EXTERNAL_WRITES_CHECK_INTERVAL seconds. With `refresh_delay`
+    set, the most recently used stale reports of a database are recomputed
+    in the background that many seconds after a write of this process, so
+    the next view is already a hit.
+    """
+
+    def __init__(self, maxsize=REPORT_CACHE_SIZE, refresh_delay=REPORT_CACHE_REFRESH_DELAY,
+                 refresh_limit=REPORT_CACHE_REFRESH_LIMIT):
+        self.maxsize = maxsize
+        self.refresh_delay = refresh_delay
+        self.refresh_limit = refresh_limit
+        self._entries = OrderedDict()
+        self._watched = weakref.WeakSet()
+        self._refreshing = set()
+        self._loop = None
+
+    async def get(self, db, name, render, *args, **kwargs):
+        """Return render(*args, **kwargs) for db, computing it only if db changed since last time."""
+        database = db.database
+        key = (database.path_to_db, name, args, tuple(sorted(kwargs.items())))
+        entry = self._entries.get(key)
+        # A reopened shard starts counting versions from zero again
+        if (entry is not None and entry.db.database is database and entry.version == database.data_version
+                and entry.external_version == await db.check_external_writes()):
+            self._entries.move_to_end(key)
+            REPORT_CACHE_REQUESTS.inc(name, 'hit')
+            return entry.value
+        REPORT_CACHE_REQUESTS.inc(name, 'miss')
+        self._watch(database)
+        return await self._render(key, db, render, args, kwargs)
+
+    async def _render(self, key, db, render, args, kwargs):
+        # Read the versions first: a write racing with the query leaves the entry stale
+        version = db.database.data_version
+        external_version = await db.check_external_writes()
+        started = time.perf_counter()
+        value = await render(*args, **kwargs)
+        REPORT_RENDER_SECONDS.observe(key[1], value=time.perf_counter() - started)
+        if self.maxsize:
+            self._entries[key] = CacheEntry(version, external_version, value, db, render, args, kwargs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def _watch(self, database):
+        if database in self._watched or not self.refresh_delay:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._watched.add(database)
+        database.add_write_listener(self._written)
+
+    def _written(self, database):
+        # Runs on the database writer thread
+        try:
+            self._loop.call_soon_threadsafe(self._schedule_refresh, database.path_to_db)
+        except RuntimeError:
+            pass
+
+    def _schedule_refresh(self, path):
+        # Writes arriving during the delay are covered by the same refresh
+        if path not in self._refreshing:
+            self._refreshing.add(path)
+            asyncio.create_task(self._refresh(path))
+
+    async def _refresh(self, path):
+        try:
+            await asyncio.sleep(self.refresh_delay)
+        finally:
+            self._refreshing.discard(path)
+        stale = [(key, entry) for key, entry in reversed(self._entries.items())
+                 if key[0] == path and entry.version != entry.db.database.data_version][:self.refresh_limit]
+        for key, entry in stale:
+            try:
+                await self._render(key, entry.db, entry.render, entry.args, entry.kwargs)
+                REPORT_CACHE_REQUESTS.inc(key[1], 'refresh')
+            except Exception:
+                # The shard may have been closed meanwhile; the next view renders it again
+                logger.exception("Failed to refresh report %s", key[1])
+                self._entries.pop(key, None)
+
+    def stats(self):
+        return {'size': len(self._entries)}
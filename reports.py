@@ -0,0 +1,51 @@
+# Telegram rejects messages longer than this many characters
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def chunk_lines(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Pack lines into as few messages as possible, each at most `limit` characters.
+
+    Consumes `lines` lazily, so only one message worth of text is held at a time.
+    """
+    chunk = []
+    size = 0
+    for line in lines:
+        line = line[:limit]
+        if chunk and size + 1 + len(line) > limit:
+            yield "\n".join(chunk)
+            chunk = []
+            size = 0
+        size += len(line) + (1 if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        yield "\n".join(chunk)
+
+
+def format_balance_lines(rows):
+    for _, name, balance in rows:
+        yield f"{name}: {balance:.2f} руб."
+
+
+def balance_report_chunks(rows, limit=TELEGRAM_MESSAGE_LIMIT):
+    return chunk_lines(format_balance_lines(rows), limit)
+
+
+def format_percent(part, whole):
+    return f"{100 * part / whole:.0f}%" if whole else "—"
+
+
+def format_attendance_lines(report, period):
+    totals = report.totals
+    yield f"Посещаемость {period}: тренировок {totals.trainings}, отметок «приду» {totals.attended}, +1: {totals.plus_ones}"
+    for row in sorted(report.participants, key=lambda row: -row.attended):
+        if row.attended:
+            yield (f"{row.name}: {row.attended} из {totals.trainings} "
+                   f"({format_percent(row.attended, totals.trainings)}), +1: {row.plus_ones}")
+
+
+def format_spending_lines(report, period):
+    totals = report.totals
+    yield f"Расходы {period}: списано {totals.debited:.2f} руб., оплачено {totals.paid:.2f} руб."
+    for row in sorted(report.participants, key=lambda row: -row.debited):
+        if row.debited or row.paid:
+            yield f"{row.name}: списано {row.debited:.2f} руб., оплачено {row.paid:.2f} руб."
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+
+from config import SCHEDULER_WORKERS
+from metrics import REGISTRY
+
+SCHEDULER_DEPTH = REGISTRY.histogram(
+    'bot_scheduler_key_depth', "Updates already queued for the same key when an update arrives", ('kind',),
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64)
+)
+SCHEDULER_WAITING = REGISTRY.gauge('bot_scheduler_waiting', "Updates waiting for their key or a worker", ('kind',))
+SCHEDULER_RUNNING = REGISTRY.gauge('bot_scheduler_running', "Updates holding a worker slot")
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    'bot_scheduler_wait_seconds', "Time an update waited before its handler ran"
+)
+
+
+def update_keys(update):
+    """Ordering keys of an update: its user, plus the training a debit button refers to."""
+    keys = []
+    event = update.event
+    user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+    if user is not None:
+        keys.append(('user', user.id))
+    if update.callback_query and (update.callback_query.data or '').startswith('debit_'):
+        keys.append(('training', update.callback_query.data.split('_', 1)[1]))
+    return keys
+
+
+class KeyedScheduler(BaseMiddleware):
+    """Outer middleware for dp.update: per-key ordering, bounded parallelism.
+
+    Updates sharing a key (the same user, or the same training for debits)
+    run one at a time in arrival order, so a quickly changed poll answer or
+    a double-pressed debit button can't interleave. Updates with different
+    keys run concurrently, at most `workers` at once: a payment entered by
+    one admin and a debit pressed by another are not ordered here; the
+    single writer transaction each of them runs in is what serializes them.
+    It must be registered before any middleware that awaits, or arrival
+    order is lost.
+    """
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.workers = asyncio.Semaphore(workers)
+        # key -> [lock, updates queued or running for the key]
+        self._keys = {}
+
+    async def __call__(self, handler, event, data):
+        keys = sorted(set(update_keys(event)))
+        kind = keys[0][0] if keys else 'none'
+        entries = []
+        for key in keys:
+            entry = self._keys.setdefault(key, [asyncio.Lock(), 0])
+            SCHEDULER_DEPTH.observe(key[0], value=entry[1])
+            entry[1] += 1
+            entries.append((key, entry))
+
+        arrived = time.perf_counter()
+        waiting = True
+        SCHEDULER_WAITING.inc(kind)
+        acquired = []
+        try:
+            # Keys are always locked in sorted order, so two updates can't deadlock
+            for _, entry in entries:
+                await entry[0].acquire()
+                acquired.append(entry[0])
+            async with self.workers:
+                waiting = False
+                SCHEDULER_WAITING.dec(kind)
+                SCHEDULER_WAIT_SECONDS.observe(value=time.perf_counter() - arrived)
+                SCHEDULER_RUNNING.inc()
+                try:
+                    return await handler(event, data)
+                finally:
+                    SCHEDULER_RUNNING.dec()
+        finally:
+            if waiting:
+                SCHEDULER_WAITING.dec(kind)
+            for lock in acquired:
+                lock.release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._keys[key]
+
+    def deepest(self, limit=5):
+        """The keys with the most updates queued or running, deepest first."""
+        return sorted(((key, entry[1]) for key, entry in self._keys.items()), key=lambda item: -item[1])[:limit]
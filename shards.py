@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from collections import OrderedDict, Counter
+from contextlib import asynccontextmanager
+
+from aiogram import BaseMiddleware
+
+from config import SHARD_DIR, SHARD_MAX_OPEN, SHARD_READER_POOL_SIZE, PARTICIPANT_CACHE_SIZE
+from database import Database
+from async_database import AsyncDatabase
+from migrate import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+SETUP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database_setup.sql')
+
+
+def create_shard(path):
+    """Create (or bring up to date) the database file of one group."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path)
+    try:
+        with open(SETUP_SCRIPT, 'r', encoding='utf-8') as f:
+            connection.executescript(f.read())
+    finally:
+        connection.close()
+    apply_migrations(path)
+
+
+class ShardManager:
+    """Routes every group to its own database file.
+
+    The main database (DB_PATH) is the shard of the default group
+    (GROUP_CHAT_ID) and also holds the directory: which file belongs to
+    which group, the groups each user is in, and which group every poll was
+    posted to. Other shards are opened on first use; at most `max_open` of
+    them stay open, least recently used ones are closed once no handler is
+    using them. Every shard has its own writer thread, so groups don't wait
+    for each other's writes.
+    """
+
+    def __init__(self, directory, default_chat_id=None, shard_dir=SHARD_DIR, max_open=SHARD_MAX_OPEN,
+                 readers=SHARD_READER_POOL_SIZE, cache_size=PARTICIPANT_CACHE_SIZE):
+        self.directory = directory
+        self.default_chat_id = default_chat_id
+        self.shard_dir = shard_dir
+        self.max_open = max_open
+        self.readers = readers
+        self.cache_size = cache_size
+        # chat_id -> (path, title); the directory is small enough to keep in memory
+        self._groups = {}
+        # chat_id -> AsyncDatabase, least recently used first
+        self._open = OrderedDict()
+        self._opening = {}
+        self._leases = Counter()
+        # telegram_id -> current chat_id and poll_id -> chat_id, bounded like the participant cache
+        self._current = OrderedDict()
+        self._polls = OrderedDict()
+
+    async def start(self):
+        if self.default_chat_id is not None:
+            await self.directory.register_group(self.default_chat_id, self.directory.database.path_to_db,
+                                                adopt_existing=True)
+        for chat_id, path, title in await self.directory.get_group_shards():
+            self._groups[chat_id] = (path, title)
+
+    def chat_ids(self):
+        return list(self._groups)
+
+    def is_registered(self, chat_id):
+        return chat_id in self._groups
+
+    def title(self, chat_id):
+        return self._groups.get(chat_id, (None, None))[1]
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    async def add_group(self, chat_id, title):
+        """Create the database of a new group; returns False if the group is already served."""
+        path = os.path.join(self.shard_dir, f"group_{abs(chat_id)}.db")
+        await asyncio.get_running_loop().run_in_executor(None, create_shard, path)
+        if not await self.directory.register_group(chat_id, path, title):
+            return False
+        self._groups[chat_id] = (path, title)
+        return True
+
+    async def add_member(self, telegram_id, chat_id):
+        await self.directory.add_group_member(telegram_id, chat_id)
+        self._remember(self._current, telegram_id, chat_id)
+
+    async def set_current_group(self, telegram_id, chat_id):
+        switched = await self.directory.set_current_group(telegram_id, chat_id)
+        if switched:
+            self._remember(self._current, telegram_id, chat_id)
+        return switched
+
+    async def member_groups(self, telegram_id):
+        return await self.directory.get_member_groups(telegram_id)
+
+    async def chat_for_user(self, telegram_id):
+        """The group private messages of this user are about, or None."""
+        chat_id = self._current.get(telegram_id)
+        if chat_id is None:
+            chat_id = await self.directory.get_current_group(telegram_id)
+            if chat_id is None:
+                return self.default_chat_id
+            self._remember(self._current, telegram_id, chat_id)
+        return chat_id
+
+    async def link_poll(self, poll_id, chat_id):
+        await self.directory.link_poll_to_group(poll_id, chat_id)
+        self._remember(self._polls, poll_id, chat_id)
+
+    async def chat_for_poll(self, poll_id):
+        chat_id = self._polls.get(poll_id)
+        if chat_id is None:
+            chat_id = await self.directory.get_group_by_poll(poll_id)
+            if chat_id is None:
+                return self.default_chat_id
+            self._remember(self._polls, poll_id, chat_id)
+        return chat_id
+
+    @asynccontextmanager
+    async def use(self, chat_id):
+        """Yield the AsyncDatabase of a group, or None if the group isn't served."""
+        if chat_id is None or chat_id not in self._groups:
+            yield None
+            return
+        if chat_id == self.default_chat_id:
+            yield self.directory
+            return
+        self._leases[chat_id] += 1
+        try:
+            yield await self._get(chat_id)
+        finally:
+            self._leases[chat_id] -= 1
+            if not self._leases[chat_id]:
+                del self._leases[chat_id]
+            await self._evict()
+
+    async def _get(self, chat_id):
+        db = self._open.get(chat_id)
+        if db is not None:
+            self._open.move_to_end(chat_id)
+            return db
+        # Concurrent first uses of a shard share one opening
+        opening = self._opening.get(chat_id)
+        if opening is None:
+            opening = asyncio.ensure_future(self._open_shard(chat_id))
+            self._opening[chat_id] = opening
+        try:
+            return await asyncio.shield(opening)
+        finally:
+            self._opening.pop(chat_id, None)
+
+    async def _open_shard(self, chat_id):
+        path = self._groups[chat_id][0]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, create_shard, path)
+        database = await loop.run_in_executor(None, Database, path, self.readers)
+        db = AsyncDatabase(database, readers=self.readers)
+        self._open[chat_id] = db
+        logger.info("Opened shard %s for group %s (%d open)", path, chat_id, len(self._open))
+        return db
+
+    async def _evict(self):
+        idle = [chat_id for chat_id in self._open if not self._leases[chat_id]]
+        while len(self._open) > self.max_open and idle:
+            chat_id = idle.pop(0)
+            db = self._open.pop(chat_id)
+            await asyncio.get_running_loop().run_in_executor(None, db.close)
+            logger.info("Closed shard of group %s", chat_id)
+
+    async def apply_registrations(self, answers):
+        """PollAnswerBatcher target: apply each poll's answers to the shard of its group."""
+        by_chat = {}
+        for answer in answers:
+            by_chat.setdefault(await self.chat_for_poll(answer[1]), []).append(answer)
+        written = 0
+        for chat_id, batch in by_chat.items():
+            async with self.use(chat_id) as db:
+                if db is not None:
+                    written += await db.apply_registrations(batch)
+        return written
+
+    def stats(self):
+        return {'groups': len(self._groups), 'open': len(self._open)}
+
+    def close(self):
+        for db in self._open.values():
+            db.close()
+        self._open.clear()
+
+
+class ShardMiddleware(BaseMiddleware):
+    """Outer middleware for dp.update: passes the group's database to handlers.
+
+    Handlers receive `db` (the AsyncDatabase of the group the update is
+    about, or None) and `group_chat_id`. Messages in a group chat belong to
+    that group; private messages and button presses belong to the user's
+    current group. Updates without a group are only let through to group
+    chats, where /add_group and /join work without one.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    async def __call__(self, handler, event, data):
+        if event.message:
+            chat, user = event.message.chat, event.message.from_user
+        elif event.callback_query:
+            message = event.callback_query.message
+            chat, user = (message.chat if message else None), event.callback_query.from_user
+        else:
+            return await handler(event, data)
+
+        if chat is not None and chat.type != 'private':
+            chat_id = chat.id
+        else:
+            chat_id = await self.shards.chat_for_user(user.id)
+        async with self.shards.use(chat_id) as db:
+            if db is None and (chat is None or chat.type == 'private'):
+                text = "Вы не состоите ни в одной группе. Отправьте /join в чате группы."
+                if event.message:
+                    await event.message.answer(text)
+                else:
+                    await event.callback_query.answer(text, show_alert=True)
+                return None
+            data['db'] = db
+            data['group_chat_id'] = chat_id if db is not None else None
+            return await handler(event, data)
@@ -0,0 +1,137 @@
+"""Timing of SQLite statements issued by Database.
+
+Connections opened with InstrumentedConnection time a sample of their
+statements, including the time spent fetching rows. Each statement shape
+(the SQL text with placeholders) is recorded together with the Database
+method that issued it, and statements slower than the configured
+threshold are logged.
+"""
+import logging
+import random
+import sqlite3
+import sys
+import time
+
+from config import SQL_METRICS_SAMPLE_RATE, SQL_SLOW_QUERY_MS
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_SECONDS = REGISTRY.histogram(
+    'db_statement_seconds', "Time spent executing and fetching one SQL statement", ('method', 'statement')
+)
+STATEMENT_ROWS = REGISTRY.counter(
+    'db_statement_rows_total', "Rows returned or modified by SQL statements", ('method', 'statement')
+)
+SLOW_STATEMENTS = REGISTRY.counter(
+    'db_slow_statements_total', "Statements slower than SQL_SLOW_QUERY_MS", ('method',)
+)
+
+# Database helpers that just pass statements through; the caller is the interesting part
+_PLUMBING = {'execute', '_fetch', 'transaction', 'reader', '__exit__', '__enter__', '__next__',
+             'fetchone', 'fetchall', 'fetchmany', 'executemany', '_finish', '_connect'}
+
+
+def statement_shape(sql, limit=200):
+    return " ".join(sql.split())[:limit]
+
+
+def calling_method():
+    """Name of the closest Database method on the stack."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name not in _PLUMBING and code.co_filename.endswith('database.py'):
+            return code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _shape = None
+
+    def _start(self, sql):
+        if random.random() < self.connection.sample_rate and not sql.lstrip()[:6].upper() == 'PRAGMA':
+            self._shape = statement_shape(sql)
+            self._method = calling_method()
+            self._elapsed = 0.0
+            self._rows = 0
+        else:
+            self._shape = None
+
+    def _finish(self):
+        if self._shape is None:
+            return
+        rows = self._rows if self._rows else max(self.rowcount, 0)
+        STATEMENT_SECONDS.observe(self._method, self._shape, value=self._elapsed)
+        STATEMENT_ROWS.inc(self._method, self._shape, amount=rows)
+        if self._elapsed * 1000 >= self.connection.slow_query_ms:
+            SLOW_STATEMENTS.inc(self._method)
+            logger.warning("Slow query in %s (%.1f ms, %d rows): %s", self._method, self._elapsed * 1000, rows, self._shape)
+        self._shape = None
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        if self._shape is None:
+            return super().execute(sql, parameters)
+        self._timed(super().execute, sql, parameters)
+        if not self.description:
+            # No result set: INSERT/UPDATE/DELETE are complete now
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        if self._shape is None:
+            return super().executemany(sql, seq_of_parameters)
+        self._timed(super().executemany, sql, seq_of_parameters)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        if self._shape is None:
+            return super().fetchone()
+        row = self._timed(super().fetchone)
+        self._rows += row is not None
+        self._finish()
+        return row
+
+    def fetchall(self):
+        if self._shape is None:
+            return super().fetchall()
+        rows = self._timed(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        if self._shape is None:
+            return super().__next__()
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    sample_rate = SQL_METRICS_SAMPLE_RATE
+    slow_query_ms = SQL_SLOW_QUERY_MS
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from database import Database
+from migrate import apply_migrations
+
+SETUP_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database_setup.sql')
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Gives every test a Database on a fresh temporary file, created the way initialize_db.py does."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'test.db')
+        connection = sqlite3.connect(self.path)
+        with open(SETUP_SQL, 'r', encoding='utf-8') as f:
+            connection.executescript(f.read())
+        connection.close()
+        apply_migrations(self.path)
+        self.db = Database(self.path)
+        self.addCleanup(self.db.close)
+
+    def add_participants(self, *names):
+        """Register participants with telegram ids 1001, 1002, ... and return their participant ids."""
+        ids = []
+        for number, name in enumerate(names, start=1001):
+            self.db.add_participant(number, name)
+            ids.append(self.db.get_participant_id(number))
+        return ids
+
+    def balances(self):
+        return dict(self.db.execute("SELECT participant_id, balance FROM participant_balances", fetchall=True))
@@ -0,0 +1,54 @@
+import unittest
+from datetime import date
+
+from tests.helpers import DatabaseTestCase
+
+
+class BalanceLedgerTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = self.add_participants("Alice", "Bob")
+
+    def test_payments_update_the_balance(self):
+        self.db.add_payment(1001, 1500, '2024-03-01')
+        self.db.add_payment(1001, -400, '2024-03-05')
+        self.db.add_payment(1002, 250.5, '2024-03-02')
+        self.assertEqual(self.db.calculate_balance(1001), 1100)
+        self.assertEqual(self.db.calculate_balance(1002), 250.5)
+        self.assertEqual(self.db.verify_balances(), [])
+
+    def test_initial_balance_resets_older_payments(self):
+        today = date.today().isoformat()
+        self.db.add_payment(1001, 700, '2020-01-01')
+        self.db.add_payment(1001, 300, today)
+        self.db.set_initial_balance_by_user_id(self.alice, 1000)
+        # Payments of the reset day still count on top of it; older ones don't
+        self.assertEqual(self.db.calculate_balance(1001), 1300)
+        self.db.add_payment(1001, -200, today)
+        self.assertEqual(self.db.calculate_balance(1001), 1100)
+        self.assertEqual(self.db.verify_balances(), [])
+
+    def test_imported_payments_count(self):
+        inserted, duplicates, archived = self.db.import_payments(
+            [(self.alice, 100, '2024-05-01'), (self.bob, 200, '2024-05-01'), (self.alice, 100, '2024-05-01')]
+        )
+        self.assertEqual((inserted, duplicates, archived), (3, 0, 0))
+        self.assertEqual(self.db.import_payments([(self.alice, 100.001, '2024-05-01')]), (0, 1, 0))
+        self.assertEqual(self.balances(), {self.alice: 200, self.bob: 200})
+        self.assertEqual(self.db.verify_balances(), [])
+
+    def test_rebuild_repairs_drift(self):
+        self.db.add_payment(1001, 500, '2024-03-01')
+        self.db.set_initial_balance_by_user_id(self.bob, -100)
+        self.db.execute("UPDATE participant_balances SET balance = 0", commit=True)
+        drifted = {participant_id: (stored, expected)
+                   for participant_id, _, stored, expected in self.db.verify_balances()}
+        self.assertEqual(drifted, {self.alice: (0, 500), self.bob: (0, -100)})
+        self.db.rebuild_balances()
+        self.assertEqual(self.db.verify_balances(), [])
+        self.assertEqual(self.balances(), {self.alice: 500, self.bob: -100})
+
+
+if __name__ == '__main__':
+    unittest.main()
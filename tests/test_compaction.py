@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import unittest
+from datetime import date, timedelta
+
+from database import STATUS_ATTENDING, STATUS_WITH_FRIEND
+from tests.helpers import DatabaseTestCase
+
+
+class CompactionTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive = os.path.join(self.directory, 'test.archive.db')
+        self.alice, self.bob, self.carol = self.add_participants("Alice", "Bob", "Carol")
+        for telegram_id, amount, day in ((1001, 2000, '2023-01-10'), (1002, 500, '2023-02-01'),
+                                         (1001, 300, '2023-06-01'), (1002, 800, '2024-02-01')):
+            self.db.add_payment(telegram_id, amount, day)
+        # Carol's balance was reset before the cutoff, Bob's after it
+        self.db.execute(
+            "INSERT INTO initial_balances (participant_id, balance, date) VALUES (?, ?, ?), (?, ?, ?)",
+            (self.carol, 150, '2023-03-01', self.bob, -50, '2024-01-15'), commit=True
+        )
+        self.db.add_payment(1003, 100, '2023-05-01')
+        self.db.rebuild_balances()
+        self.training = self.db.add_training('2023-04-01', '18:00', "Зал", 400)
+        self.db.update_registration(1001, self.training, STATUS_ATTENDING)
+        self.db.update_registration(1003, self.training, STATUS_WITH_FRIEND)
+        self.db.debit_funds_for_training(self.training)
+
+    def count(self, table):
+        return self.db.execute(f"SELECT COUNT(*) FROM {table}", fetchone=True)[0]
+
+    def test_balances_are_unchanged(self):
+        before = self.balances()
+        compaction = self.db.compact_ledger('2024-01-01', self.archive)
+        self.assertEqual(self.balances(), before)
+        self.assertEqual(self.db.verify_balances(), [])
+        # Debits are dated the day they were made, so they stay
+        self.assertEqual((compaction.payments, compaction.initial_balances), (4, 1))
+        self.assertEqual(self.count('payments'), 3)
+        # Archived rows keep their ids; registrations stay for the training list
+        archive = sqlite3.connect(self.archive)
+        self.assertEqual(archive.execute("SELECT COUNT(*) FROM payments").fetchone()[0], 4)
+        archive.close()
+        self.assertEqual(len(self.db.get_training_registrations(self.training)), 2)
+
+    def test_compacting_again_moves_nothing(self):
+        self.db.compact_ledger('2024-01-01', self.archive)
+        before = self.balances()
+        rows = {table: self.count(table) for table in ('payments', 'initial_balances')}
+        again = self.db.compact_ledger('2024-01-01', self.archive)
+        self.assertEqual((again.payments, again.initial_balances, again.checkpoints), (0, 0, 0))
+        self.assertEqual(self.balances(), before)
+        self.assertEqual({table: self.count(table) for table in rows}, rows)
+        self.assertEqual(len(self.db.get_compactions()), 2)
+
+    def test_later_payments_count_on_top_of_the_checkpoint(self):
+        self.db.compact_ledger('2024-01-01', self.archive)
+        self.db.add_payment(1001, -250, '2024-03-01')
+        self.db.add_payment(1003, 40, '2024-03-01')
+        self.assertEqual(self.db.verify_balances(), [])
+        self.assertEqual(self.db.calculate_balance(1001), 2000 + 300 - 400 - 250)
+        self.assertEqual(self.db.calculate_balance(1003), 150 + 100 - 800 + 40)
+
+    def test_future_cutoff_is_refused(self):
+        tomorrow = (date.today() + timedelta(days=1)).isoformat()
+        with self.assertRaises(ValueError):
+            self.db.compact_ledger(tomorrow, self.archive)
+        self.assertEqual(self.db.get_compactions(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import sqlite3
+import unittest
+
+from database import STATUS_ATTENDING, STATUS_WITH_FRIEND
+from tests.helpers import DatabaseTestCase
+
+
+class DebitTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = self.add_participants("Alice", "Bob", "Carol")
+        self.training = self.db.add_training('2024-03-01', '18:00', "Зал", 500)
+        self.db.update_registration(1001, self.training, STATUS_ATTENDING)
+        self.db.update_registration(1002, self.training, STATUS_WITH_FRIEND)
+        self.db.update_registration(1003, self.training, "не смогу")
+
+    def debit_payments(self):
+        return self.db.execute("SELECT participant_id, amount FROM payments ORDER BY participant_id", fetchall=True)
+
+    def test_debit_charges_attendees(self):
+        entries = self.db.debit_funds_for_training(self.training)
+        self.assertEqual({entry.participant_id: (entry.amount, entry.balance) for entry in entries},
+                         {self.alice: (500, -500), self.bob: (1000, -1000)})
+        self.assertEqual(self.debit_payments(), [(self.alice, -500), (self.bob, -1000)])
+        self.assertEqual(self.db.verify_balances(), [])
+
+    def test_debiting_twice_charges_once(self):
+        self.db.debit_funds_for_training(self.training)
+        self.assertIsNone(self.db.debit_funds_for_training(self.training))
+        self.assertEqual(self.db.debit_trainings_until('2024-12-31'), {})
+        self.assertEqual(self.db.debit_trainings_with_notices([self.training]), [])
+        self.assertEqual(self.debit_payments(), [(self.alice, -500), (self.bob, -1000)])
+        self.assertEqual(self.balances(), {self.alice: -500, self.bob: -1000, self.carol: 0})
+
+    def test_bulk_debit_skips_later_trainings(self):
+        later = self.db.add_training('2024-04-01', '18:00', "Зал", 300)
+        self.db.update_registration(1003, later, STATUS_ATTENDING)
+        debited = self.db.debit_trainings_until('2024-03-31')
+        self.assertEqual(list(debited), [self.training])
+        self.assertEqual(self.db.calculate_balance(1003), 0)
+        self.assertEqual([training_id for training_id, *_ in self.db.get_undebited_trainings()], [later])
+
+    def test_failed_debit_changes_nothing(self):
+        self.db.execute(
+            f"""
+            CREATE TRIGGER fail_bob BEFORE INSERT ON payments WHEN NEW.participant_id = {self.bob}
+            BEGIN SELECT RAISE(ABORT, 'payment rejected'); END
+            """,
+            commit=True
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.debit_funds_for_training(self.training)
+        self.assertEqual(self.debit_payments(), [])
+        self.assertEqual(self.balances(), {self.alice: 0, self.bob: 0, self.carol: 0})
+        self.assertEqual([training_id for training_id, *_ in self.db.get_undebited_trainings()], [self.training])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramNetworkError
+from aiogram.methods import SendMessage
+
+from notifications import Broadcaster
+
+
+class StubBot:
+    """Records when every message was sent; `failures` scripts exceptions per chat, raised in order."""
+
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        pending = self.failures.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append((chat_id, text, asyncio.get_running_loop().time()))
+
+
+def method(chat_id):
+    return SendMessage(chat_id=chat_id, text="test")
+
+
+class BroadcasterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def broadcast(self, bot, messages, **options):
+        results = []
+        broadcaster = Broadcaster(bot, on_result=lambda notification, result: results.append(result), **options)
+        broadcaster.start()
+        for chat_id, text in messages:
+            self.assertTrue(broadcaster.enqueue(chat_id, text))
+        await broadcaster.stop(timeout=10)
+        return broadcaster, results
+
+    def times(self, bot, chat_id=None):
+        return [sent_at for chat, _, sent_at in bot.sent if chat_id is None or chat == chat_id]
+
+    async def test_per_chat_spacing(self):
+        bot = StubBot()
+        await self.broadcast(bot, [(1, f"m{i}") for i in range(3)], workers=3, global_rate=1000, chat_rate=10)
+        times = self.times(bot, 1)
+        self.assertEqual([text for _, text, _ in bot.sent], ["m0", "m1", "m2"])
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 0.09)
+
+    async def test_group_chats_use_group_rate(self):
+        bot = StubBot()
+        await self.broadcast(bot, [(-100, "a"), (-100, "b")], global_rate=1000, chat_rate=1000, group_rate=10)
+        first, second = self.times(bot)
+        self.assertGreaterEqual(second - first, 0.09)
+
+    async def test_global_rate_limit(self):
+        bot = StubBot()
+        await self.broadcast(bot, [(chat_id, "m") for chat_id in range(1, 11)],
+                             workers=10, global_rate=50, chat_rate=1000)
+        times = sorted(self.times(bot))
+        self.assertEqual(len(times), 10)
+        # Ten messages at 50 per second take at least nine intervals of 20 ms
+        self.assertGreaterEqual(times[-1] - times[0], 9 * 0.02 - 0.005)
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 0.015)
+
+    async def test_retry_after_pauses_every_worker(self):
+        bot = StubBot({1: [TelegramRetryAfter(method(1), "Flood control exceeded", retry_after=1)]})
+        started = asyncio.get_running_loop().time()
+        broadcaster, results = await self.broadcast(bot, [(1, "flooded"), (2, "waits too")],
+                                                    workers=2, global_rate=1000, chat_rate=1000)
+        self.assertEqual(broadcaster.stats['retry_after'], 1)
+        self.assertEqual(sorted(result.chat_id for result in results if result.ok), [1, 2])
+        self.assertEqual({result.chat_id: result.attempts for result in results}, {1: 2, 2: 1})
+        self.assertGreaterEqual(self.times(bot, 1)[0] - started, 1)
+        self.assertGreaterEqual(self.times(bot, 2)[0] - started, 1)
+
+    async def test_permanent_failure_is_reported(self):
+        bot = StubBot({1: [TelegramForbiddenError(method(1), "Forbidden: bot was blocked by the user")]})
+        broadcaster, results = await self.broadcast(bot, [(1, "blocked")])
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertFalse(result.ok)
+        self.assertEqual((result.chat_id, result.attempts), (1, 1))
+        self.assertIn("blocked", result.error)
+        self.assertEqual(broadcaster.stats['failed'], 1)
+        self.assertEqual(bot.sent, [])
+
+    async def test_gives_up_after_max_retries(self):
+        errors = [TelegramNetworkError(method(1), "timeout") for _ in range(2)]
+        bot = StubBot({1: errors})
+        started = asyncio.get_running_loop().time()
+        broadcaster, results = await self.broadcast(bot, [(1, "lost")], max_retries=1)
+        self.assertEqual(len(results), 1)
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].attempts, 2)
+        self.assertEqual(broadcaster.stats['retried'], 1)
+        self.assertIn("timeout", results[0].error)
+        # One 2 s backoff before the retry, none after the last attempt
+        self.assertLess(asyncio.get_running_loop().time() - started, 3)
+
+    async def test_unexpected_error_is_reported(self):
+        bot = StubBot({1: [ValueError("undecodable response")], 2: [ValueError("undecodable response")]})
+        broadcaster = Broadcaster(bot)
+        broadcaster.start()
+        self.assertTrue(broadcaster.enqueue(1, "queued"))
+        result = await asyncio.wait_for(broadcaster.send(2, "awaited"), 1)
+        await broadcaster.stop(timeout=1)
+        self.assertFalse(result.ok)
+        self.assertIn("undecodable", result.error)
+        self.assertEqual(broadcaster.stats['failed'], 2)
+        self.assertEqual(broadcaster.queue.qsize(), 0)
+
+    async def test_full_queue_drops_message(self):
+        broadcaster = Broadcaster(StubBot(), queue_size=1)
+        self.assertTrue(broadcaster.enqueue(1, "first"))
+        self.assertFalse(broadcaster.enqueue(1, "second"))
+        self.assertEqual(broadcaster.stats['dropped'], 1)
+
+    async def test_send_waits_for_delivery(self):
+        bot = StubBot({2: [TelegramForbiddenError(method(2), "blocked")]})
+        broadcaster = Broadcaster(bot)
+        broadcaster.start()
+        sent, blocked = await asyncio.gather(broadcaster.send(1, "hello"), broadcaster.send(2, "hello"))
+        await broadcaster.stop()
+        self.assertTrue(sent.ok)
+        self.assertFalse(blocked.ok)
+        self.assertEqual([(chat, text) for chat, text, _ in bot.sent], [(1, "hello")])
+
+
+if __name__ == '__main__':
+    unittest.main()
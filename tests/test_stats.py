@@ -0,0 +1,61 @@
+import unittest
+
+from database import STATUS_ATTENDING, STATUS_WITH_FRIEND
+from migrate import apply_migrations
+from tests.helpers import DatabaseTestCase
+
+STATS_TABLES = ('participant_monthly_stats', 'participant_stats', 'monthly_stats')
+
+
+class StatsTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = self.add_participants("Alice", "Bob", "Carol")
+        march = self.db.add_training('2024-03-05', '18:00', "Зал", 500)
+        april = self.db.add_training('2024-04-02', '18:00', "Зал", 600)
+        self.db.add_training('2024-04-09', '18:00', "Зал", 600)
+        self.db.link_poll_to_training(april, 'poll-april')
+        self.db.update_registration(1001, march, STATUS_ATTENDING)
+        self.db.update_registration(1002, march, STATUS_ATTENDING)
+        self.db.update_registration(1002, march, STATUS_WITH_FRIEND)
+        self.db.update_registration(1003, march, "не смогу")
+        self.db.apply_registrations([
+            (1001, 'poll-april', STATUS_WITH_FRIEND), (1002, 'poll-april', STATUS_ATTENDING),
+            (1003, 'poll-april', STATUS_ATTENDING), (1003, 'poll-april', None),
+        ])
+        self.db.debit_funds_for_training(march)
+        # Answers after the debit are ignored, so stats keep matching what was charged
+        self.db.update_registration(1002, march, None)
+        self.db.debit_trainings_with_notices([april])
+        self.db.add_payment(1001, 2000, '2024-03-10')
+        self.db.add_payment(1002, -100, '2024-03-11')
+        self.db.import_payments([(self.bob, 700, '2024-04-01'), (self.carol, 300, '2024-04-03')])
+
+    def snapshot(self):
+        return {table: sorted(self.db.execute(f"SELECT * FROM {table}", fetchall=True)) for table in STATS_TABLES}
+
+    def test_incremental_stats_match_a_rebuild(self):
+        incremental = self.snapshot()
+        self.db.rebuild_stats()
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_report(self):
+        totals, participants = self.db.get_stats_report('2024-04')
+        self.assertEqual(tuple(totals), (2, 2, 1, 2 * 600 + 600, 1000))
+        self.assertEqual({row.name: (row.attended, row.plus_ones, row.debited, row.paid) for row in participants},
+                         {"Alice": (1, 1, 1200, 0), "Bob": (1, 0, 600, 700), "Carol": (0, 0, 0, 300)})
+        totals, _ = self.db.get_stats_report()
+        self.assertEqual(tuple(totals), (3, 4, 2, 500 + 1000 + 1800, 3000))
+
+    def test_migration_fills_stats_from_history(self):
+        incremental = self.snapshot()
+        for table in STATS_TABLES:
+            self.db.execute(f"DELETE FROM {table}", commit=True)
+        self.db.execute("DELETE FROM schema_migrations WHERE version = 14", commit=True)
+        self.assertEqual(apply_migrations(self.path), [14])
+        self.assertEqual(self.snapshot(), incremental)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram.types import Update
+
+from config import WEBHOOK_MAX_CONCURRENCY, WEBHOOK_MAX_PENDING
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+WEBHOOK_REQUESTS = REGISTRY.counter(
+    'bot_webhook_requests_total', "Webhook requests by outcome", ('outcome',)
+)
+WEBHOOK_PENDING = REGISTRY.gauge(
+    'bot_webhook_pending_updates', "Acknowledged webhook updates not yet processed"
+)
+
+
+class WebhookServer:
+    """Receives updates from Telegram over HTTPS POST instead of long polling.
+
+    Every request is checked against the secret token given to setWebhook,
+    parsed and acknowledged with 200 straight away; the update itself is
+    processed in a background task. At most `max_concurrency` updates are
+    fed to the dispatcher at once. When `max_pending` updates are already
+    waiting the server answers 503, and Telegram redelivers the update later.
+    """
+
+    def __init__(self, dp, bot, secret, max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+                 max_pending=WEBHOOK_MAX_PENDING):
+        # Without the secret anyone who finds the URL could post updates as any user
+        if not secret:
+            raise ValueError("webhook mode needs WEBHOOK_SECRET")
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.max_pending = max_pending
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks = set()
+        self._runner = None
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            WEBHOOK_REQUESTS.inc('forbidden')
+            return web.Response(status=403)
+        if len(self.tasks) >= self.max_pending:
+            WEBHOOK_REQUESTS.inc('overloaded')
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except ValueError:
+            WEBHOOK_REQUESTS.inc('invalid')
+            return web.Response(status=400)
+        WEBHOOK_REQUESTS.inc('accepted')
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        WEBHOOK_PENDING.inc()
+        try:
+            async with self.semaphore:
+                await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+        finally:
+            WEBHOOK_PENDING.dec()
+
+    async def start(self, host, port, path):
+        """Serve POST `path` on host:port."""
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Receiving webhook updates on http://%s:%d%s", host, port, path)
+
+    async def stop(self, timeout=10):
+        """Stop accepting requests and wait up to `timeout` seconds for updates in progress."""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        if self.tasks:
+            done, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()